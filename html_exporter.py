@@ -1,9 +1,23 @@
 import pandas as pd
-from jinja2 import Environment, FileSystemLoader
-from typing import List, Dict, Any, Set, Union
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from typing import List, Dict, Any, Set, Union, Iterable, Iterator, Optional, NamedTuple, Tuple
 import os
+import re
+import argparse
+import multiprocessing
+import queue
+import threading
+import time
+import io
+import tarfile
+import zipfile
+import itertools
+import collections
+import sqlite3
 from pathlib import Path
 
+from npc_profile import PROFILER, report_profile
+
 # =======================================================
 # 1. 定数とマスタデータ準備
 # =======================================================
@@ -11,12 +25,31 @@ from pathlib import Path
 FIELD_ORDER = ['器術', '体術', '忍術', '謀術', '戦術', '妖術'] 
 FIELD_MAX_SIZE = 11 
 OUTPUT_DIR = Path("html")
+# コンパイル済みテンプレートのキャッシュ置き場 (テンプレートの内容が変わると Jinja2 が作り直す)
+TEMPLATE_CACHE_DIR = '.jinja_cache'
+# 共有スタイルシートのファイル名 (シートと同じ場所に置く)
+SHARED_CSS_NAME = 'sheet.css'
+STYLE_BLOCK_PATTERN = re.compile(r'<style\b[^>]*>(.*?)</style>', re.S | re.I)
+# 空白を詰めずにそのまま残す要素
+PRESERVED_BLOCK_PATTERN = re.compile(r'(<(pre|textarea|script)\b.*?</\2\s*>)', re.S | re.I)
+CSS_COMMENT_PATTERN = re.compile(r'/\*.*?\*/', re.S)
+CSS_SPACE_PATTERN = re.compile(r'\s*([{};:,>])\s*')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+# 改行を含むタグ間の空白 (テンプレートの字下げ) は表示に影響しないため取り除く
+TAG_GAP_PATTERN = re.compile(r'>\s*\n\s*<')
+# 空の class 属性と、class 値の前後の空白 (グリッドのセルで多い)
+EMPTY_CLASS_PATTERN = re.compile(r'\sclass="\s*"')
+PADDED_CLASS_PATTERN = re.compile(r'class="\s*([^"]*?)\s*"')
 
 SCHOOL_SERIES_FIELD_MAP = {
     '斜歯系列': '器術', '鞍馬系列': '体術', 'ハグレ系列': '忍術',
     '比良坂系列': '謀術', '御斎系列': '戦術', '隠忍系列': '妖術',
     '古流': None, '汎用': None, '屍衣': '妖術', 
 }
+# 修得データ (キャラ*.csv) の種類
+ACQUIRED_KINDS = ['背景', '忍法', '特技', '奥義', '忍具']
+# 忍法リストに表示する忍法マスタの項目と、マスタにない場合の既定値
+NINPO_DETAIL_DEFAULTS = {'タイプ': '攻撃', '間合': '-', 'コスト': '0'}
 
 # load_csv_safely 関数は変更なし
 def load_csv_safely(filenames: List[str], error_message: str) -> pd.DataFrame:
@@ -31,14 +64,124 @@ def load_csv_safely(filenames: List[str], error_message: str) -> pd.DataFrame:
     print(f"\n--- エラー: {error_message} ---")
     raise FileNotFoundError(f"必要なファイルが見つかりません。候補: {', '.join(filenames)}")
 
-def load_master_skills(df_skills: pd.DataFrame) -> Dict[str, Dict[str, List[str]]]:
+def load_parquet_safely(filename: str, error_message: str) -> pd.DataFrame:
+    """Parquet を読み込む (pyarrow が必要)。ID などの型はファイルに保存されたものがそのまま使われる"""
+    try:
+        return pd.read_parquet(filename)
+    except FileNotFoundError:
+        print(f"\n--- エラー: {error_message} ---")
+        raise FileNotFoundError(f"必要なファイルが見つかりません。候補: {filename}")
+
+def load_generated_tables(input_format: str = 'csv') -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]:
+    """npc_logic が出力した結合ファイルと5つの正規化ファイルを読み込む (input_format は 'csv' / 'parquet')"""
+    def load(name: str) -> pd.DataFrame:
+        if input_format == 'parquet':
+            return load_parquet_safely(f'{name}.parquet', f'{name}.parquetが見つかりません。')
+        return load_csv_safely([f'{name}.csv'], f'{name}.csvが見つかりません。')
+
+    df_base = load('generated_npcs_with_base_data')
+    acquired_data = {kind: load(f'キャラ{kind}') for kind in ACQUIRED_KINDS}
+    return df_base, acquired_data
+
+# npc_logic の SQLite 出力 (テーブル名は各CSVのファイル名から拡張子を除いたもの)
+SQLITE_INPUT_FILE = 'generated_npcs.sqlite'
+BASE_TABLE = 'generated_npcs_with_base_data'
+
+def open_generated_database(db_path: str = SQLITE_INPUT_FILE) -> sqlite3.Connection:
+    """SQLite 出力を読み取り専用で開く (ファイルがない場合は FileNotFoundError)"""
+    path = Path(db_path)
+    if not path.exists():
+        print(f"\n--- エラー: {db_path}が見つかりません。 ---")
+        raise FileNotFoundError(f"必要なファイルが見つかりません。候補: {db_path}")
+    conn = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+# --where の条件: '列名 演算子 値' (例: '階級=上忍', '功績点 >= 10')。演算子は2文字のものから照合する
+WHERE_CONDITION_PATTERN = re.compile(r'\s*(.+?)\s*(!=|>=|<=|=|>|<)\s*(.*?)\s*')
+
+def parse_where_value(value: str) -> Tuple[Any, bool]:
+    """
+    --where の値を (比較する値, 数値として比較するか) にする。
+    引用符で囲んだ値 (例: '007') は文字列のまま、数値として読める値は int / float として比較する。
+    """
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '\'"':
+        return value[1:-1], False
+    for convert in (int, float):
+        try:
+            return convert(value), True
+        except ValueError:
+            pass
+    return value, False
+
+def build_where_clause(conn: sqlite3.Connection, conditions: Optional[Iterable[str]] = None) -> Tuple[str, List[Any]]:
+    """
+    --where の条件 ('列名 演算子 値') を結合テーブルの列と照合し、(WHERE 句, パラメータ) を作る。
+    値は SQL に埋め込まず ? で渡し、複数の条件は AND で結ぶ。書式の誤りや存在しない列は ValueError。
+    名簿由来の列 (年齢など) は TEXT で保存されているため、値が数値なら列も数値に変換して比較する
+    (文字列のままだと '10' < '9' のように辞書順になる)。
+    """
+    if not conditions:
+        return '', []
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info("{BASE_TABLE}")')}
+    clauses, params = [], []
+    for condition in conditions:
+        match = WHERE_CONDITION_PATTERN.fullmatch(condition)
+        if not match:
+            raise ValueError(f"絞り込み条件の書式が正しくありません: {condition!r} (例: 階級=上忍)")
+        column, operator, value = match.groups()
+        if column not in columns:
+            raise ValueError(f"絞り込み条件の列 '{column}' は {BASE_TABLE} にありません。列: {', '.join(sorted(columns))}")
+        value, numeric = parse_where_value(value)
+        if numeric:
+            clauses.append(f'CAST("{column}" AS NUMERIC) {operator} ?')
+        else:
+            clauses.append(f'"{column}" {operator} ?')
+        params.append(value)
+    return ' WHERE ' + ' AND '.join(clauses), params
+
+def iter_database_tasks(conn: sqlite3.Connection, where_clause: str = '', params: Iterable[Any] = ()) -> Iterator[tuple]:
+    """
+    結合テーブルの行 (build_where_clause で作った条件で絞り込み可能) を順に読み、
+    1キャラクターずつ 連番 の索引で修得データを引いて (基本データの行, 修得データ) を返す。
+    """
+    query = f'SELECT * FROM "{BASE_TABLE}"{where_clause} ORDER BY rowid'
+    for base_row in conn.execute(query, tuple(params)):
+        row = dict(base_row)
+        char_id = row.get('連番')
+        char_records = {
+            kind: [dict(r) for r in conn.execute(f'SELECT * FROM "キャラ{kind}" WHERE "連番" = ? ORDER BY rowid', (char_id,))]
+            for kind in ACQUIRED_KINDS
+        }
+        yield row, char_records
+
+def load_master_skills(df_skills: pd.DataFrame) -> Dict[str, Dict[str, Any]]:
     field_skills_data = df_skills.groupby('分野')['名前'].apply(list).to_dict()
     skill_field_map = df_skills.set_index('名前')['分野'].to_dict()
+    # 特技名 -> ビット番号 (特技マスタ順)。グリッドの各セルのビット番号も事前に求めておく
+    skill_bit_map = {name: bit for bit, name in enumerate(skill_field_map)}
+    field_skill_bits = {
+        field: [skill_bit_map[name] for name in names] for field, names in field_skills_data.items()
+    }
     return {
         'field_skills_data': field_skills_data,
-        'skill_field_map': skill_field_map
+        'skill_field_map': skill_field_map,
+        'skill_bit_map': skill_bit_map,
+        'field_skill_bits': field_skill_bits,
+        # 得意分野ごとのグリッドの骨格 (get_skill_grid が必要になった時に作る)
+        'grid_skeletons': {},
     }
 
+def skills_to_mask(skill_names: Iterable[str], master_data: Dict[str, Dict[str, Any]]) -> int:
+    """特技名の集合を特技マスタ順のビットマスクに変換する (マスタにない特技名は無視)"""
+    skill_bit_map = master_data['skill_bit_map']
+    mask = 0
+    for name in skill_names:
+        bit = skill_bit_map.get(name)
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
 def load_master_ninpo(df_ninpo_master: pd.DataFrame) -> Dict[str, str]:
     """忍法マスタから忍法名と流派のマップを作成し、空白を除去する"""
     if '名前' in df_ninpo_master.columns and '流派' in df_ninpo_master.columns:
@@ -76,22 +219,68 @@ def safe_int_conversion(value: Any, default: int = 0) -> int:
     except (ValueError, TypeError):
         return default
 
+def load_master_ninpo_details(df_ninpo_master: pd.DataFrame) -> Dict[str, Dict[str, Any]]:
+    """忍法マスタから忍法名 -> {タイプ, 間合, コスト} のマップを作成する (同名の忍法は先の行を採用)"""
+    details = {}
+    columns = [col for col in NINPO_DETAIL_DEFAULTS if col in df_ninpo_master.columns]
+    if '名前' not in df_ninpo_master.columns:
+        return details
+    for row in df_ninpo_master.to_dict('records'):
+        name = str(row['名前']).strip()
+        if name not in details:
+            details[name] = {col: row[col] for col in columns if not pd.isna(row[col])}
+    return details
+
+def build_school_series_map(df_school: pd.DataFrame) -> Dict[str, str]:
+    """流派マスタから流派名 -> 流派系列 のマップを作成する (同名の流派は先の行を採用)"""
+    if '流派名' not in df_school.columns or '流派系列' not in df_school.columns:
+        return {}
+    series_map = {}
+    for name, series in zip(df_school['流派名'], df_school['流派系列']):
+        series_map.setdefault(name, series)
+    return series_map
+
+def group_acquired_records(acquired_data: Dict[str, pd.DataFrame]) -> Dict[str, Dict[Any, List[Dict[str, Any]]]]:
+    """修得データの各表を1回だけ走査し、種類ごとに 連番 -> 行 (辞書) のリスト にまとめる"""
+    grouped = {}
+    for kind, df in acquired_data.items():
+        by_id: Dict[Any, List[Dict[str, Any]]] = {}
+        for row in df.to_dict('records'):
+            by_id.setdefault(row['連番'], []).append(row)
+        grouped[kind] = by_id
+    return grouped
+
+def records_for_character(grouped: Dict[str, Dict[Any, List[Dict[str, Any]]]], char_id: Any) -> Dict[str, List[Dict[str, Any]]]:
+    """group_acquired_records の結果から1キャラクター分の行を取り出す"""
+    return {kind: grouped.get(kind, {}).get(char_id, []) for kind in ACQUIRED_KINDS}
+
 # =======================================================
 # 2. データ変換ロジック
 # =======================================================
 
-def get_skill_grid(acquired_skills: Set[str], master_data: Dict[str, Dict[str, List[str]]], school_series: str) -> List[List[Dict[str, Any]]]:
+class GridCell(NamedTuple):
+    """特技グリッドの1セル (テンプレートからは cell.name / cell.css で参照する)"""
+    name: str
+    css: str
+
+class GridSkeleton(NamedTuple):
+    """得意分野ごとに共通の、修得状態を除いたグリッド"""
+    rows: Tuple[Tuple[GridCell, ...], ...]
+    # 特技のビット番号 -> [(行, 列, 修得済みのセル)]
+    checked_cells: Dict[int, List[Tuple[int, int, GridCell]]]
+
+def build_grid_skeleton(master_data: Dict[str, Dict[str, Any]], preferred_field: Optional[str]) -> GridSkeleton:
     """
-    修得特技セットを6x11のグリッド形式に整形し、特技の間に1つの空欄を挿入して12列構造にする。
+    特技を6x11のグリッド形式に並べ、特技の間に1つの空欄を挿入して12列構造にする (修得状態は含まない)。
     特技の左右の空欄が、特技自身または次の特技が得意分野であれば黒塗りになる。
     """
-    
     field_skills = master_data['field_skills_data']
-    grid = []
-    preferred_field = SCHOOL_SERIES_FIELD_MAP.get(school_series, None)
+    field_skill_bits = master_data['field_skill_bits']
+    rows = []
+    checked_cells: Dict[int, List[Tuple[int, int, GridCell]]] = {}
     
     # 修正: 空欄セルを生成し、直前の分野（field_check）と次の分野（next_field_check）をチェックする
-    def conditional_blackout_cell(prev_field: str, next_field: str | None) -> Dict[str, str]:
+    def conditional_blackout_cell(prev_field: str, next_field: str | None) -> GridCell:
         """直前の分野 OR 次の分野が得意系列であれば空欄セルを黒塗り（blackout-col）にする"""
         css_classes = 'gap-col' 
         
@@ -99,23 +288,26 @@ def get_skill_grid(acquired_skills: Set[str], master_data: Dict[str, Dict[str, L
         if prev_field == preferred_field or next_field == preferred_field:
             css_classes += ' blackout-col'
         
-        return {'name': '', 'css': css_classes.strip()} 
+        return GridCell('', css_classes.strip())
 
     for i in range(FIELD_MAX_SIZE):
         row_final = []
         # 1. 行番号の列 (1列目)
-        row_final.append({'name': str(i + 2), 'css': 'row-number'}) 
+        row_final.append(GridCell(str(i + 2), 'row-number')) 
         
         for field_index, field in enumerate(FIELD_ORDER):
             
             is_preferred_field = field == preferred_field
+            preferred_css = ' preferred-field-cell' if is_preferred_field else ''
             skills_in_field = field_skills.get(field, [])
             skill_name = skills_in_field[i] if i < len(skills_in_field) else ''
-            cell_css = 'checked' if skill_name in acquired_skills else ''
             
-            # A. 特技セル (6個)
-            cell_css += ' preferred-field-cell' if is_preferred_field else '' 
-            row_final.append({'name': skill_name, 'css': cell_css}) 
+            # A. 特技セル (6個)。修得済みの場合に差し替えるセルも用意しておく
+            if skill_name:
+                checked_cells.setdefault(field_skill_bits[field][i], []).append(
+                    (i, len(row_final), GridCell(skill_name, 'checked' + preferred_css))
+                )
+            row_final.append(GridCell(skill_name, preferred_css)) 
             
             # B. 特技の右側の空欄セル (5個)
             # 最後のフィールドの後ろには挿入しない
@@ -126,18 +318,41 @@ def get_skill_grid(acquired_skills: Set[str], master_data: Dict[str, Dict[str, L
                 # ★修正箇所: 直前の分野(field)と次の分野(next_field)をチェックして空欄セルを生成
                 row_final.append(conditional_blackout_cell(field, next_field)) 
 
-        grid.append(row_final)
+        rows.append(tuple(row_final))
         
+    return GridSkeleton(tuple(rows), checked_cells)
+
+def get_skill_grid(acquired_skills: Union[int, Set[str]], master_data: Dict[str, Dict[str, Any]], school_series: str) -> List[List[GridCell]]:
+    """
+    修得特技 (ビットマスク、または特技名のセット) を6x11・12列構造のグリッドに整形する。
+    得意分野ごとの骨格を使い回し、修得済みの特技のセルだけを差し替える。
+    """
+    acquired_mask = acquired_skills if isinstance(acquired_skills, int) else skills_to_mask(acquired_skills, master_data)
+    preferred_field = SCHOOL_SERIES_FIELD_MAP.get(school_series, None)
+    skeletons = master_data.setdefault('grid_skeletons', {})
+    skeleton = skeletons.get(preferred_field)
+    if skeleton is None:
+        skeleton = skeletons[preferred_field] = build_grid_skeleton(master_data, preferred_field)
+
+    grid = [list(row) for row in skeleton.rows]
+    while acquired_mask:
+        low_bit = acquired_mask & -acquired_mask
+        for i, col, cell in skeleton.checked_cells.get(low_bit.bit_length() - 1, ()):
+            grid[i][col] = cell
+        acquired_mask ^= low_bit
     return grid
 
-def prepare_context(char_row: pd.Series, acquired_data: Dict[str, pd.DataFrame], master_data: Dict[str, Dict[str, List[str]]], df_school: pd.DataFrame, ninpo_school_map: Dict[str, str]) -> Dict[str, Any]:
-    """1キャラクター分のデータをHTMLテンプレート用の辞書形式にまとめる"""
+def prepare_context(char_row: Dict[str, Any], char_records: Dict[str, List[Dict[str, Any]]], master_data: Dict[str, Dict[str, List[str]]], school_series_map: Dict[str, str], ninpo_school_map: Dict[str, str], ninpo_detail_map: Optional[Dict[str, Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    1キャラクター分のデータをHTMLテンプレート用の辞書形式にまとめる。
+    char_records は records_for_character で取り出した、このキャラクターの修得データ。
+    """
+    ninpo_detail_map = ninpo_detail_map or {}
     
     char_id = char_row['連番']
     school_name = str(char_row.get('下位流派', char_row.get('流派', '汎用'))).strip() 
 
-    school_data = df_school[df_school['流派名'] == school_name] 
-    school_series = school_data.iloc[0]['流派系列'] if not school_data.empty and '流派系列' in school_data.columns else '汎用'
+    school_series = school_series_map.get(school_name, '汎用')
 
     # 1. 基本情報
     context = {
@@ -151,10 +366,8 @@ def prepare_context(char_row: pd.Series, acquired_data: Dict[str, pd.DataFrame],
     }
     
     # 2. 背景データの処理
-    df_bg = acquired_data['背景']
-    df_bg_char = df_bg[df_bg['連番'] == char_id]
     bg_detail_list = []
-    for _, bg_row in df_bg_char.iterrows():
+    for bg_row in char_records['背景']:
         bg_detail_list.append({
             '種別': str(bg_row.get('種別', '不明')),
             '背景名': str(bg_row.get('背景名', '不明')),
@@ -164,30 +377,28 @@ def prepare_context(char_row: pd.Series, acquired_data: Dict[str, pd.DataFrame],
 
 
     # 3. 特技データの処理（グリッド作成）
-    df_skill = acquired_data['特技']
-    char_skills = set(df_skill[df_skill['連番'] == char_id]['特技名'].tolist())
+    char_skills = skills_to_mask((s_row['特技名'] for s_row in char_records['特技']), master_data)
     # グリッド形式（6x11の12列構造）に変換
     context['skills'] = get_skill_grid(char_skills, master_data, school_series)
 
     # 4. 忍法データの処理
-    df_ninpo = acquired_data['忍法']
     char_ninpo_list = []
-    for _, n_row in df_ninpo[df_ninpo['連番'] == char_id].iterrows():
+    for n_row in char_records['忍法']:
         n_name = n_row['忍法名']
+        chosen_ninpo = ninpo_detail_map.get(n_name, {})
         char_ninpo_list.append({
             'name': n_name,
-            'タイプ': chosen_ninpo.get('タイプ', '攻撃'), # 追加
-            '間合': chosen_ninpo.get('間合', '-'),      # 追加
-            'コスト': chosen_ninpo.get('コスト', '0'),     # 追加
+            'タイプ': chosen_ninpo.get('タイプ', NINPO_DETAIL_DEFAULTS['タイプ']),
+            '間合': chosen_ninpo.get('間合', NINPO_DETAIL_DEFAULTS['間合']),
+            'コスト': chosen_ninpo.get('コスト', NINPO_DETAIL_DEFAULTS['コスト']),
             'skill': n_row.get('指定特技', 'なし'),
             'styles': ninpo_school_map.get(n_name, '汎用')
         })
     context['ninpo'] = char_ninpo_list
 
     # 奥義リスト作成 (変更なし)
-    df_ougi = acquired_data['奥義']
     ougi_list = []
-    for _, o_row in df_ougi[df_ougi['連番'] == char_id].iterrows():
+    for o_row in char_records['奥義']:
         ougi_list.append({
             'name': o_row['奥義名'],
             'skill': o_row.get('指定特技', 'なし')
@@ -195,9 +406,8 @@ def prepare_context(char_row: pd.Series, acquired_data: Dict[str, pd.DataFrame],
     context['ougi'] = ougi_list
 
     # 忍具リスト作成
-    df_ningu = acquired_data['忍具']
     items_dict = {}
-    for _, i_row in df_ningu[df_ningu['連番'] == char_id].iterrows():
+    for i_row in char_records['忍具']:
         # ★修正: 忍具の個数に safe_int_conversion を適用
         items_dict[i_row['忍具名']] = safe_int_conversion(i_row['個数'])
     context['items'] = items_dict
@@ -205,77 +415,429 @@ def prepare_context(char_row: pd.Series, acquired_data: Dict[str, pd.DataFrame],
     return context
 
 # =======================================================
-# 3. メイン実行関数 (変更なし)
+# 3. シートの描画と書き出し
 # =======================================================
 
-def export_html():
-    
-    # 1. 必要なCSVファイルと特技マスタの読み込み
-    try:
-        df_base = load_csv_safely(['generated_npcs_with_base_data.csv'], '基本データファイルが見つかりません。')
-        acquired_data = {
-            '背景': load_csv_safely(['キャラ背景.csv'], 'キャラ背景.csvが見つかりません。'),
-            '忍法': load_csv_safely(['キャラ忍法.csv'], 'キャラ忍法.csvが見つかりません。'),
-            '特技': load_csv_safely(['キャラ特技.csv'], 'キャラ特技.csvが見つかりません。'),
-            '奥義': load_csv_safely(['キャラ奥義.csv'], 'キャラ奥義.csvが見つかりません。'),
-            '忍具': load_csv_safely(['キャラ忍具.csv'], 'キャラ忍具.csvが見つかりません。'),
-        }
-        df_skills_master = load_csv_safely(
-            ['特技.xlsx - 特技_マスタ.csv', '特技_マスタ.csv'], 
-            '特技マスタファイルが見つかりません。'
-        )
-        master_data = load_master_skills(df_skills_master)
-        df_school_master = load_csv_safely(
-            ['流派.xlsx - 流派_マスタ.csv', '流派_マスタ.csv'], 
-            '流派マスタファイルが見つかりません。'
-        )
-        df_ninpo_master = load_csv_safely(
-            ['忍法.xlsx - 忍法_マスタ.csv', '忍法_マスタ.csv'], 
-            '忍法マスタファイルが見つかりません。'
-        )
-        ninpo_school_map = load_master_ninpo(df_ninpo_master)
+def minify_css(css: str) -> str:
+    """コメントと余分な空白を取り除く"""
+    css = CSS_COMMENT_PATTERN.sub('', css)
+    css = CSS_SPACE_PATTERN.sub(r'\1', WHITESPACE_PATTERN.sub(' ', css))
+    return css.replace(';}', '}').strip()
+
+def minify_html(html: str) -> str:
+    """
+    テンプレートの字下げや改行を詰める (pre / textarea / script の中はそのまま)。
+    グリッドのセルは空の class 属性を省き、タグだけが連続する形になる。
+    """
+    parts = PRESERVED_BLOCK_PATTERN.split(html)
+    minified = []
+    # split の結果は [通常部分, 保持ブロック, タグ名, 通常部分, ...] の並び
+    for i in range(0, len(parts), 3):
+        text = TAG_GAP_PATTERN.sub('><', parts[i])
+        text = PADDED_CLASS_PATTERN.sub(r'class="\1"', EMPTY_CLASS_PATTERN.sub('', text))
+        minified.append(WHITESPACE_PATTERN.sub(' ', text))
+        if i + 1 < len(parts):
+            minified.append(parts[i + 1])
+    return ''.join(minified).strip()
+
+def extract_static_styles(template_source: str) -> List[str]:
+    """テンプレート中の <style> のうち、Jinja2 の式を含まない (全シート共通の) ものの中身を返す"""
+    return [css for css in STYLE_BLOCK_PATTERN.findall(template_source) if '{{' not in css and '{%' not in css]
+
+class RenderedSheet(NamedTuple):
+    """描画結果。filename が None の場合、html にはエラーメッセージが入る"""
+    npc_id: Any
+    name: str
+    filename: Optional[str]
+    html: str
+    # 共有CSS/縮小を適用する前のバイト数 (どちらも使わない場合は 0)
+    raw_size: int = 0
+
+class SheetRenderer:
+    """マスタ由来のデータと Jinja2 テンプレートを保持し、1キャラクター分のシートを描画する"""
+
+    def __init__(self, master_data: Dict[str, Dict[str, Any]], school_series_map: Dict[str, str],
+                 ninpo_school_map: Dict[str, str], ninpo_detail_map: Dict[str, Dict[str, Any]],
+                 template_dir: str = '.', template_name: str = 'template.html',
+                 bytecode_cache_dir: Optional[str] = TEMPLATE_CACHE_DIR,
+                 shared_css: bool = False, minify: bool = False):
+        """
+        shared_css: テンプレートの共通 <style> をシートから外し、SHARED_CSS_NAME への <link> に置き換える
+        minify: シートの HTML の字下げ・改行を詰める
+        """
+        self.master_data = master_data
+        self.school_series_map = school_series_map
+        self.ninpo_school_map = ninpo_school_map
+        self.ninpo_detail_map = ninpo_detail_map
+        start = time.perf_counter()
+        bytecode_cache = None
+        if bytecode_cache_dir:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+        env = Environment(loader=FileSystemLoader(template_dir), bytecode_cache=bytecode_cache)
+        self.template = env.get_template(template_name)
+        self.compile_seconds = time.perf_counter() - start
+
+        self.minify = minify
+        self.static_styles = set()
+        self.shared_css_text = None
+        if shared_css:
+            template_source = env.loader.get_source(env, template_name)[0]
+            styles = extract_static_styles(template_source)
+            self.static_styles = set(styles)
+            self.shared_css_text = '\n'.join(minify_css(css) for css in styles) + '\n'
+
+    def _postprocess(self, output_html: str) -> str:
+        """共通スタイルの外出しと縮小を適用する"""
+        if self.static_styles:
+            linked = False
+            def replace_style(match: re.Match) -> str:
+                nonlocal linked
+                if match.group(1) not in self.static_styles:
+                    return match.group(0)
+                if linked:
+                    return ''
+                linked = True
+                return f'<link rel="stylesheet" href="{SHARED_CSS_NAME}">'
+            output_html = STYLE_BLOCK_PATTERN.sub(replace_style, output_html)
+        if self.minify:
+            output_html = minify_html(output_html)
+        return output_html
+
+    def render(self, row: Dict[str, Any], char_records: Dict[str, List[Dict[str, Any]]]) -> RenderedSheet:
+        profiling = PROFILER.enabled
+        if profiling:
+            start = time.perf_counter_ns()
+        context = prepare_context(row, char_records, self.master_data, self.school_series_map,
+                                  self.ninpo_school_map, self.ninpo_detail_map)
+        if profiling:
+            context_done = time.perf_counter_ns()
+            PROFILER.add('シート: コンテキスト', context_done - start)
+        output_html = self.template.render(context)
+        raw_size = 0
+        if self.static_styles or self.minify:
+            raw_size = len(output_html.encode('utf-8'))
+            output_html = self._postprocess(output_html)
+        if profiling:
+            PROFILER.add('シート: 描画', time.perf_counter_ns() - context_done)
         
-    except FileNotFoundError as e:
-        print(f"\n--- 致命的なエラーにより処理を中断しました ---")
-        print(e)
-        return
+        npc_id = row['連番']
+        npc_name = str(row.get('氏名', f'名無し_{npc_id}')).strip()
+        return RenderedSheet(npc_id, npc_name, f"char_sheet_{npc_id}_{npc_name}.html", output_html, raw_size)
+
+    def render_many(self, tasks: List[tuple]) -> List[RenderedSheet]:
+        """(行, 修得データ) のリストを描画する。失敗したキャラクターはエラーメッセージ入りの結果になる"""
+        results = []
+        for row, char_records in tasks:
+            try:
+                results.append(self.render(row, char_records))
+            except Exception as e:
+                # エラーの詳細（スタックトレース）を出力しないことで、視認性を高めます
+                results.append(RenderedSheet(
+                    row.get('連番', '不明'), str(row.get('氏名', '')).strip(), None,
+                    f"HTML生成中にエラーが発生しました: 連番 {row.get('連番', '不明')}, エラー: {type(e).__name__}: {e}"
+                ))
+        return results
+
+class SheetWriter:
+    """
+    描画済みのシートを別スレッドでファイルに書き出す。
+    キューの長さを max_pending で制限し、描画が書き出しより先行しすぎないようにする。
+    """
+
+    def __init__(self, output_dir: Path, max_pending: int = 64):
+        self.output_dir = output_dir
+        self.count = 0
+        self.bytes_written = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, sheet: RenderedSheet):
+        self._queue.put(sheet)
+
+    def add_asset(self, filename: str, text: str):
+        """シート以外の共有ファイル (CSS など) を書き出す。シートを put する前に呼ぶ"""
+        self._store(filename, text)
+        self.bytes_written += len(text.encode('utf-8'))
+
+    def close(self):
+        """キューに残ったシートをすべて書き出してからスレッドを終了する"""
+        self._queue.put(None)
+        self._thread.join()
+        self._finish()
+
+    def _run(self):
+        while True:
+            sheet = self._queue.get()
+            if sheet is None:
+                return
+            try:
+                if PROFILER.enabled:
+                    start = time.perf_counter_ns()
+                self._write(sheet)
+                if PROFILER.enabled:
+                    PROFILER.add('シート: 書き出し', time.perf_counter_ns() - start)
+                self.count += 1
+                self.bytes_written += len(sheet.html.encode('utf-8'))
+            except Exception as e:
+                print(f"HTML書き出し中にエラーが発生しました: {sheet.filename}, エラー: {type(e).__name__}: {e}")
+
+    def _write(self, sheet: RenderedSheet):
+        self._store(sheet.filename, sheet.html)
+
+    def _store(self, filename: str, text: str):
+        with open(self.output_dir / filename, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def _finish(self):
+        pass
+
+class ArchiveSheetWriter(SheetWriter):
+    """
+    描画済みのシートを1つの zip / tar アーカイブに順次追記する (シートはメモリに溜めない)。
+    形式は拡張子で決める: .zip, .tar, .tar.gz (.tgz), .tar.xz (compress=False の場合は .zip か .tar)。
+    最後に 連番・氏名・メンバーパス の一覧を index.csv として追加する。
+    """
+
+    INDEX_NAME = 'index.csv'
+
+    def __init__(self, archive_path: Path, compress: bool = True, max_pending: int = 64):
+        self.archive_path = archive_path
+        self.index: List[Dict[str, Any]] = []
+        name = archive_path.name.lower()
+        if name.endswith('.zip'):
+            self._zip = zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+            self._tar = None
+        elif name.endswith('.tar'):
+            self._zip = None
+            self._tar = tarfile.open(archive_path, 'w')
+        elif name.endswith(('.tar.gz', '.tgz', '.tar.xz')):
+            # 圧縮形式の拡張子で無圧縮の tar を書くと展開できないため、組み合わせ自体を受け付けない
+            if not compress:
+                raise ValueError(f"無圧縮の tar アーカイブは拡張子を .tar にしてください: {archive_path}")
+            mode = 'w:xz' if name.endswith('.xz') else 'w:gz'
+            self._zip = None
+            self._tar = tarfile.open(archive_path, mode)
+        else:
+            raise ValueError(f"アーカイブの拡張子は .zip / .tar / .tar.gz / .tgz / .tar.xz のいずれかにしてください: {archive_path}")
+        super().__init__(archive_path.parent, max_pending)
+
+    def _store(self, member_path: str, text: str, encoding: str = 'utf-8'):
+        data = text.encode(encoding)
+        if self._zip is not None:
+            self._zip.writestr(member_path, data)
+        else:
+            info = tarfile.TarInfo(member_path)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self._tar.addfile(info, io.BytesIO(data))
+
+    def _write(self, sheet: RenderedSheet):
+        self._store(sheet.filename, sheet.html)
+        self.index.append({'連番': sheet.npc_id, '氏名': sheet.name, 'パス': sheet.filename})
+
+    def _finish(self):
+        try:
+            index_csv = pd.DataFrame(self.index, columns=['連番', '氏名', 'パス']).to_csv(index=False)
+            self._store(self.INDEX_NAME, index_csv, 'utf_8_sig')
+        finally:
+            (self._zip or self._tar).close()
+
+# 並列描画時にワーカープロセスごとに保持する描画器 (テンプレートのコンパイルは1回だけ)
+_worker_renderer: Optional[SheetRenderer] = None
+
+def _init_render_worker(renderer_args: tuple, profile: bool = False):
+    global _worker_renderer
+    _worker_renderer = SheetRenderer(*renderer_args)
+    PROFILER.reset()
+    PROFILER.enable(profile)
+
+def _render_chunk(renderer: SheetRenderer, tasks: List[tuple]) -> Tuple[List[tuple], float, Optional[Dict[str, bytes]]]:
+    """描画結果と、描画にかかった秒数、(ワーカーの場合は) 計測値を返す"""
+    start = time.perf_counter()
+    results = renderer.render_many(tasks)
+    return results, time.perf_counter() - start, None
+
+def _render_in_worker(tasks: List[tuple]) -> Tuple[List[tuple], float, Optional[Dict[str, bytes]]]:
+    results, seconds, _ = _render_chunk(_worker_renderer, tasks)
+    return results, seconds, PROFILER.drain() if PROFILER.enabled else None
+
+# =======================================================
+# 4. メイン実行関数
+# =======================================================
+
+def load_export_masters() -> tuple:
+    """
+    描画に使うマスタ (特技・流派・忍法) を読み込み、
+    (特技マスタデータ, 流派系列マップ, 忍法流派マップ, 忍法詳細マップ) を返す。
+    マスタが見つからない場合は FileNotFoundError。
+    """
+    df_skills_master = load_csv_safely(
+        ['特技.xlsx - 特技_マスタ.csv', '特技_マスタ.csv'], 
+        '特技マスタファイルが見つかりません。'
+    )
+    master_data = load_master_skills(df_skills_master)
+    df_school_master = load_csv_safely(
+        ['流派.xlsx - 流派_マスタ.csv', '流派_マスタ.csv'], 
+        '流派マスタファイルが見つかりません。'
+    )
+    df_ninpo_master = load_csv_safely(
+        ['忍法.xlsx - 忍法_マスタ.csv', '忍法_マスタ.csv'], 
+        '忍法マスタファイルが見つかりません。'
+    )
+    ninpo_school_map = load_master_ninpo(df_ninpo_master)
+    ninpo_detail_map = load_master_ninpo_details(df_ninpo_master)
+    return master_data, build_school_series_map(df_school_master), ninpo_school_map, ninpo_detail_map
+
+def _chunked(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """iterable を size 件ずつのリストにして順に返す (全体をリストにはしない)"""
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _imap_bounded(pool: Any, func: Any, items: Iterable[Any], max_pending: int) -> Iterator[Any]:
+    """
+    pool.imap と同じく順番どおりに結果を返すが、未完了のタスクを max_pending 個までに抑える。
+    (pool.imap は入力を先にすべて読み進めるため、逐次生成される入力ではメモリが増え続ける)
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def export_sheets(tasks: Iterable[tuple], masters: tuple, workers: int = 1, chunksize: int = 64,
+                  template_cache_dir: Optional[str] = TEMPLATE_CACHE_DIR,
+                  archive: Optional[str] = None, compress: bool = True,
+                  shared_css: bool = False, minify: bool = False, load_seconds: float = 0.0) -> int:
+    """
+    (基本データの行, records_for_character 形式の修得データ) を順に描画して書き出し、出力したシート数を返す。
+    tasks は逐次受け取るため、生成中の NPC をそのまま流し込める。
+    masters は load_export_masters の戻り値。その他の引数は export_html を参照。
+    """
+    start = time.perf_counter()
 
     # 2. Jinja2 環境のセットアップ
-    file_loader = FileSystemLoader('.') 
-    env = Environment(loader=file_loader)
+    renderer_args = masters + ('.', 'template.html', template_cache_dir, shared_css, minify)
     try:
-        template = env.get_template('template.html')
+        renderer = SheetRenderer(*renderer_args)
     except Exception:
         print(f"\n--- エラー: 'template.html' が見つかりません。前回の回答で提示した内容で作成してください。 ---")
-        return
+        return 0
 
-    # 出力フォルダが存在しない場合は作成
-    OUTPUT_DIR.mkdir(exist_ok=True)
+    # 出力先の準備 (フォルダが存在しない場合は作成)
+    if archive:
+        try:
+            writer = ArchiveSheetWriter(Path(archive), compress)
+        except (ValueError, OSError) as e:
+            print(f"\n--- エラー: アーカイブを作成できません: {e} ---")
+            return 0
+        output_location = f"**{writer.archive_path}** "
+    else:
+        OUTPUT_DIR.mkdir(exist_ok=True)
+        writer = SheetWriter(OUTPUT_DIR)
+        output_location = f"**{OUTPUT_DIR}/** フォルダ内"
+    if renderer.shared_css_text is not None:
+        writer.add_asset(SHARED_CSS_NAME, renderer.shared_css_text)
     
     # 3. HTMLファイルの生成
-    html_output_count = 0
+    chunks = _chunked(tasks, chunksize)
+
+    # 描画 (workers > 1 ならプロセスプール) と書き出し (別スレッド) を並行して進める
+    pool = multiprocessing.Pool(workers, initializer=_init_render_worker,
+                                initargs=(renderer_args, PROFILER.enabled)) if workers > 1 else None
+    try:
+        rendered_chunks = (
+            _imap_bounded(pool, _render_in_worker, chunks, workers * 2) if pool
+            else (_render_chunk(renderer, chunk) for chunk in chunks)
+        )
+        render_seconds = 0.0
+        raw_bytes = 0
+        for rendered, seconds, samples in rendered_chunks:
+            render_seconds += seconds
+            PROFILER.merge(samples)
+            for sheet in rendered:
+                if sheet.filename is None:
+                    print(sheet.html)
+                else:
+                    raw_bytes += sheet.raw_size
+                    writer.put(sheet)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        writer.close()
+    html_output_count = writer.count
+
+    print(f"\n--- HTML出力完了 ---")
+    print(f"✅ **HTMLファイル ({html_output_count}個)** の出力が完了しました。")
+    print(f"ファイルはすべて {output_location}に保存されました。")
+    # 並列時の描画時間はワーカーの合計 (CPU 時間に近い値)
+    print(f"⏱ 読み込み: {load_seconds * 1000:.1f}ms / テンプレート読み込み・コンパイル: {renderer.compile_seconds * 1000:.1f}ms"
+          f" / 描画: {render_seconds * 1000:.1f}ms / 全体: {(load_seconds + time.perf_counter() - start) * 1000:.1f}ms")
+    if shared_css or minify:
+        saved = raw_bytes - writer.bytes_written
+        ratio = saved / raw_bytes * 100 if raw_bytes else 0.0
+        print(f"📦 出力サイズ: {raw_bytes:,} → {writer.bytes_written:,} bytes"
+              f" ({saved:,} bytes / {ratio:.1f}% 削減、共有CSSを含む)")
+    return html_output_count
+
+def export_html(workers: int = 1, chunksize: int = 64, template_cache_dir: Optional[str] = TEMPLATE_CACHE_DIR,
+                archive: Optional[str] = None, compress: bool = True,
+                shared_css: bool = False, minify: bool = False, input_format: str = 'csv',
+                where: Optional[List[str]] = None):
+    """
+    生成済みのCSV (input_format='parquet' の場合は Parquet) からキャラクターシートのHTMLを出力する。
+    input_format='sqlite' の場合は SQLite 出力から1キャラクターずつ索引で読み、where の条件
+    ('列名 演算子 値' のリスト。例: ['階級=上忍']) で対象を絞り込める。全テーブルを pandas に読み込まない。
+    workers > 1 の場合は chunksize 人ずつプロセスプールで描画し、ファイルの書き出しは別スレッドで行う。
+    template_cache_dir はコンパイル済みテンプレートのキャッシュ置き場 (None でキャッシュを使わない)。
+    archive を指定すると、シートを1つずつのファイルではなくそのアーカイブ (zip / tar) にまとめる。
+    shared_css / minify を指定すると、共通CSSを1つのファイルに外出し / HTML を縮小し、削減したバイト数を表示する。
+    最後に 読み込み/コンパイル/描画 の所要時間を表示する。
+    """
+    start = time.perf_counter()
     
-    for _, row in df_base.iterrows():
+    # 1. 必要なCSVファイルと特技マスタの読み込み
+    conn: Optional[sqlite3.Connection] = None
+    try:
         try:
-            context = prepare_context(row, acquired_data, master_data, df_school_master, ninpo_school_map)
-            
-            output_html = template.render(context)
+            if input_format == 'sqlite':
+                conn = open_generated_database()
+                where_clause, where_params = build_where_clause(conn, where)
+            else:
+                df_base, acquired_data = load_generated_tables(input_format)
+            masters = load_export_masters()
             
-            npc_id = row['連番']
-            npc_name = str(row.get('氏名', f'名無し_{npc_id}')).strip()
-            
-            output_filename = OUTPUT_DIR / f"char_sheet_{npc_id}_{npc_name}.html"
-            with open(output_filename, 'w', encoding='utf-8') as f:
-                f.write(output_html)
-            html_output_count += 1
-            
-        except Exception as e:
-            # エラーの詳細（スタックトレース）を出力しないことで、視認性を高めます
-            print(f"HTML生成中にエラーが発生しました: 連番 {row.get('連番', '不明')}, エラー: {type(e).__name__}: {e}")
+        except (FileNotFoundError, ImportError, ValueError, sqlite3.Error) as e:
+            print(f"\n--- 致命的なエラーにより処理を中断しました ---")
+            print(e)
+            return
 
-    print(f"\n--- HTML出力完了 ---")
-    print(f"✅ **HTMLファイル ({html_output_count}個)** の出力が完了しました。")
-    print(f"ファイルはすべて **{OUTPUT_DIR}/** フォルダ内に保存されました。")
+        if PROFILER.enabled:
+            PROFILER.add('シート: 読み込み', int((time.perf_counter() - start) * 1e9))
+        if input_format == 'sqlite':
+            tasks = iter_database_tasks(conn, where_clause, where_params)
+        else:
+            # 修得データは 連番 ごとに1回だけまとめておく
+            grouped_records = group_acquired_records(acquired_data)
+            tasks = ((row, records_for_character(grouped_records, row.get('連番'))) for row in df_base.to_dict('records'))
+        try:
+            export_sheets(tasks, masters, workers=workers, chunksize=chunksize, template_cache_dir=template_cache_dir,
+                          archive=archive, compress=compress, shared_css=shared_css, minify=minify,
+                          load_seconds=time.perf_counter() - start)
+        except sqlite3.Error as e:
+            print(f"\n--- データベースの読み込み中にエラーが発生しました: {e} ---")
+    finally:
+        # マスタの読み込みに失敗した場合も含め、開いたデータベースは必ず閉じる
+        if conn is not None:
+            conn.close()
 
 
 if __name__ == '__main__':
@@ -285,4 +847,26 @@ if __name__ == '__main__':
         print("エラー: HTML出力には Jinja2 ライブラリが必要です。")
         print("コマンドプロンプトで『pip install Jinja2』を実行してインストールしてください。")
     else:
-        export_html()
\ No newline at end of file
+        parser = argparse.ArgumentParser(description='生成済みのCSVからキャラクターシートのHTMLを出力する')
+        parser.add_argument('--workers', type=int, default=1, help='描画に使うプロセス数 (既定: 1)')
+        parser.add_argument('--chunksize', type=int, default=64, help='ワーカーに渡す1回あたりの人数 (既定: 64)')
+        parser.add_argument('--no-template-cache', action='store_true', help='コンパイル済みテンプレートのキャッシュを使わない')
+        parser.add_argument('--archive', default=None, help='シートをまとめるアーカイブ (.zip / .tar / .tar.gz / .tgz / .tar.xz)')
+        parser.add_argument('--no-compress', action='store_true', help='アーカイブを圧縮しない (tar の場合は拡張子を .tar にする)')
+        parser.add_argument('--shared-css', action='store_true', help=f'共通の <style> を {SHARED_CSS_NAME} に外出しする')
+        parser.add_argument('--minify', action='store_true', help='シートの HTML の字下げ・改行を詰める')
+        parser.add_argument('--input-format', choices=['csv', 'parquet', 'sqlite'], default='csv', help='生成結果の形式 (既定: csv)')
+        parser.add_argument('--where', action='append', default=None, metavar='列名 演算子 値',
+                            help="SQLite 入力で出力対象を絞り込む条件。演算子は = != > >= < <= で、数値の値は数値として、"
+                                 "それ以外 (引用符で囲んだ値を含む) は文字列として比較する (SQL は書けない)。"
+                                 "複数指定すると AND (例: --where 階級=上忍 --where \"年齢>=30\")")
+        parser.add_argument('--profile', action='store_true', help='処理段階ごとの所要時間を計測して表示する')
+        parser.add_argument('--profile-json', default=None, help='計測結果を JSON Lines で追記するファイル (--profile を含む)')
+        args = parser.parse_args()
+        PROFILER.enable(args.profile or bool(args.profile_json))
+        export_html(workers=args.workers, chunksize=args.chunksize,
+                    template_cache_dir=None if args.no_template_cache else TEMPLATE_CACHE_DIR,
+                    archive=args.archive, compress=not args.no_compress,
+                    shared_css=args.shared_css, minify=args.minify, input_format=args.input_format,
+                    where=args.where)
+        report_profile(args.profile_json)
\ No newline at end of file
@@ -0,0 +1,151 @@
+import argparse
+import asyncio
+import json
+import math
+import time
+from typing import List, Dict, Any, Optional, Tuple
+from urllib.parse import urlencode
+
+from npc_service import SERVICE_HOST, SERVICE_PORT
+
+# =======================================================
+# 生成サービスの負荷試験
+# =======================================================
+# concurrency 本の keep-alive 接続から合計 requests 回リクエストを送り、
+# スループットとレイテンシ (p50 / p90 / p99 / 最大) を表示する。
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近傍順位法のパーセンタイル (sorted_values は昇順)"""
+    if not sorted_values:
+        return float('nan')
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+async def open_connection(host: str, port: int, unix_path: Optional[str]) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    if unix_path:
+        return await asyncio.open_unix_connection(unix_path)
+    return await asyncio.open_connection(host, port)
+
+async def send_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str,
+                       target: str, host: str, body: bytes = b'') -> Tuple[int, bytes]:
+    """リクエストを1回送り、(ステータス, 本文) を返す"""
+    headers = f"{method} {target} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n"
+    if body:
+        headers += "Content-Type: application/json\r\n"
+    writer.write(f"{headers}\r\n".encode('latin-1') + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        if key.strip().lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+async def run_client(requests: asyncio.Queue, latencies: List[float], errors: List[str],
+                     host: str, port: int, unix_path: Optional[str], method: str, target: str, body: bytes):
+    reader, writer = await open_connection(host, port, unix_path)
+    try:
+        while True:
+            try:
+                requests.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            try:
+                status, payload = await send_request(reader, writer, method, target, host, body)
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+                errors.append(f"{type(e).__name__}: {e}")
+                writer.close()
+                reader, writer = await open_connection(host, port, unix_path)
+                continue
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(f"{status}: {payload[:200].decode('utf-8', 'replace')}")
+    finally:
+        writer.close()
+
+async def run_load_test(host: str = SERVICE_HOST, port: int = SERVICE_PORT, unix_path: Optional[str] = None,
+                        requests: int = 200, concurrency: int = 8, path: str = '/npc',
+                        params: Optional[Dict[str, Any]] = None, warmup: int = 5) -> Dict[str, Any]:
+    """負荷試験を行い、結果 (件数・スループット・レイテンシ) を返す"""
+    params = params or {}
+    # /npcs は JSON 本文で、その他は GET のクエリで条件を渡す
+    if path == '/npcs':
+        method, target, body = 'POST', path, json.dumps(params, ensure_ascii=False).encode('utf-8')
+    else:
+        method, target, body = 'GET', f"{path}?{urlencode(params)}" if params else path, b''
+
+    if warmup > 0:
+        reader, writer = await open_connection(host, port, unix_path)
+        for _ in range(warmup):
+            await send_request(reader, writer, method, target, host, body)
+        writer.close()
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+    latencies: List[float] = []
+    errors: List[str] = []
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        run_client(queue, latencies, errors, host, port, unix_path, method, target, body)
+        for _ in range(max(1, concurrency))
+    ))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    count = int(params.get('count', 1)) if path == '/npcs' else 1
+    return {
+        'requests': len(latencies), 'errors': len(errors), 'first_errors': errors[:3], 'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed else float('nan'),
+        'npcs_per_second': len(latencies) * count / elapsed if elapsed else float('nan'),
+        'p50_ms': percentile(latencies, 50) * 1000, 'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000, 'max_ms': (latencies[-1] if latencies else float('nan')) * 1000,
+    }
+
+def print_report(result: Dict[str, Any]):
+    print(f"--- {result['requests']}リクエスト / {result['seconds']:.2f}秒 (エラー {result['errors']}件) ---")
+    print(f"スループット: {result['requests_per_second']:.1f} リクエスト/秒 ({result['npcs_per_second']:.1f} 人/秒)")
+    print(f"レイテンシ: p50 {result['p50_ms']:.2f}ms / p90 {result['p90_ms']:.2f}ms"
+          f" / p99 {result['p99_ms']:.2f}ms / 最大 {result['max_ms']:.2f}ms")
+    for error in result['first_errors']:
+        print(f"  エラー例: {error}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='NPC 生成サービス (npc_service.py) の負荷試験')
+    parser.add_argument('--host', default=SERVICE_HOST, help=f'サービスのアドレス (既定: {SERVICE_HOST})')
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help=f'サービスのポート (既定: {SERVICE_PORT})')
+    parser.add_argument('--unix', default=None, help='Unix ソケットで接続する')
+    parser.add_argument('--requests', type=int, default=200, help='リクエストの総数 (既定: 200)')
+    parser.add_argument('--concurrency', type=int, default=8, help='同時接続数 (既定: 8)')
+    parser.add_argument('--warmup', type=int, default=5, help='計測前に送るリクエスト数 (既定: 5)')
+    parser.add_argument('--path', choices=['/npc', '/npcs', '/sheet'], default='/npc', help='試験するエンドポイント (既定: /npc)')
+    parser.add_argument('--count', type=int, default=10, help='/npcs で1回に生成する人数 (既定: 10)')
+    parser.add_argument('--rank', default='中忍', help='階級 (既定: 中忍)')
+    parser.add_argument('--school', default=None, help='下位流派')
+    parser.add_argument('--kouseki', type=int, default=None, help='功績点')
+    parser.add_argument('--render', action='store_true', help='JSON にシートの HTML を含める')
+    args = parser.parse_args()
+
+    request_params: Dict[str, Any] = {'階級': args.rank}
+    if args.school:
+        request_params['下位流派'] = args.school
+    if args.kouseki is not None:
+        request_params['功績点'] = args.kouseki
+    if args.render:
+        request_params['render'] = 'true'
+    if args.path == '/npcs':
+        request_params['count'] = args.count
+    try:
+        report = asyncio.run(run_load_test(args.host, args.port, args.unix, args.requests, args.concurrency,
+                                           args.path, request_params, args.warmup))
+    except (ConnectionError, OSError) as e:
+        print(f"--- サービスに接続できません: {e} ---")
+        raise SystemExit(1)
+    print_report(report)
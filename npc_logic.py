@@ -1,9 +1,31 @@
 import pandas as pd
+import numpy as np
+import array
 import random
 import re
 import json
 import math 
-from typing import List, Dict, Any, Set, Optional
+import itertools
+import csv
+import collections
+import heapq
+import sqlite3
+import argparse
+import multiprocessing
+import gc
+import sys
+import pickle
+import hashlib
+import os
+import time
+from typing import List, Dict, Any, Set, Optional, Union, Iterable, Iterator
+
+from npc_profile import PROFILER, report_profile
+import npc_records
+from npc_records import (
+    BackgroundRestriction, CostRule, NinpoSpecialRule, SkillRule, BackgroundTable,
+    SkillRecord, NinpoRecord, BackgroundRecord, SchoolRecord,
+)
 
 # =======================================================
 # 1. 定数とルールの定義
@@ -42,8 +64,28 @@ NINGU_MASTER = [
     {'ID': 3, '名前': "遁甲符"}
 ]
 
+# 所属流派に関わらず通常修得の候補になる忍法の流派
+GENERIC_NINPO_SCHOOLS = ('汎用', '古流', '異種')
+SEKKIN_NINPO_NAME = '接近戦攻撃※'
+
+# マスタファイル: キー -> (Excelファイル名, シート名)。Excel が読めない場合は「シート名.csv」を読む
+MASTER_FILES = {
+    '背景': ('背景.xlsx', '背景_マスタ'),
+    '忍法': ('忍法.xlsx', '忍法_マスタ'),
+    '特技': ('特技.xlsx', '特技_マスタ'),
+    '流派': ('流派.xlsx', '流派_マスタ'),
+}
+# 前処理済みマスタのキャッシュ置き場。元ファイルかこのモジュール (と npc_records.py) の内容が変わると作り直す
+MASTER_CACHE_DIR = '.master_cache'
+
+# =======================================================
+# 2. マスタのレコード定義とルール文字列のコンパイル
+# =======================================================
+
+# 前処理済みマスタのキャッシュに入るため npc_records.py に置く (先頭で import している)
+
 # =======================================================
-# 2. NPC クラスの定義
+# 3. NPC クラスの定義
 # =======================================================
 
 class NPC:
@@ -59,6 +101,7 @@ class NPC:
         self.背景 = [] # 内部処理用 ({'種別': '長所', '名前': '名前', '功績点': 3})
         self.忍法 = []
         self.修得特技: Set[str] = set()
+        self.修得特技mask = 0 # 特技マスタ順のビットマスク (判定・抽選はこちらで行う)
         self.奥義 = []
         self.忍具 = {} 
         
@@ -78,85 +121,46 @@ class NPC:
         }
 
 # =======================================================
-# 3. NPCGenerator クラスの定義 (メインロジック)
+# 4. NPCGenerator クラスの定義 (メインロジック)
 # =======================================================
 
 class NPCGenerator:
     """NPCの生成ロジックとマスターデータ管理を行うクラス"""
 
-    def __init__(self):
-        self.master = self._load_master_data() 
-        self._initialize_master_data()
+    def __init__(self, cache_dir: Optional[str] = MASTER_CACHE_DIR):
+        """cache_dir に前処理済みマスタのキャッシュがあれば Excel を読まずに復元する (None でキャッシュ無効)"""
+        # 乱数生成器。complete_npc_data に rng を渡すと、その NPC の生成中だけ差し替える
+        self.rng: Any = random
+        start = time.perf_counter()
+        cache_path = self._master_cache_path(cache_dir) if cache_dir else None
+        self.loaded_from_cache = cache_path is not None and self._load_master_cache(cache_path)
+        if self.loaded_from_cache:
+            self._report_rule_parse_errors()
+        else:
+            self.master = self._load_master_data() 
+            self._initialize_master_data()
+            if cache_path is not None:
+                self._save_master_cache(cache_path)
+        self.master_load_seconds = time.perf_counter() - start
+        if PROFILER.enabled:
+            PROFILER.add('マスタ読み込み', int(self.master_load_seconds * 1e9))
         self.RANK_SLOTS = RANK_SLOTS
         self.RANK_BG_LIMITS = RANK_BG_LIMITS
 
     # ★ 修正1: 静的メソッドからインスタンスメソッドへ変更 (selfアクセスが必要なため)
-    def select_random_skill(self, required_skill_str: str) -> str:
+    def select_random_skill(self, required_skill: Union[str, SkillRule]) -> str:
         """
-        忍法マスタの指定特技欄の文字列に基づき、ランダムに1つの特技を選択する。
+        忍法マスタの指定特技に基づき、ランダムに1つの特技を選択する。
+        マスタの忍法はコンパイル済みの SkillRule を渡す (文字列はその場でコンパイルする)。
         """
-        # クラス変数にアクセス
-        all_skills = self.all_skills
-        skill_field_map = self.skill_field_map
-        rule = required_skill_str.strip()
-        
-        if pd.isna(required_skill_str) or required_skill_str.strip() in ['なし', '']:
-            return 'なし'
-
-        # --- 1. 分野指定の場合 (例: '分野:器術', '好きな妖術') ---
-        # '分野:' または '好きな' で始まり、末尾に「術」があるパターンを抽出
-        # 例: "分野:器術" -> "器術", "好きな妖術" -> "妖術"
-        match_field = re.search(r'(?:分野:|好きな)?(.+術)', rule)
-        
-        if match_field:
-            # `match_field.group(1)` には '器術' や '妖術' が入る
-            target_field = match_field.group(1).strip()
-            
-            # 指定分野に属する特技のリストを抽出
-            # skill_field_map (特技名:分野名) を使用してフィルタリング
-            field_skills = [skill for skill, field in skill_field_map.items() if field == target_field]
-            
-            if field_skills:
-                return random.choice(field_skills)
-            else:
-                # フィールド名が不正・該当特技なしの場合
-                return 'なし'
-
-        # ★ 修正: '自由'の場合はここでランダム特技を決定する
-        elif rule == '自由':
-            return random.choice(all_skills) if all_skills else 'なし'
-
-        # '可変'はルール文字列をそのまま返す (特技修得フェーズで処理)
-        elif rule == '可変':
-            return rule
-
-        # 3. 特定特技リストの場合 (例: '《針術》《隠蔽術》《異形化》')
-        # 《》を削除し、特技名を抽出
-        skills_list = [s.strip().replace('《', '').replace('》', '') for s in required_skill_str.split('》') if s.strip()]
-    
-        # 候補からランダムに1つ選択
-        if skills_list:
-            # 特技マスタに存在する特技のみから選ぶ（念のため）
-            valid_skills = [s for s in skills_list if s in skill_field_map]
-            if valid_skills:
-                return random.choice(valid_skills)
-            else:
-                return 'なし'
-            
-        return 'なし'
+        if not isinstance(required_skill, SkillRule):
+            required_skill = SkillRule.parse_designated(required_skill, self.field_skills, self.skill_bits)
+        return required_skill.choose(self.rng)
 
     def _load_master_data(self) -> Dict[str, pd.DataFrame]:
         """Excelファイルを読み込み、前処理を実行"""
-        # このメソッドは変更なし (省略)
-        file_sheet_map = {
-            '背景': ('背景.xlsx', '背景_マスタ'),
-            '忍法': ('忍法.xlsx', '忍法_マスタ'),
-            '特技': ('特技.xlsx', '特技_マスタ'),
-            '流派': ('流派.xlsx', '流派_マスタ'),
-        }
-        
         master_data = {}
-        for key, (file_name, sheet_name) in file_sheet_map.items():
+        for key, (file_name, sheet_name) in MASTER_FILES.items():
             try:
                 try:
                     master_data[key] = pd.read_excel(file_name, sheet_name=sheet_name)
@@ -168,12 +172,23 @@ class NPCGenerator:
         return master_data
     
     def _initialize_master_data(self):
-        """マスターデータの前処理と特殊データの準備 (変更なし)"""
+        """マスターデータの前処理と、生成処理で使うレコードの準備"""
         # 特技データ
         self.skill_field_map = self.master['特技'].set_index('名前')['分野'].to_dict()
         self.field_skills = self.master['特技'].groupby('分野')['名前'].apply(list).to_dict()
         self.all_skills = list(self.skill_field_map.keys())
-        self.general_schools = self.master['流派'][self.master['流派']['流派名'] != '汎用'].copy()
+        # 特技をビット番号に対応付け、分野ごとのマスクを用意する
+        self.skill_bits = {name: bit for bit, name in enumerate(self.all_skills)}
+        self.all_skills_mask = (1 << len(self.all_skills)) - 1
+        self.field_masks = {
+            field: sum(1 << self.skill_bits[name] for name in set(names))
+            for field, names in self.field_skills.items()
+        }
+        # 一括生成用: 分野ごとの真偽値行 (特技マスタ順)
+        self._field_rows = {
+            field: np.array([mask >> bit & 1 for bit in range(len(self.all_skills))], dtype=bool)
+            for field, mask in self.field_masks.items()
+        }
         
         # 忍法データ
         df_np = self.master['忍法'].copy()
@@ -186,10 +201,9 @@ class NPCGenerator:
 
         # 通常修得用の秘伝を除外
         df_np = df_np[df_np['種別'].astype(str).str.strip() != '秘伝'].copy()
-        sekkin_ninpo_data = df_np[df_np['名前'].astype(str).str.strip() == '接近戦攻撃※']
-        if sekkin_ninpo_data.empty: raise ValueError("忍法マスタに「接近戦攻撃※」が見つかりません。")
-        self.ninpo_sekkin = sekkin_ninpo_data.iloc[0].copy()
-        self.master['忍法'] = df_np[df_np['名前'].astype(str).str.strip() != '接近戦攻撃※'].copy()
+        if (df_np['名前'].astype(str).str.strip() == SEKKIN_NINPO_NAME).sum() == 0:
+            raise ValueError("忍法マスタに「接近戦攻撃※」が見つかりません。")
+        self.master['忍法'] = df_np[df_np['名前'].astype(str).str.strip() != SEKKIN_NINPO_NAME].copy()
         
         # 流派データ
         df_sc = self.master['流派'].copy()
@@ -214,8 +228,8 @@ class NPCGenerator:
              print("⚠️ 警告: 背景マスターに'コスト条件'カラムが見つかりません。コスト変動は無効化されます。")
              self.df_bg_master['コスト条件'] = 'なし' 
              
-        self.df_bg_chosho = self.df_bg_master[self.df_bg_master['種別'] == '長所'].copy()
-        self.df_bg_jakuten = self.df_bg_master[self.df_bg_master['種別'] == '弱点'].copy()
+        # --- 生成処理用のレコードへ変換 (以降の生成処理では DataFrame を参照しない) ---
+        self._build_master_records(self.all_ninpo_master, df_sc)
 
         # IDマッピング
         self.ninpo_id_map = self.master['忍法'].set_index('名前')['忍法ID'].to_dict()
@@ -228,110 +242,222 @@ class NPCGenerator:
         self.ougi_names = [o['名前'] for o in OUGIES_MASTER]
         self.ningu_names = [n['名前'] for n in NINGU_MASTER]
 
+    def _build_master_records(self, df_np_all: pd.DataFrame, df_sc: pd.DataFrame):
+        """4つのマスタを、空白除去済みの不変レコード (NamedTuple) の列に変換する"""
+        def text(value: Any, default: str = '') -> str:
+            return default if value is None or pd.isna(value) else str(value).strip()
+
+        # 特技
+        self.skill_records = tuple(
+            SkillRecord(rid, row.get('特技ID'), row['名前'], row['分野'])
+            for rid, row in enumerate(self.master['特技'].to_dict('records'))
+        )
+
+        # 指定特技/加入必須特技は同じ文字列を共有することが多いため、文字列単位でコンパイルする
+        designated_rules: Dict[str, SkillRule] = {}
+        def designated(rule_str: str) -> SkillRule:
+            if rule_str not in designated_rules:
+                designated_rules[rule_str] = SkillRule.parse_designated(rule_str, self.field_skills, self.skill_bits)
+            return designated_rules[rule_str]
+
+        # 忍法 (秘伝・接近戦攻撃※を含む全件。通常修得用は ninpo_regular で絞り込む)
+        ninpo_records = []
+        for rid, row in enumerate(df_np_all.to_dict('records')):
+            skill_rule = text(row['指定特技'], 'なし')
+            ninpo_records.append(NinpoRecord(
+                rid, row.get('忍法ID'), text(row['名前']), text(row.get('種別')), text(row.get('流派')),
+                text(row.get('階級制限')), skill_rule, text(row.get('タイプ'), 'その他'), designated(skill_rule),
+            ))
+        self.ninpo_records = tuple(ninpo_records)
+        self.ninpo_sekkin = next(
+            n for n in self.ninpo_records if n.kind != '秘伝' and n.name == SEKKIN_NINPO_NAME
+        )
+        self.ninpo_regular = tuple(
+            n for n in self.ninpo_records if n.kind != '秘伝' and n.name != SEKKIN_NINPO_NAME
+        )
+        self.ninpo_by_name: Dict[str, NinpoRecord] = {}
+        for n in self.ninpo_regular:
+            self.ninpo_by_name.setdefault(n.name, n)
+
+        # 忍法の索引 (値は rid の array)。種別/流派は忍法特例の '種別:X:n' / '流派:X:n' 用に秘伝も含める
+        self.ninpo_ids_by_name: Dict[str, array.array] = self._group_ninpo_ids(lambda n: n.name)
+        self.ninpo_ids_by_kind: Dict[str, array.array] = self._group_ninpo_ids(lambda n: n.kind)
+        self.ninpo_ids_by_school: Dict[str, array.array] = self._group_ninpo_ids(lambda n: n.school)
+        # (階級, 所属流派) ごとの通常修得候補は初回利用時に構築する
+        self._ninpo_candidate_index: Dict[tuple, array.array] = {}
+
+        # 流派
+        has_required = '加入必須特技' in df_sc.columns
+        school_records = []
+        for rid, row in enumerate(df_sc.to_dict('records')):
+            required_skill = text(row['加入必須特技'], 'なし') if has_required else 'なし'
+            school_records.append(SchoolRecord(
+                rid, row['流派名'], row.get('流派系列'), required_skill,
+                SkillRule.parse_required(required_skill, self.field_skills, self.skill_bits),
+            ))
+        self.school_records = tuple(school_records)
+        self.general_schools = [sc for sc in self.school_records if sc.name != '汎用']
+        self.school_required_skill: Dict[str, SkillRule] = {}
+        for sc in self.school_records:
+            self.school_required_skill.setdefault(sc.name, sc.required)
+        self._school_series_cache: Dict[str, Optional[SchoolRecord]] = {}
+
+        # 背景 (修得制限/コスト条件/忍法特例は読み込み時に一度だけコンパイルする)
+        self.rule_parse_errors: List[str] = []
+        has_ninpo_rule = '忍法特例' in self.df_bg_master.columns
+        bg_records = []
+        for rid, row in enumerate(self.df_bg_master.to_dict('records')):
+            bg_name = str(row['名前']).strip()
+            label = f"背景「{bg_name}」の"
+            bg_records.append(BackgroundRecord(
+                rid, row.get('背景ID', 0), bg_name, row['種別'], int(row['功績点']),
+                BackgroundRestriction.parse(row['修得制限'], self.rule_parse_errors, label),
+                CostRule.parse(row['コスト条件'], self.rule_parse_errors, label),
+                NinpoSpecialRule.parse(row['忍法特例']) if has_ninpo_rule else None,
+            ))
+        self._report_rule_parse_errors()
+        self.bg_records = tuple(bg_records)
+        self.bg_records_by_kind = {
+            kind: tuple(bg for bg in self.bg_records if bg.kind == kind) for kind in ['長所', '弱点']
+        }
+        # (背景名, NinpoSpecialRule) をマスタ順に保持
+        self.bg_ninpo_rules = [(bg.name, bg.ninpo_rule) for bg in self.bg_records if bg.ninpo_rule is not None]
+
+        # 背景候補表は (種別, 所属流派, 流派系列) ごとに初回利用時に構築してキャッシュする
+        self.bg_names = [bg.name for bg in self.bg_records]
+        self._bg_table_cache: Dict[tuple, BackgroundTable] = {}
+
+    def _group_ninpo_ids(self, key_func) -> Dict[str, array.array]:
+        index: Dict[str, list] = {}
+        for n in self.ninpo_records:
+            index.setdefault(key_func(n), []).append(n.rid)
+        return {key: array.array('q', rids) for key, rids in index.items()}
+
+    def _report_rule_parse_errors(self):
+        """コンパイルできなかった修得制限/コスト条件を一覧で警告する"""
+        if not self.rule_parse_errors:
+            return
+        print("\n🚨 【背景マスタ ルール解析 警告】 🚨")
+        print("以下のルール文字列は解釈できませんでした。書式を確認してください。\n")
+        for e in self.rule_parse_errors:
+            print(f" - {e}")
+        print("--------------------------------------\n")
+
+    # --- 前処理済みマスタのキャッシュ ---
+    @staticmethod
+    def _master_cache_path(cache_dir: str) -> Optional[str]:
+        """元のマスタファイルとこのモジュール・npc_records の内容のハッシュから、キャッシュファイルのパスを決める"""
+        digest = hashlib.sha256()
+        for module_file in (__file__, npc_records.__file__):
+            with open(module_file, 'rb') as f:
+                digest.update(f.read())
+        for file_name, sheet_name in MASTER_FILES.values():
+            source = file_name if os.path.exists(file_name) else f'{sheet_name}.csv'
+            if not os.path.exists(source):
+                # 元ファイルがなければキャッシュは使わず、通常の読み込みでエラーを出す
+                return None
+            digest.update(source.encode('utf-8'))
+            with open(source, 'rb') as f:
+                digest.update(f.read())
+        return os.path.join(cache_dir, f'master_{digest.hexdigest()[:16]}.pkl')
+
+    def _load_master_cache(self, cache_path: str) -> bool:
+        try:
+            with open(cache_path, 'rb') as f:
+                self.__dict__.update(pickle.load(f))
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"⚠️ 警告: マスタキャッシュ '{cache_path}' を読み込めないため作り直します: {e}")
+            return False
+        return True
 
-    # --- 背景の修得制限チェックメソッド (NOT構文の解析を修正) ---
-    def _check_background_restriction(self, npc: NPC, rule_str: str) -> bool:
-        rule = str(rule_str).strip()
-        if not rule or rule in ['汎用', 'なし', '－', 'nan']:
-            return True
-        
-        # 取得済みの背景の名前のセット
-        acquired_bg_names = {bg['名前'] for bg in npc.背景}
-        
-        # 条件を '+' で分割し、いずれかがTrueならOK (OR条件)
-        conditions = [r.strip('《》').strip('/').strip('(').strip(')') for r in rule.split('+')]
-        
-        # NPCの流派名と系列名を安全に取得・整形
-        npc_shuzoku = str(npc.所属流派).strip()
-        npc_series = str(npc.流派系列).strip() if npc.流派系列 else '' 
-        
-        for condition in conditions:
-            condition = condition.strip()
-            if not condition: continue
-
-            # A. HAVE: 条件チェック
-            if condition.startswith('HAVE:'):
-                required_name = condition[len('HAVE:'):].strip()
-                if required_name in acquired_bg_names:
-                    return True # OR条件: 一つ満たした
-                continue 
-
-            # B. NOT 条件チェック
-            is_not_condition = condition.startswith('NOT')
-            
-            if is_not_condition:
-                # 'NOT'の3文字を削除後、先頭のコロン':'と前後の空白を削除してチェックルールを取得
-                check_rule = condition[3:].lstrip(':').strip() 
-            else:
-                check_rule = condition
-            
-            if not check_rule: continue # ルール文字列が空になった場合はスキップ
+    def _save_master_cache(self, cache_path: str):
+        """前処理済みの状態を書き出す (同じ場所の古いキャッシュは削除する)"""
+        try:
+            cache_dir = os.path.dirname(cache_path)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.export_state())
+            os.replace(tmp_path, cache_path)
+            for name in os.listdir(cache_dir):
+                if name.startswith('master_') and name.endswith('.pkl') and os.path.join(cache_dir, name) != cache_path:
+                    os.remove(os.path.join(cache_dir, name))
+        except OSError as e:
+            print(f"⚠️ 警告: マスタキャッシュを保存できませんでした: {e}")
+
+    # --- ワーカープロセスへの受け渡し ---
+    def warm_caches(self):
+        """
+        マスタの流派ごとの背景候補表と、(階級, 流派) ごとの忍法候補を作っておく。
+        ワーカーに渡す前に呼び、ワーカーごとに同じ表を作り直さないようにする。
+        """
+        for school in self.school_records:
+            npc = NPC(0, '', '中忍', school.name, 0)
+            self._resolve_school_series(npc)
+            for kind in self.bg_records_by_kind:
+                self._get_background_table(kind, npc)
+            for rank in RANK_SLOTS:
+                self._get_ninpo_candidate_ids(rank, school.name)
+
+    # 生成処理では参照しない DataFrame と乱数生成器、読み込み情報は渡さない
+    _UNSHARED_STATE = ('master', 'all_ninpo_master', 'df_bg_master', 'rng', 'loaded_from_cache', 'master_load_seconds')
+
+    def export_state(self) -> bytes:
+        """前処理済みのマスタレコードと索引 (構築済みのキャッシュを含む) を1つのバイト列にまとめる"""
+        state = {key: value for key, value in self.__dict__.items() if key not in self._UNSHARED_STATE}
+        return pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_state(cls, buffer: Union[bytes, memoryview]) -> 'NPCGenerator':
+        """
+        export_state のバイト列から生成器を復元する。Excel の読み込みと前処理は行わない。
+        復元した生成器は master などの DataFrame を持たないため、整合性チェックは呼び出し元で行う。
+        """
+        generator = cls.__new__(cls)
+        generator.__dict__.update(pickle.loads(buffer))
+        generator.rng = random
+        return generator
 
-            # check_ruleとNPCの流派/系列を比較
-            is_match = check_rule == npc_shuzoku or check_rule == npc_series
-            
-            if is_not_condition:
-                if not is_match:
-                    # NOT [Rule] かつ NOT マッチ => 満たした
-                    return True
-            else:
-                if is_match:
-                    # [Rule] かつ マッチ => 満たした
-                    return True
-        
-        # どの条件も満たされなかった
-        return False
-        
-    # --- コスト条件を考慮した功績点計算メソッド (変更なし) ---
-    def _calculate_effective_cost(self, npc: NPC, base_cost: int, cost_rule_str: str) -> int:
-        # このメソッドは変更なし (省略)
-        rule = str(cost_rule_str).strip()
-        if not rule or rule in ['汎用', 'なし', '－', 'nan']:
-            return base_cost
-
-        # 1. '|' 区切りの条件/固定値形式 (長所: 固定値)
-        # 例: 麝香会総合病院|4 (所属していればコストは4)
-        if '|' in rule:
-            condition_str, value_str = rule.split('|', 1)
-            conditions = [s.strip('《》') for s in condition_str.split('+')]
-            
-            if any(c == npc.所属流派 or c == npc.流派系列 for c in conditions):
-                try:
-                    return int(value_str.strip())
-                except ValueError:
-                    pass 
-        
-        # 2. '/' 区切りの条件/半額形式 (長所: 半額)
-        # 例: 麝香会総合病院/ (所属していれば半額、端数切り上げ)
-        if '/' in rule:
-            parts = rule.split('/')
-            condition_str = parts[0]
-            
-            is_half_rule = len(parts) == 2 and parts[1].strip() == '' or \
-                            len(parts) > 1 and parts[1].strip().upper() in ['半額', '1/2', 'ハナガク/2']
-                            
-            if is_half_rule:
-                conditions = [s.strip('《》') for s in condition_str.split('+')]
-
-                if any(c == npc.所属流派 or c == npc.流派系列 for c in conditions):
-                    # ★ 端数切り上げ (ceil) を適用
-                    return math.ceil(base_cost / 2)
-        
-        # 3. 加算/減算形式 (弱点)
-        # 例: 御斎系列+1
-        match = re.match(r'^(.+?)([+-])(\d+)$', rule)
-        if match:
-            condition_str, operator, amount_str = match.groups()
-            amount = int(amount_str)
-            
-            conditions = [s.strip('《》') for s in condition_str.split('+')]
-            
-            if any(c == npc.所属流派 or c == npc.流派系列 for c in conditions):
-                return base_cost + (amount if operator == '+' else -amount)
+    # --- 背景の修得制限チェックメソッド (NOT構文の解析を修正) ---
+    # 修得制限は流派名/系列名を空白除去して比較する
+    @staticmethod
+    def _restriction_keys(npc: NPC) -> tuple:
+        return str(npc.所属流派).strip(), (str(npc.流派系列).strip() if npc.流派系列 else '')
+
+    def _check_background_restriction(self, npc: NPC, rule: Union[str, BackgroundRestriction]) -> bool:
+        # 文字列が渡された場合のみその場でコンパイルする (マスタ行はコンパイル済みを渡す)
+        if not isinstance(rule, BackgroundRestriction):
+            rule = BackgroundRestriction.parse(rule)
+        npc_shuzoku, npc_series = self._restriction_keys(npc)
+        return rule(npc_shuzoku, npc_series, {bg['名前'] for bg in npc.背景})
         
-        # どの条件にも合致しない場合は基本コスト
-        return base_cost
+    # --- コスト条件を考慮した功績点計算メソッド ---
+    def _calculate_effective_cost(self, npc: NPC, base_cost: int, cost_rule: Union[str, CostRule]) -> int:
+        if not isinstance(cost_rule, CostRule):
+            cost_rule = CostRule.parse(cost_rule)
+        return cost_rule(base_cost, npc.所属流派, npc.流派系列)
     
+    def _get_background_table(self, kind: str, npc: NPC) -> BackgroundTable:
+        """実効コストは流派と系列だけで決まるため、(種別, 所属流派, 流派系列) 単位でキャッシュする"""
+        key = (kind, npc.所属流派, npc.流派系列)
+        table = self._bg_table_cache.get(key)
+        if table is not None:
+            return table
+
+        npc_shuzoku, npc_series = self._restriction_keys(npc)
+        entries, overlay = [], []
+        for bg in self.bg_records_by_kind[kind]:
+            cost = bg.cost_rule(bg.cost, npc.所属流派, npc.流派系列)
+            if bg.restriction.allows_by_school(npc_shuzoku, npc_series):
+                entries.append((cost, bg.rid))
+            elif bg.restriction.have_names:
+                overlay.append((cost, bg.rid, bg.restriction.have_names))
+        table = BackgroundTable(entries, overlay, self.bg_names)
+        self._bg_table_cache[key] = table
+        return table
+
     def _determine_backgrounds(self, npc: NPC):
         # 1. 階級に基づいた上限を取得 (外部のRANK_BG_LIMITS定数を参照)
         limits = RANK_BG_LIMITS.get(npc.階級, {'chosho': 2, 'jakuten': 2})
@@ -348,32 +474,21 @@ class NPCGenerator:
             
             # 継続判定: 1つ増えるごとに継続率を25%下げる (0個:100%継続, 1個:75%継続, 2個:50%継続...)
             if current_jakuten_count > 0:
-                if random.random() < (current_jakuten_count * 0.25):
+                if self.rng.random() < (current_jakuten_count * 0.25):
                     break # 確率判定により、上限に達する前に終了
 
-            # 弱点候補の抽出
-            available_jakuten = self.df_bg_jakuten[
-                self.df_bg_jakuten.apply(
-                    lambda r: self._check_background_restriction(npc, str(r.get('修得制限', '汎用'))), 
-                    axis=1
-                )
-            ].copy()
-            
+            # 弱点候補から、修得制限を満たす未取得の弱点を1つ選ぶ
+            acquired_bg_names = {bg['名前'] for bg in npc.背景}
             acquired_jakuten_names = {bg['名前'] for bg in npc.背景 if bg['種別'] == '弱点'}
-            available_jakuten = available_jakuten[
-                ~available_jakuten['名前'].astype(str).str.strip().isin(acquired_jakuten_names)
-            ].copy()
-
-            if available_jakuten.empty:
+            chosen = self._get_background_table('弱点', npc).choose(None, acquired_jakuten_names, acquired_bg_names, self.rng)
+            if chosen is None:
                 break
             
-            chosen_jakuten_data = available_jakuten.sample(n=1).iloc[0]
-            final_cost = self._calculate_effective_cost(npc, chosen_jakuten_data['功績点'], str(chosen_jakuten_data.get('コスト条件', 'なし')))
-            
+            bg_rid, final_cost = chosen
             npc.功績点 += final_cost 
             
-            bg_name = chosen_jakuten_data['名前'].strip()
-            bg_id = chosen_jakuten_data.get('背景ID', 0)
+            bg_name = self.bg_records[bg_rid].name
+            bg_id = self.bg_records[bg_rid].id
 
             npc.背景.append({'種別': '弱点', '名前': bg_name, '功績点': -final_cost})
             
@@ -396,35 +511,20 @@ class NPCGenerator:
             
             # 継続判定: 弱点と同様に1つごとに継続率25%減少
             if current_chosho_count > 0:
-                if random.random() < (current_chosho_count * 0.25):
+                if self.rng.random() < (current_chosho_count * 0.25):
                     break
 
-            # コスト計算済みのコピーを作成
-            df_chosho_calc = self.df_bg_chosho.copy()
-            df_chosho_calc['EffectiveCost'] = df_chosho_calc.apply(
-                lambda r: self._calculate_effective_cost(npc, r['功績点'], str(r.get('コスト条件', 'なし'))),
-                axis=1
-            )
-
-            # 現在の功績点で買える、かつ未取得、かつ修得制限をパスするものに絞る
-            available_chosho = df_chosho_calc[
-                (df_chosho_calc['EffectiveCost'] <= npc.功績点) & 
-                (~df_chosho_calc['名前'].str.strip().isin({bg['名前'] for bg in npc.背景}))
-            ].copy()
-
-            available_chosho = available_chosho[
-                available_chosho.apply(lambda r: self._check_background_restriction(npc, str(r.get('修得制限', '汎用'))), axis=1)
-            ]
-
-            if available_chosho.empty:
+            # 現在の功績点で買える、かつ未取得、かつ修得制限をパスするものから1つ選ぶ
+            acquired_bg_names = {bg['名前'] for bg in npc.背景}
+            chosen = self._get_background_table('長所', npc).choose(npc.功績点, acquired_bg_names, acquired_bg_names, self.rng)
+            if chosen is None:
                 break
 
-            chosen_chosho_data = available_chosho.sample(n=1).iloc[0]
-            chosho_cost = chosen_chosho_data['EffectiveCost'] 
+            bg_rid, chosho_cost = chosen
             
             npc.功績点 -= chosho_cost
-            bg_name = chosen_chosho_data['名前'].strip()
-            bg_id = chosen_chosho_data.get('背景ID', 0)
+            bg_name = self.bg_records[bg_rid].name
+            bg_id = self.bg_records[bg_rid].id
 
             npc.背景.append({'種別': '長所', '名前': bg_name, '功績点': chosho_cost})
             
@@ -438,88 +538,75 @@ class NPCGenerator:
             })
             
     # --- 忍法決定ロジック ---
-    def _acquire_ninpo_by_rule(self, npc: NPC, rule: str):
-        rule = rule.strip()
-        if not rule or rule in ['なし', '－']: return
-
-        rule_info = re.match(r'(種別|流派):([^:]+):(\d+)', rule)
-        
-        if rule_info:
-            rule_type, value, count_str = rule_info.groups()
-            value = value.strip()
-            count = int(count_str)
-            
-            # ★★★ 修正2: 全ての忍法マスターデータから候補を絞り込む ★★★
-            candidates = self.all_ninpo_master.copy()
-            # ★★★ ここまで ★★★
-            
-            if rule_type == '種別':
-                candidates = candidates[candidates['種別'].astype(str).str.strip() == value]
-            elif rule_type == '流派':
-                candidates = candidates[candidates['流派'].astype(str).str.strip() == value]
+    def _acquire_ninpo_by_rule(self, npc: NPC, rule: Union[str, NinpoSpecialRule]):
+        if not isinstance(rule, NinpoSpecialRule):
+            rule = NinpoSpecialRule.parse(rule)
+        if rule is None: return
+
+        if rule.rule_type != '名前':
+            # ★★★ 修正2: 全ての忍法マスターデータ (秘伝を含む) の索引から候補を引く ★★★
+            index = self.ninpo_ids_by_kind if rule.rule_type == '種別' else self.ninpo_ids_by_school
+            excluded = self._acquired_ninpo_ids(npc)
+            candidates = [rid for rid in index.get(rule.value, ()) if rid not in excluded]
             
-            acquired_names = {n['名前'] for n in npc.忍法}
-            candidates = candidates[~candidates['名前'].astype(str).str.strip().isin(acquired_names)]
-            
-            if not candidates.empty:
-                chosen_ninpo_data = candidates.sample(n=min(count, len(candidates)), replace=False)
-                for _, ninpo_data in chosen_ninpo_data.iterrows():
-                    self._add_ninpo(npc, ninpo_data, is_overlimit=True)
+            if candidates:
+                for rid in self.rng.sample(candidates, min(rule.count, len(candidates))):
+                    self._add_ninpo(npc, self.ninpo_records[rid], is_overlimit=True)
         else:
-            ninpo_data = self.master['忍法'][self.master['忍法']['名前'].astype(str).str.strip() == rule.strip('《》')]
-            if not ninpo_data.empty:
-                self._add_ninpo(npc, ninpo_data.iloc[0], is_overlimit=True)
+            ninpo = self.ninpo_by_name.get(rule.value)
+            if ninpo is not None:
+                self._add_ninpo(npc, ninpo, is_overlimit=True)
 
     def _apply_ninpo_special_exceptions(self, npc: NPC):
-        # このメソッドは変更なし (省略)
         chosen_bg_names = {bg['名前'] for bg in npc.背景}
-        
-        chosen_bg_data = self.df_bg_master[
-            self.df_bg_master['名前'].astype(str).str.strip().isin(chosen_bg_names)
-        ].copy()
-        
-        for _, bg_row in chosen_bg_data.iterrows():
-            rule = bg_row.get('忍法特例')
-            if pd.notna(rule) and str(rule).strip() not in ['なし', '－']:
-                self._acquire_ninpo_by_rule(npc, str(rule))
+        # 忍法特例を持つ背景だけをマスタ順に保持しているので、取得済みのものを順に適用する
+        for bg_name, rule in self.bg_ninpo_rules:
+            if bg_name in chosen_bg_names:
+                self._acquire_ninpo_by_rule(npc, rule)
 
-    def _get_ninpo_candidates(self, npc: NPC) -> pd.DataFrame:
-        # このメソッドは変更なし (省略)
-        candidates = self.master['忍法'][
-            (self.master['忍法']['階級制限'].astype(str).str.strip().isin(['－', npc.階級]))
-        ].copy()
-        candidates = candidates[
-            (candidates['流派'].astype(str).str.strip() == npc.所属流派) | 
-            (candidates['流派'].astype(str).str.strip().isin(['汎用', '古流', '異種']))
-        ].copy()
-        acquired_names = {n['名前'] for n in npc.忍法}
-        candidates = candidates[~candidates['名前'].astype(str).str.strip().isin(acquired_names)]
-        return candidates
-
-    def _acquire_ninpo_from_candidates(self, npc: NPC, candidates: pd.DataFrame, count: int):
-        # このメソッドは変更なし (省略)
-        acquired_names = {n['名前'] for n in npc.忍法}
-        candidates = candidates[~candidates['名前'].astype(str).str.strip().isin(acquired_names)]
-        if candidates.empty: return
+    def _acquired_ninpo_ids(self, npc: NPC) -> Set[int]:
+        """取得済み忍法と同名の忍法の rid (同名の忍法は重複して取得しない)"""
+        return {rid for n in npc.忍法 for rid in self.ninpo_ids_by_name.get(n['名前'], ())}
+
+    def _get_ninpo_candidate_ids(self, rank: str, school: str) -> array.array:
+        """
+        階級制限と流派 (自流派/汎用/古流/異種) で絞った通常修得候補の rid。(階級, 所属流派) ごとにキャッシュする。
+        array に持ち、fork したワーカーが読んでも共有しているページを書き換えないようにする。
+        """
+        key = (rank, school)
+        candidate_ids = self._ninpo_candidate_index.get(key)
+        if candidate_ids is None:
+            candidate_ids = array.array('q', (
+                n.rid for n in self.ninpo_regular
+                if n.rank_limit in ('－', rank)
+                and (n.school == school or n.school in GENERIC_NINPO_SCHOOLS)
+            ))
+            self._ninpo_candidate_index[key] = candidate_ids
+        return candidate_ids
+
+    def _get_ninpo_candidates(self, npc: NPC) -> List[int]:
+        excluded = self._acquired_ninpo_ids(npc)
+        return [rid for rid in self._get_ninpo_candidate_ids(npc.階級, npc.所属流派) if rid not in excluded]
+
+    def _acquire_ninpo_from_candidates(self, npc: NPC, candidates: List[int], count: int):
+        excluded = self._acquired_ninpo_ids(npc)
+        candidates = [rid for rid in candidates if rid not in excluded]
+        if not candidates: return
         current_ninpo_count = len([n for n in npc.忍法 if n.get('枠消費なし') is not True and n.get('POST_PROCESS') is not True])
         ninpo_limit = RANK_SLOTS[npc.階級]['ninpo']
         actual_count = min(count, ninpo_limit - current_ninpo_count)
         if actual_count <= 0: return
-        chosen_ninpo_data = candidates.sample(n=actual_count, replace=False)
-        for _, ninpo_data in chosen_ninpo_data.iterrows():
-            self._add_ninpo(npc, ninpo_data, is_overlimit=False)
+        for rid in self.rng.sample(candidates, actual_count):
+            self._add_ninpo(npc, self.ninpo_records[rid], is_overlimit=False)
 
     # ★ 修正2: 忍法取得時に指定特技をランダム決定するロジックを追加
-    def _add_ninpo(self, npc: NPC, ninpo_data: pd.Series, is_overlimit: bool):
-        # マスタデータ上の指定特技ルール文字列を取得
-        required_skill_rule = ninpo_data['指定特技'].strip() if pd.notna(ninpo_data['指定特技']) else 'なし'
-        
-        # ★ ここで、ルールに基づき、実際に修得する特技名をランダムで決定する
-        designated_skill = self.select_random_skill(required_skill_rule)
+    def _add_ninpo(self, npc: NPC, ninpo: NinpoRecord, is_overlimit: bool):
+        # ★ マスタ上の指定特技ルールに基づき、実際に修得する特技名をランダムで決定する
+        designated_skill = self.select_random_skill(ninpo.designated)
 
-        ninpo_name = ninpo_data['名前'].strip()
-        ninpo_id = ninpo_data['忍法ID']
-        ninpo_type = ninpo_data['タイプ'].strip() if pd.notna(ninpo_data['タイプ']) else 'その他'
+        ninpo_name = ninpo.name
+        ninpo_id = ninpo.id
+        ninpo_type = ninpo.ninpo_type
         
         # 内部処理用
         npc.忍法.append({
@@ -536,7 +623,6 @@ class NPCGenerator:
         })
         
     def _determine_ninpo(self, npc: NPC):
-        # このメソッドは変更なし (省略)
         self._add_ninpo(npc, self.ninpo_sekkin, is_overlimit=True) 
         ninpo_limit = RANK_SLOTS[npc.階級]['ninpo']
         current_ninpo_count = len([n for n in npc.忍法 if n.get('枠消費なし') is not True and n.get('POST_PROCESS') is not True])
@@ -545,28 +631,23 @@ class NPCGenerator:
             candidate_ninpo = self._get_ninpo_candidates(npc)
             self._acquire_ninpo_from_candidates(npc, candidate_ninpo, remaining_slots)
 
-    # --- 特技決定ロジック（_parse_skill_acquisition_ruleは変更なし） ---
-    def _parse_skill_acquisition_rule(self, rule_str: str) -> List[str]:
-        # このメソッドは変更なし (省略)
-        if not rule_str or rule_str.strip() in ['－', 'なし', '可変', 'nan']: return []
-        clean_rule = rule_str.strip()
-        if clean_rule == '自由': return [random.choice(self.all_skills)]
-        if clean_rule.startswith('分野:'):
-            field_name = clean_rule.split(':')[1].strip()
-            if field_name in self.field_skills: return [random.choice(self.field_skills[field_name])]
+    # --- 特技決定ロジック ---
+    def _compile_required_skill(self, rule: Union[str, SkillRule]) -> SkillRule:
+        if isinstance(rule, SkillRule):
+            return rule
+        return SkillRule.parse_required(rule, self.field_skills, self.skill_bits)
+
+    def _parse_skill_acquisition_rule(self, rule: Union[str, SkillRule]) -> List[str]:
+        rule = self._compile_required_skill(rule)
+        if rule.kind == SkillRule.NONE or rule.kind == SkillRule.VARIABLE or not rule.candidates:
             return []
-        if '+' in clean_rule:
-            candidates = [s.strip('《》') for s in clean_rule.split('+') if s.strip('《》') in self.all_skills]
-            if not candidates: return []
-            return [random.choice(candidates)]
-        skills = re.findall(r'《(.*?)》', clean_rule)
-        if len(skills) > 1: return [random.choice(skills)]
-        elif len(skills) == 1: return skills
-        return []
-
-    # --- _acquire_skill, _get_remaining_skill_slots, _is_skill_condition_satisfied は変更なし (省略) ---
+        return [self.rng.choice(rule.candidates)]
+
+    # --- _acquire_skill, _get_remaining_skill_slots, _is_skill_condition_satisfied ---
     def _acquire_skill(self, npc: NPC, skill_name: str):
-        if skill_name and skill_name not in npc.修得特技 and skill_name in self.all_skills:
+        bit = self.skill_bits.get(skill_name) if skill_name else None
+        if bit is not None and not npc.修得特技mask >> bit & 1:
+            npc.修得特技mask |= 1 << bit
             npc.修得特技.add(skill_name)
             
             skill_id = self.skill_id_map.get(skill_name)
@@ -577,26 +658,30 @@ class NPCGenerator:
                     '特技名': skill_name
                 })
                 
+    def _skills_in_mask(self, mask: int) -> List[str]:
+        """ビットマスクに含まれる特技名を特技マスタ順に返す"""
+        skills = []
+        while mask:
+            low_bit = mask & -mask
+            skills.append(self.all_skills[low_bit.bit_length() - 1])
+            mask ^= low_bit
+        return skills
+
     def _get_remaining_skill_slots(self, npc: NPC) -> int:
         skill_limit = RANK_SLOTS[npc.階級]['skill']
-        return skill_limit - len(npc.修得特技)
-
-    def _is_skill_condition_satisfied(self, npc: NPC, required_rule: str) -> bool:
-        clean_rule = required_rule.strip()
-        if '分野:' in clean_rule:
-            field_name = clean_rule.split(':')[1].strip()
-            return any(self.skill_field_map.get(s) == field_name for s in npc.修得特技)
-        elif '+' in clean_rule:
-            candidates = [s.strip('《》') for s in clean_rule.split('+')]
-            return any(s in npc.修得特技 for s in candidates)
-        else:
-            required_skill = clean_rule.strip('《》')
-            return required_skill in npc.修得特技
+        return skill_limit - npc.修得特技mask.bit_count()
+
+    def _is_skill_condition_satisfied(self, npc: NPC, required_rule: Union[str, SkillRule]) -> bool:
+        return self._compile_required_skill(required_rule).is_satisfied(npc.修得特技mask)
 
     # --- 特技決定ロジック本体 ---
 
     def _determine_skills(self, npc: NPC):
-        # --- [準備] 残りスロット計算用の関数を内部で定義 ---
+        if not self._determine_fixed_skills(npc): return
+        self._determine_random_skills(npc)
+
+    def _determine_fixed_skills(self, npc: NPC) -> bool:
+        """STEP 1-2 (忍法指定特技・流派加入必須特技)。残り枠があれば True を返す"""
         def get_rem():
             return self._get_remaining_skill_slots(npc)
 
@@ -605,37 +690,36 @@ class NPCGenerator:
             skill = ninpo.get('指定特技')
             if skill and skill != 'なし' and skill != '任意':
                 self._acquire_skill(npc, skill)
-        if get_rem() <= 0: return
+        if get_rem() <= 0: return False
 
         # STEP 2: 流派加入必須特技の修得
-        school_data = self.master['流派'][self.master['流派']['流派名'] == npc.所属流派]
-        required_rule = school_data.iloc[0]['加入必須特技'] if not school_data.empty and '加入必須特技' in school_data.columns and pd.notna(school_data.iloc[0]['加入必須特技']) else 'なし'
+        required_rule = self.school_required_skill.get(npc.所属流派)
         
-        if required_rule and required_rule != 'なし':
+        if required_rule is not None and required_rule.kind != SkillRule.NONE:
             is_satisfied = self._is_skill_condition_satisfied(npc, required_rule)
             if not is_satisfied:
                 skills_to_acquire = self._parse_skill_acquisition_rule(required_rule)
                 if skills_to_acquire: 
                     self._acquire_skill(npc, skills_to_acquire[0])
-        if get_rem() <= 0: return
-
-        print(f"DEBUG: キャラ={npc.氏名}, 系列={npc.流派系列}, ターゲット分野={SCHOOL_SERIES_SKILL_MAP.get(npc.流派系列)}")
+        return get_rem() > 0
 
+    def _determine_random_skills(self, npc: NPC):
+        """STEP 3-4 (得意分野から2個、残り枠はランダム)"""
+        def get_rem():
+            return self._get_remaining_skill_slots(npc)
 
         # STEP 3: 流派系列の得意分野から「2個」修得
         # ★ 修正ポイント: npc.流派系列 が SCHOOL_SERIES_SKILL_MAP にあるか厳密にチェック
         target_field = SCHOOL_SERIES_SKILL_MAP.get(npc.流派系列)
         
         if target_field:
-            # フィールド名（'器術'など）に対応する全特技リストを取得
-            field_skills_list = self.field_skills.get(target_field, [])
-            # まだ持っていない特技を抽出
-            preferred_candidates = [s for s in field_skills_list if s not in npc.修得特技]
+            # フィールド名（'器術'など）のマスクから、まだ持っていない特技を抽出
+            preferred_candidates = self._skills_in_mask(self.field_masks.get(target_field, 0) & ~npc.修得特技mask)
             
             if preferred_candidates:
                 # 「2個」または「残りスロット」の少ない方を取得数にする
                 num_to_take = min(get_rem(), 2)
-                chosen = random.sample(preferred_candidates, min(num_to_take, len(preferred_candidates)))
+                chosen = self.rng.sample(preferred_candidates, min(num_to_take, len(preferred_candidates)))
                 for s in chosen:
                     self._acquire_skill(npc, s)
         
@@ -644,20 +728,20 @@ class NPCGenerator:
         # STEP 4: 残り枠をランダムな特技で埋める
         rem = get_rem()
         if rem > 0:
-            available_skills = [s for s in self.all_skills if s not in npc.修得特技]
+            available_skills = self._skills_in_mask(self.all_skills_mask & ~npc.修得特技mask)
             if available_skills:
-                chosen_random = random.sample(available_skills, min(rem, len(available_skills)))
+                chosen_random = self.rng.sample(available_skills, min(rem, len(available_skills)))
                 for s in chosen_random:
                     self._acquire_skill(npc, s)
     
     # --- 後処理、奥義、忍具決定ロジック ---
     def _apply_post_processing(self, npc: NPC):
         # このメソッドは変更なし (省略)
-        acquired_skill_list = list(npc.修得特技)
+        acquired_skill_list = self._skills_in_mask(npc.修得特技mask)
         if not acquired_skill_list: return
         sekkin_ninpo = next((n for n in npc.忍法 if n['名前'] == '接近戦攻撃※'), None)
         if sekkin_ninpo:
-            final_skill = random.choice(acquired_skill_list)
+            final_skill = self.rng.choice(acquired_skill_list)
             sekkin_ninpo['指定特技'] = final_skill
             for n in npc.忍法_list:
                 if n['忍法名'] == '接近戦攻撃※':
@@ -671,35 +755,41 @@ class NPCGenerator:
         ougi_count = 1
         if npc.階級 in ['上忍', '上忍頭']: ougi_count = 2
         
-        chosen_ougi_names = random.sample(self.ougi_names, ougi_count) 
+        chosen_ougi_names = self.rng.sample(self.ougi_names, ougi_count) 
         
-        acquired_skill_list = list(npc.修得特技)
+        # 集合の反復順はプロセスごとに変わるため、特技マスタ順のリストから選ぶ
+        acquired_skill_list = self._skills_in_mask(npc.修得特技mask)
         
         if not acquired_skill_list:
             ougi_skill = 'なし'
         else:
-            ougi_skill = random.choice(acquired_skill_list)
+            ougi_skill = self.rng.choice(acquired_skill_list)
             
         for ougi_name in chosen_ougi_names:
-            ougi_id = self.ougi_id_map.get(ougi_name)
-            
-            npc.奥義.append({'名前': ougi_name, '指定特技': ougi_skill})
-            
-            if ougi_id is not None:
-                npc.奥義_list.append({
-                    'キャラID': npc.連番,
-                    '奥義ID': ougi_id,
-                    '奥義名': ougi_name,
-                    '指定特技': ougi_skill
-                })
+            self._add_ougi(npc, ougi_name, ougi_skill)
+
+    def _add_ougi(self, npc: NPC, ougi_name: str, ougi_skill: str):
+        ougi_id = self.ougi_id_map.get(ougi_name)
+        
+        npc.奥義.append({'名前': ougi_name, '指定特技': ougi_skill})
+        
+        if ougi_id is not None:
+            npc.奥義_list.append({
+                'キャラID': npc.連番,
+                '奥義ID': ougi_id,
+                '奥義名': ougi_name,
+                '指定特技': ougi_skill
+            })
 
     def _determine_ningu(self, npc: NPC):
         # このメソッドは変更なし (省略)
         slots = 2
         for _ in range(slots):
-            chosen_ningu = random.choice(self.ningu_names)
+            chosen_ningu = self.rng.choice(self.ningu_names)
             npc.忍具[chosen_ningu] = npc.忍具.get(chosen_ningu, 0) + 1
-            
+        self._record_ningu(npc)
+
+    def _record_ningu(self, npc: NPC):
         for ningu_name, count in npc.忍具.items():
             ningu_id = self.ningu_id_map.get(ningu_name)
             if ningu_id is not None:
@@ -716,10 +806,8 @@ class NPCGenerator:
         """
         忍法マスタの指定特技が、特技マスタに存在するかチェックし、警告を出力する。
         """
-        ninpo_df = self.all_ninpo_master.copy() # 秘伝を含む全忍法マスタ
-
-        # '指定特技'カラムから特技のルール文字列を抽出
-        required_skill_rules = ninpo_df['指定特技'].astype(str).str.strip().unique()
+        # '指定特技'から特技のルール文字列を抽出 (秘伝を含む全忍法、出現順で重複除去)
+        required_skill_rules = list(dict.fromkeys(n.skill_rule for n in self.ninpo_records))
         
         # 自由、分野指定、なし、－などを除外
         rules_to_check = [
@@ -748,9 +836,7 @@ class NPCGenerator:
                 # 特技マスタに存在しないかチェック
                 if skill_name not in self.skill_field_map:
                     # その特技名を含む忍法を検索して警告メッセージを作成
-                    ninpos_with_error = ninpo_df[
-                        ninpo_df['指定特技'].astype(str).str.contains(skill_name.replace('(', r'\(').replace(')', r'\)'))
-                    ]['名前'].tolist()
+                    ninpos_with_error = [n.name for n in self.ninpo_records if skill_name in n.skill_rule]
 
                     warning_msg = (
                         f"特技マスタ未登録名: 「{skill_name}」. "
@@ -767,32 +853,65 @@ class NPCGenerator:
                 print(f" - {w}")
             print("--------------------------------------\n")
         
-    def complete_npc_data(self, npc: NPC) -> NPC:
-    # --- 1. 流派系列の確定 (検索を強化) ---
-    # 空白を削除し、部分一致でも探せるようにする
+    def _find_school_record(self, target_school: str) -> Optional[SchoolRecord]:
+        """流派名が一致、または流派名に target_school を含む最初の流派を返す (流派名ごとにキャッシュ)"""
+        if target_school not in self._school_series_cache:
+            self._school_series_cache[target_school] = next(
+                (sc for sc in self.school_records
+                 if isinstance(sc.name, str) and (target_school in sc.name or sc.name == target_school)),
+                None
+            )
+        return self._school_series_cache[target_school]
+
+    def _resolve_school_series(self, npc: NPC):
+        """流派系列の確定 (空白を削除し、部分一致でも探す)"""
         target_school = str(npc.所属流派).strip()
+        school = self._find_school_record(target_school)
     
-    # マスターデータから、流派名が含まれている行を探す
-        school_data = self.master['流派'][
-            self.master['流派']['流派名'].str.contains(target_school, na=False) | 
-           (self.master['流派']['流派名'] == target_school)
-        ]
-    
-        if not school_data.empty:
-          # 見つかったら最初の1件の系列を採用
-             npc.流派系列 = school_data.iloc[0]['流派系列']
+        if school is not None:
+            # 見つかったら最初の1件の系列を採用
+            npc.流派系列 = school.series
         else:
-        # それでも見つからない場合、下位流派かもしれないので「系列」という文字で推測するなどの処理
-        # もしくは、一旦デバッグで何を探そうとしたか出す
             print(f"⚠️ 警告: 流派 '{target_school}' がマスタに見つかりません")
             npc.流派系列 = '汎用'
 
-    # デバッグ文（Noneじゃないか確認用）
-        print(f"DEBUG: マスタにある流派リスト: {self.master['流派']['流派名'].tolist()[:5]}")
+    def complete_npc_data(self, npc: NPC, rng: Optional[random.Random] = None) -> NPC:
+        """
+        NPCの残りの情報を決定する。rng を渡すと、この NPC の抽選はすべてその乱数生成器から行う
+        (省略時は random モジュール)。
+        """
+        self.rng = rng if rng is not None else random
+        try:
+            return self._complete_npc_data(npc)
+        finally:
+            self.rng = random
+
+    # --profile 時に段階ごとに計測する処理 (_complete_npc_data と同じ順序)
+    _PROFILED_STAGES = (
+        ('生成: 流派系列', '_resolve_school_series'), ('生成: 階級コスト', '_pay_rank_up_cost'),
+        ('生成: 背景', '_determine_backgrounds'), ('生成: 特技', '_determine_skills'),
+        ('生成: 忍法', '_determine_ninpo'), ('生成: 奥義', '_determine_ougi'), ('生成: 忍具', '_determine_ningu'),
+    )
+
+    def _complete_npc_data_profiled(self, npc: NPC) -> NPC:
+        for stage, method_name in self._PROFILED_STAGES:
+            start = time.perf_counter_ns()
+            getattr(self, method_name)(npc)
+            PROFILER.add(stage, time.perf_counter_ns() - start)
+        return npc
+
+    def _pay_rank_up_cost(self, npc: NPC):
+        npc.功績点 -= RANK_POINTS.get(npc.階級, 0)
+
+    def _complete_npc_data(self, npc: NPC) -> NPC:
+        if PROFILER.enabled:
+            return self._complete_npc_data_profiled(npc)
+
+        # --- 1. 流派系列の確定 ---
+        self._resolve_school_series(npc)
 
         # --- ★ 階級上昇コストの先払い処理 ---
-        rank_up_cost = RANK_POINTS.get(npc.階級, 0)
-        npc.功績点 -= rank_up_cost
+        self._pay_rank_up_cost(npc)
 
         # --- ★ ここから下が抜けていたため、背景が決まっていませんでした ---
         
@@ -813,149 +932,766 @@ class NPCGenerator:
 
         # 最後に完成したnpcオブジェクトを返す
         return npc
+
+    # --- 一括生成 (名簿全体を列単位で処理する) ---
+    def generate_batch(self, characters: List[NPC], seed: Optional[int] = None) -> List[NPC]:
+        """
+        complete_npc_data と同じ手順を名簿全体に対して行う。
+        背景と固定特技は1体ずつ、特技 STEP 3/4・奥義・忍具の抽選は NumPy で全員分をまとめて行い、
+        忍法は (階級, 所属流派) ごとにまとめて共通の候補表から抽選する。
+        seed を指定すると同じ名簿からは同じ結果になる。
+        """
+        npcs = list(characters)
+        if not npcs:
+            return npcs
+        rng = np.random.default_rng(seed)
+        # 背景・固定特技・忍法の個別抽選は self.rng を使うため、同じシードから作った乱数生成器に差し替える
+        self.rng = random.Random(int(rng.integers(2**63)))
+        try:
+            return self._generate_batch(npcs, rng)
+        finally:
+            self.rng = random
+
+    def _generate_batch(self, npcs: List[NPC], rng: np.random.Generator) -> List[NPC]:
+        # 1-3. 流派系列・階級コスト・背景・固定特技 (STEP 1-2) は1体ずつ
+        for npc in npcs:
+            self._resolve_school_series(npc)
+            npc.功績点 -= RANK_POINTS.get(npc.階級, 0)
+            self._determine_backgrounds(npc)
+            self._determine_fixed_skills(npc)
+
+        # 3. 特技 STEP 3: 得意分野から「2個」(残り枠が少なければその数)
+        acquired = self._masks_to_matrix([npc.修得特技mask for npc in npcs])
+        skill_limits = np.array([RANK_SLOTS[npc.階級]['skill'] for npc in npcs])
+        field_matrix = np.zeros_like(acquired)
+        for row, npc in enumerate(npcs):
+            target_field = SCHOOL_SERIES_SKILL_MAP.get(npc.流派系列)
+            if target_field:
+                field_matrix[row] = self._field_rows.get(target_field, False)
+        remaining = np.maximum(skill_limits - acquired.sum(axis=1), 0)
+        self._acquire_sampled_skills(npcs, acquired, rng, field_matrix & ~acquired, np.minimum(remaining, 2))
+
+        # 3. 特技 STEP 4: 残り枠をランダムな特技で埋める
+        remaining = np.maximum(skill_limits - acquired.sum(axis=1), 0)
+        self._acquire_sampled_skills(npcs, acquired, rng, ~acquired, remaining)
+
+        # 4. 忍法: (階級, 所属流派) ごとに候補表を1回だけ引き、グループ単位で抽選する
+        groups: Dict[tuple, List[NPC]] = {}
+        for npc in npcs:
+            groups.setdefault((npc.階級, npc.所属流派), []).append(npc)
+        excluded = set(self.ninpo_ids_by_name.get(self.ninpo_sekkin.name, ()))
+        for (rank, school), members in groups.items():
+            candidate_ids = np.array([rid for rid in self._get_ninpo_candidate_ids(rank, school) if rid not in excluded])
+            count = min(RANK_SLOTS[rank]['ninpo'], len(candidate_ids))
+            if count > 0:
+                picks = candidate_ids[np.argsort(rng.random((len(members), len(candidate_ids))), axis=1)[:, :count]]
+            for row, npc in enumerate(members):
+                self._add_ninpo(npc, self.ninpo_sekkin, is_overlimit=True)
+                if count > 0:
+                    for rid in picks[row]:
+                        self._add_ninpo(npc, self.ninpo_records[int(rid)], is_overlimit=False)
+
+        # 5. 奥義: 上忍/上忍頭は2つ、それ以外は1つ。指定特技は修得特技から1つ
+        ougi_order = np.argsort(rng.random((len(npcs), len(self.ougi_names))), axis=1)
+        skill_keys = np.where(acquired, rng.random(acquired.shape), np.inf)
+        ougi_skill_cols = np.argmin(skill_keys, axis=1)
+        has_skill = acquired.any(axis=1)
+        for row, npc in enumerate(npcs):
+            ougi_count = 2 if npc.階級 in ['上忍', '上忍頭'] else 1
+            ougi_skill = self.all_skills[ougi_skill_cols[row]] if has_skill[row] else 'なし'
+            for col in ougi_order[row, :ougi_count]:
+                self._add_ougi(npc, self.ougi_names[col], ougi_skill)
+
+        # 6. 忍具: 2枠を重複ありで抽選
+        ningu_draws = rng.integers(0, len(self.ningu_names), size=(len(npcs), 2))
+        for row, npc in enumerate(npcs):
+            for col in ningu_draws[row]:
+                ningu_name = self.ningu_names[col]
+                npc.忍具[ningu_name] = npc.忍具.get(ningu_name, 0) + 1
+            self._record_ningu(npc)
+
+        return npcs
+
+    def _masks_to_matrix(self, masks: List[int]) -> np.ndarray:
+        """修得特技のビットマスク (特技数は64を超えうる) を (人数 x 特技数) の真偽値行列に展開する"""
+        n_skills = len(self.all_skills)
+        n_words = (n_skills + 63) // 64
+        word_mask = (1 << 64) - 1
+        packed = np.array(
+            [[(mask >> (64 * w)) & word_mask for w in range(n_words)] for mask in masks], dtype=np.uint64
+        ).reshape(len(masks), n_words)
+        bits = (packed[:, :, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+        return bits.reshape(len(masks), n_words * 64)[:, :n_skills].astype(bool)
+
+    def _acquire_sampled_skills(self, npcs: List[NPC], acquired: np.ndarray, rng: np.random.Generator,
+                                candidates: np.ndarray, counts: np.ndarray):
+        """各行の候補 (真偽値) から counts 個ずつ重複なしで抽選して修得し、acquired を更新する"""
+        counts = np.minimum(counts, candidates.sum(axis=1))
+        if not counts.any():
+            return
+        order = np.argsort(np.where(candidates, rng.random(candidates.shape), np.inf), axis=1)
+        for row in np.flatnonzero(counts):
+            cols = order[row, :counts[row]]
+            for col in cols:
+                self._acquire_skill(npcs[row], self.all_skills[col])
+            acquired[row, cols] = True
 # =======================================================
-# 4. 実行関数と実行ブロック
+# 5. 実行関数と実行ブロック
 # =======================================================
 
-def run_generation():
+# 名簿の行から NPC の初期化に使うカラム
+NPC_INPUT_COLUMNS = ('連番', '名前', '階級', '下位流派', '功績点')
+
+# 並列生成時にワーカープロセスごとに保持する生成器 (初期化は1回だけ)
+_worker_generator: Optional[NPCGenerator] = None
+# fork で起動するワーカーが引き継ぐ、親プロセスの構築済み生成器
+_inherited_generator: Optional[NPCGenerator] = None
+
+def npc_from_row(row: Dict[str, Any]) -> NPC:
+    """キャラクター名簿の1行から NPC オブジェクトを初期化する"""
+    # 必要なカラムの値を読み込み、クリーンアップ
+    npc_id = row['連番']
+    npc_name = str(row.get('名前', f'名無し_{npc_id}')).strip()
+    rank_str = str(row.get('階級', '中忍')).strip()
+    school_str = str(row.get('下位流派', '汎用')).strip()
+    # 功績点と連番は事前にクリーンアップされているため、安全に取得可能
+    kouseki_int = int(row.get('功績点', 0)) 
     
-    # --- 既存キャラクターファイル読み込み ---
-    try:
-        df_characters = pd.read_excel('キャラクター.xlsx', sheet_name='character')
-    except Exception:
+    if rank_str not in RANK_SLOTS:
+        rank_str = '中忍'
+    return NPC(npc_id, npc_name, rank_str, school_str, kouseki_int)
+
+def npc_rng(run_seed: int, char_id: Any) -> random.Random:
+    """(実行シード, 連番) から NPC ごとの乱数生成器を作る。ワーカー数や分割の仕方に関係なく同じ結果になる"""
+    return random.Random(f"{run_seed}:{char_id}")
+
+def generate_rows(generator: NPCGenerator, rows: List[Dict[str, Any]], run_seed: int) -> List[tuple]:
+    """名簿の行を順に生成し、(完成した NPC または None, エラーメッセージ または None) のリストを返す"""
+    results = []
+    for row in rows:
         try:
-            df_characters = pd.read_csv('キャラクター.csv', encoding='utf_8_sig')
+            npc = npc_from_row(row)
+            results.append((generator.complete_npc_data(npc, npc_rng(run_seed, npc.連番)), None))
         except Exception as e:
-            print(f"既存キャラクターファイルの読み込みエラー: {e}")
-            print("ファイル名が「キャラクター.xlsx」（シート名「character」）または「キャラクター.xlsx - character.csv」であることを確認してください。")
-            return
-
-    # ★★★ 修正箇所: NaN値の処理と確実な整数型への変換 ★★★
-    # 功績点と連番カラムの欠損値(NaN)を0で埋め、整数型(int)に変換します。
-    if '功績点' in df_characters.columns:
-        df_characters['功績点'] = pd.to_numeric(df_characters['功績点'], errors='coerce').fillna(0).astype(int)
-    if '連番' in df_characters.columns:
-        df_characters['連番'] = pd.to_numeric(df_characters['連番'], errors='coerce').fillna(0).astype(int)
-    # ★★★ 修正箇所: ここまで ★★★
+            results.append((None, f"致命的なエラー: 連番 {row.get('連番', '不明')} のNPC処理中にエラーが発生しました: {e}"))
+    return results
+
+class WorkerMasterState:
+    """
+    ワーカープロセスに前処理済みの生成器を渡す (context でプールを作り、initializer に initargs を渡す)。
+    渡す前に warm_caches で候補表を作っておく。
+    fork が使える環境では、ワーカーは親プロセスで構築済みの生成器をそのまま引き継ぐ。
+    マスタのレコードと索引はコピーオンライトで親プロセスと同じページを共有し、ワーカーでは何も復元しないため、
+    ワーカー数を増やしても1ワーカーあたりの使用メモリはほとんど増えない。
+    fork の前に gc.freeze() で既存のオブジェクトを循環 GC の対象から外し、GC の走査でページがコピーされないようにする。
+    fork が使えない環境 (Windows / macOS) では export_state のバイト列を initargs で渡し、各ワーカーで復元する。
+    """
+
+    def __init__(self, generator: NPCGenerator, profile: bool = False):
+        global _inherited_generator
+        generator.warm_caches()
+        self.forked = 'fork' in multiprocessing.get_all_start_methods() and sys.platform != 'darwin'
+        self.context = multiprocessing.get_context('fork' if self.forked else None)
+        if self.forked:
+            _inherited_generator = generator
+            gc.freeze()
+            self.initargs = (None, profile)
+        else:
+            self.initargs = (generator.export_state(), profile)
+
+    def close(self):
+        global _inherited_generator
+        if self.forked:
+            gc.unfreeze()
+            _inherited_generator = None
+
+    def __enter__(self) -> 'WorkerMasterState':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _init_generation_worker(state: Optional[bytes], profile: bool = False):
+    """state が None なら fork 元の生成器を引き継ぎ、それ以外は export_state のバイト列から復元する"""
+    global _worker_generator
+    _worker_generator = _inherited_generator if state is None else NPCGenerator.from_state(state)
+    PROFILER.reset()
+    PROFILER.enable(profile)
+
+def _generate_rows_in_worker(task: tuple) -> List[tuple]:
+    rows, run_seed = task
+    return generate_rows(_worker_generator, rows, run_seed)
+
+def _generate_rows_profiled_in_worker(task: tuple) -> tuple:
+    """生成結果と、このチャンクでの計測値 (PROFILER.drain) を返す"""
+    return _generate_rows_in_worker(task), PROFILER.drain()
+
+# 正規化テーブル: 種類 -> (NPC の出力用リストの属性名, 出力ファイル名, NPC 内で重複を除くIDカラム, カラム)
+OUTPUT_TABLES = {
+    '背景': ('背景_list', 'キャラ背景.csv', None, ['連番', '背景ID', '背景名', '種別', '功績点_変動']),
+    '忍法': ('忍法_list', 'キャラ忍法.csv', None, ['連番', '忍法ID', '忍法名', '指定特技']),
+    '特技': ('特技_list', 'キャラ特技.csv', '特技ID', ['連番', '特技ID', '特技名']),
+    '奥義': ('奥義_list', 'キャラ奥義.csv', None, ['連番', '奥義ID', '奥義名', '指定特技']),
+    '忍具': ('忍具_list', 'キャラ忍具.csv', '忍具ID', ['連番', '忍具ID', '忍具名', '個数']),
+}
+BASE_OUTPUT_FILE = 'generated_npcs_with_base_data.csv'
+# 出力形式 -> 拡張子 (ファイル名は OUTPUT_TABLES / BASE_OUTPUT_FILE の拡張子を置き換える)
+OUTPUT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'sqlite': '.sqlite'}
+# SQLite 出力ではすべてのテーブルを1つのデータベースにまとめる (テーブル名はファイル名から拡張子を除いたもの)
+SQLITE_OUTPUT_FILE = 'generated_npcs.sqlite'
+# 連番順に並べ替えるために書き出しを待たせておく NPC の最大数
+REORDER_BUFFER_ROWS = 10000
+# SQLite 出力で 連番 以外に索引を作るカラム
+SQLITE_INDEX_COLUMNS = {
+    '背景': ['背景ID', '背景名'], '忍法': ['忍法ID', '忍法名'], '特技': ['特技ID', '特技名'],
+    '奥義': ['奥義ID', '奥義名'], '忍具': ['忍具ID', '忍具名'], '結合': ['氏名', '階級', '下位流派'],
+}
+# Parquet 出力のカラム型: 'int64' / 'int32' は整数 (欠損は null)、'category' は辞書エンコードした文字列。
+# ここにない結合ファイルのカラム (名簿由来) は 'category' として出力する
+PARQUET_COLUMN_TYPES = {
+    '連番': 'int64', '功績点': 'int64', '最終功績点': 'int64',
+    '背景ID': 'int32', '忍法ID': 'int32', '特技ID': 'int32', '奥義ID': 'int32', '忍具ID': 'int32',
+    '功績点_変動': 'int32', '個数': 'int32',
+}
 
-    print(f"--- 既存キャラクター ({len(df_characters)}体) への情報付与開始 ---")
+def output_file_name(file_name: str, output_format: str = 'csv') -> str:
+    """出力形式に合わせてファイル名の拡張子を置き換える"""
+    return os.path.splitext(file_name)[0] + OUTPUT_FORMATS[output_format]
+
+def npc_output_records(npc: NPC) -> Dict[str, List[Dict[str, Any]]]:
+    """NPC の修得データを正規化テーブルの行にする (キャラID を 連番 に置き換え、特技/忍具は重複を除く)"""
+    records = {}
+    for kind, (attr, _, unique_col, _) in OUTPUT_TABLES.items():
+        rows = []
+        seen = set()
+        for item in getattr(npc, attr):
+            row = {('連番' if key == 'キャラID' else key): value for key, value in item.items()}
+            if unique_col is not None:
+                if row.get(unique_col) in seen:
+                    continue
+                seen.add(row.get(unique_col))
+            rows.append(row)
+        records[kind] = rows
+    return records
+
+def npc_base_row(npc: NPC, roster_row: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    名簿の行に生成結果を合わせた、結合ファイル (generated_npcs_with_base_data.csv) の1行を作る。
+    名簿の「功績点」は最終功績点で置き換え、名簿に「氏名」がある場合はそちらを残す。
+    """
+    row = {key: value for key, value in roster_row.items() if key != '功績点'}
+    calculated = npc.to_dict()
+    for key, value in calculated.items():
+        row.setdefault(key, value)
+    row['功績点'] = calculated['最終功績点']
+    return row
+
+def base_output_columns(roster_columns: Iterable[str]) -> List[str]:
+    """結合ファイルのカラム: 名簿のカラム (功績点を除く) + 氏名 (名簿にない場合) + 最終功績点 + 功績点"""
+    columns = [col for col in roster_columns if col != '功績点']
+    if '氏名' not in columns:
+        columns.append('氏名')
+    return columns + ['最終功績点', '功績点']
+
+class GenerationWriter:
+    """
+    完成した NPC を1体ずつ、5つの正規化テーブルと1つの結合テーブルに追記する (形式ごとのサブクラスで実装)。
+    名簿全体をメモリに溜めないため、名簿の大きさに関係なく使用メモリは一定。
+    出力は連番順 (同じ連番は名簿順) で、特技/忍具の重複は NPC ごとに除く。
+    連番順に並べるため、最大 reorder_buffer 体を連番をキーにしたヒープに溜め、あふれた分から小さい順に書き出す。
+    名簿の並びの乱れがこの範囲を超えると連番順にならないため、その件数を終了時に警告する。
+    """
+
+    output_format = 'csv'
+
+    def __init__(self, roster_columns: Iterable[str], output_dir: str = '.', reorder_buffer: int = REORDER_BUFFER_ROWS):
+        self.base_columns = base_output_columns(roster_columns)
+        self.count = 0
+        self.first_row: Optional[Dict[str, Any]] = None
+        self.reorder_buffer = max(0, reorder_buffer)
+        self._pending: List[tuple] = [] # (連番, 受け取った順, NPC, 名簿の行) のヒープ
+        self._received = 0
+        self._last_id: Any = None
+        self.out_of_order = 0 # バッファに収まらず連番順に書けなかった件数
+        # 種類 -> (出力先のパス, カラム)
+        self.targets = {
+            kind: (os.path.join(output_dir, output_file_name(file_name, self.output_format)), columns)
+            for kind, (_, file_name, _, columns) in OUTPUT_TABLES.items()
+        }
+        self.targets['結合'] = (os.path.join(output_dir, output_file_name(BASE_OUTPUT_FILE, self.output_format)), self.base_columns)
+
+    def _write_rows(self, kind: str, rows: List[Dict[str, Any]]):
+        raise NotImplementedError
+
+    def write(self, npc: NPC, roster_row: Dict[str, Any]):
+        """NPC を並べ替えバッファに入れ、あふれた分を連番の小さい順に書き出す"""
+        heapq.heappush(self._pending, (npc.連番, self._received, npc, roster_row))
+        self._received += 1
+        if len(self._pending) > self.reorder_buffer:
+            self._write_npc(*heapq.heappop(self._pending)[2:])
+
+    def flush_reorder_buffer(self):
+        """並べ替えバッファに残っている NPC をすべて連番順に書き出す"""
+        while self._pending:
+            self._write_npc(*heapq.heappop(self._pending)[2:])
+        if self.out_of_order:
+            print(f"⚠️ 警告: {self.out_of_order}体は名簿の並びの乱れが並べ替えバッファ ({self.reorder_buffer}体) を超えたため、"
+                  f"連番順に出力できませんでした (--reorder-buffer を大きくしてください)")
+            self.out_of_order = 0
+
+    def _write_npc(self, npc: NPC, roster_row: Dict[str, Any]):
+        if self._last_id is not None and npc.連番 < self._last_id:
+            self.out_of_order += 1
+        else:
+            self._last_id = npc.連番
+        if PROFILER.enabled:
+            start = time.perf_counter_ns()
+        for kind, rows in npc_output_records(npc).items():
+            self._write_rows(kind, rows)
+        base_row = npc_base_row(npc, roster_row)
+        self._write_rows('結合', [base_row])
+        if self.first_row is None:
+            self.first_row = base_row
+        self.count += 1
+        if PROFILER.enabled:
+            PROFILER.add(f'出力: {self.output_format} 書き込み', time.perf_counter_ns() - start)
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> 'GenerationWriter':
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            self.flush_reorder_buffer()
+        finally:
+            if PROFILER.enabled:
+                start = time.perf_counter_ns()
+            self.close()
+            if PROFILER.enabled:
+                PROFILER.add(f'出力: {self.output_format} 終了処理', time.perf_counter_ns() - start)
+
+class GenerationCsvWriter(GenerationWriter):
+    """UTF-8 (BOM 付き) の CSV に1行ずつ追記する"""
+
+    def __init__(self, roster_columns: Iterable[str], output_dir: str = '.', reorder_buffer: int = REORDER_BUFFER_ROWS):
+        super().__init__(roster_columns, output_dir, reorder_buffer)
+        self._files = []
+        self._writers: Dict[str, Any] = {}
+        try:
+            for kind, (path, columns) in self.targets.items():
+                # pandas の to_csv と同じ書式 (BOM 付き UTF-8、OS の改行コード)
+                f = open(path, 'w', encoding='utf_8_sig', newline='')
+                self._files.append(f)
+                writer = csv.writer(f, lineterminator=os.linesep)
+                writer.writerow(columns)
+                self._writers[kind] = writer
+        except OSError:
+            self.close()
+            raise
+
+    @staticmethod
+    def _format(value: Any) -> Any:
+        # 欠損値は pandas と同じく空欄にする
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return ''
+        return value
+
+    def _write_rows(self, kind: str, rows: List[Dict[str, Any]]):
+        columns = self.targets[kind][1]
+        self._writers[kind].writerows([[self._format(row.get(col)) for col in columns] for row in rows])
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
+
+class GenerationParquetWriter(GenerationWriter):
+    """
+    Parquet に batch_rows 行ずつ (1行グループずつ) 追記する。
+    ID や点数は整数、名前などの文字列は辞書エンコード (pandas では category) で保存する。
+    pyarrow が必要。
+    """
+
+    output_format = 'parquet'
+
+    def __init__(self, roster_columns: Iterable[str], output_dir: str = '.', batch_rows: int = 50000,
+                 reorder_buffer: int = REORDER_BUFFER_ROWS):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet 出力には pyarrow ライブラリが必要です。『pip install pyarrow』を実行してインストールしてください。")
+        super().__init__(roster_columns, output_dir, reorder_buffer)
+        self._pa = pa
+        self.batch_rows = batch_rows
+        self._buffers: Dict[str, List[Dict[str, Any]]] = {kind: [] for kind in self.targets}
+        self._writers: Dict[str, Any] = {}
+        self._schemas: Dict[str, Any] = {}
+        try:
+            for kind, (path, columns) in self.targets.items():
+                schema = pa.schema([(col, self._arrow_type(col)) for col in columns])
+                self._schemas[kind] = schema
+                self._writers[kind] = pq.ParquetWriter(path, schema)
+        except Exception:
+            self.close()
+            raise
+
+    def _arrow_type(self, column: str) -> Any:
+        kind = PARQUET_COLUMN_TYPES.get(column, 'category')
+        if kind == 'category':
+            return self._pa.dictionary(self._pa.int32(), self._pa.string())
+        return getattr(self._pa, kind)()
+
+    @staticmethod
+    def _convert(value: Any, is_int: bool) -> Any:
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return None
+        if is_int:
+            return value if type(value) is int else clean_roster_int(value)
+        return value if type(value) is str else str(value)
+
+    def _write_rows(self, kind: str, rows: List[Dict[str, Any]]):
+        buffer = self._buffers[kind]
+        buffer.extend(rows)
+        if len(buffer) >= self.batch_rows:
+            self._flush(kind)
+
+    def _flush(self, kind: str):
+        buffer = self._buffers[kind]
+        if not buffer:
+            return
+        schema = self._schemas[kind]
+        arrays = []
+        for field in schema:
+            is_int = not self._pa.types.is_dictionary(field.type)
+            arrays.append(self._pa.array([self._convert(row.get(field.name), is_int) for row in buffer], type=field.type))
+        self._writers[kind].write_table(self._pa.Table.from_arrays(arrays, schema=schema))
+        buffer.clear()
+
+    def close(self):
+        try:
+            for kind in list(self._writers):
+                self._flush(kind)
+        finally:
+            for writer in self._writers.values():
+                writer.close()
+            self._writers = {}
+
+class GenerationSqliteWriter(GenerationWriter):
+    """
+    1つの SQLite データベース (SQLITE_OUTPUT_FILE) の6つのテーブルに batch_rows 行ずつまとめて挿入する。
+    既存の同名テーブルは作り直す。索引 (連番と名前/IDカラム) は挿入がすべて終わってから作る。
+    """
+
+    output_format = 'sqlite'
+
+    def __init__(self, roster_columns: Iterable[str], output_dir: str = '.', batch_rows: int = 10000,
+                 reorder_buffer: int = REORDER_BUFFER_ROWS):
+        super().__init__(roster_columns, output_dir, reorder_buffer)
+        self.path = os.path.join(output_dir, SQLITE_OUTPUT_FILE)
+        self.batch_rows = batch_rows
+        self._buffers: Dict[str, List[tuple]] = {kind: [] for kind in self.targets}
+        self._pending_rows = 0
+        self._conn = sqlite3.connect(self.path)
+        try:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._inserts = {}
+            with self._conn:
+                for kind, (path, columns) in self.targets.items():
+                    table = self.table_name(kind)
+                    column_defs = ', '.join(
+                        f'"{col}" INTEGER' if col in PARQUET_COLUMN_TYPES else f'"{col}" TEXT' for col in columns
+                    )
+                    self._conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+                    self._conn.execute(f'CREATE TABLE "{table}" ({column_defs})')
+                    placeholders = ', '.join('?' for _ in columns)
+                    self._inserts[kind] = f'INSERT INTO "{table}" VALUES ({placeholders})'
+        except Exception:
+            self._conn.close()
+            raise
+
+    @staticmethod
+    def table_name(kind: str) -> str:
+        file_name = BASE_OUTPUT_FILE if kind == '結合' else OUTPUT_TABLES[kind][1]
+        return os.path.splitext(file_name)[0]
+
+    @staticmethod
+    def _convert(value: Any) -> Any:
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return None
+        return value if isinstance(value, (int, float, str)) else str(value)
+
+    def _write_rows(self, kind: str, rows: List[Dict[str, Any]]):
+        columns = self.targets[kind][1]
+        self._buffers[kind].extend(tuple(self._convert(row.get(col)) for col in columns) for row in rows)
+        self._pending_rows += len(rows)
+        if self._pending_rows >= self.batch_rows:
+            self._flush()
+
+    def _flush(self):
+        """たまった行を1つのトランザクションで挿入する"""
+        with self._conn:
+            for kind, buffer in self._buffers.items():
+                if buffer:
+                    self._conn.executemany(self._inserts[kind], buffer)
+                    buffer.clear()
+        self._pending_rows = 0
+
+    def _create_indexes(self):
+        with self._conn:
+            for kind in self.targets:
+                table = self.table_name(kind)
+                for col in ['連番'] + SQLITE_INDEX_COLUMNS.get(kind, []):
+                    if col in self.targets[kind][1]:
+                        self._conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table}_{col}" ON "{table}" ("{col}")')
+
+    def close(self):
+        if self._conn is None:
+            return
+        try:
+            self._flush()
+            self._create_indexes()
+        finally:
+            self._conn.close()
+            self._conn = None
+
+def open_generation_writer(roster_columns: Iterable[str], output_format: str = 'csv', output_dir: str = '.',
+                           reorder_buffer: int = REORDER_BUFFER_ROWS) -> GenerationWriter:
+    """出力形式 ('csv' / 'parquet' / 'sqlite') に応じた書き出し先を開く"""
+    if output_format == 'parquet':
+        return GenerationParquetWriter(roster_columns, output_dir, reorder_buffer=reorder_buffer)
+    if output_format == 'sqlite':
+        return GenerationSqliteWriter(roster_columns, output_dir, reorder_buffer=reorder_buffer)
+    return GenerationCsvWriter(roster_columns, output_dir, reorder_buffer)
+
+def print_generation_summary(first_row: Optional[Dict[str, Any]], output_format: str = 'csv'):
+    """出力したファイルの一覧と、先頭のNPCの抜粋を表示する"""
+    def name(file_name: str) -> str:
+        if output_format == 'sqlite':
+            return os.path.splitext(file_name)[0]
+        return output_file_name(file_name, output_format)
+    print(f"\n--- 完了 ---")
+    if output_format == 'sqlite':
+        print(f"{SQLITE_OUTPUT_FILE} に以下の**5つの正規化されたテーブル**と1つの結合テーブルを出力しました：")
+    else:
+        print(f"以下の**5つの正規化されたファイル**と1つの結合ファイルを出力しました：")
+    print(f"- {name('キャラ背景.csv')} (連番、背景ID、背景名)")
+    print(f"- {name('キャラ忍法.csv')} (連番、忍法ID、忍法名、指定特技)")
+    print(f"- {name('キャラ特技.csv')} (連番、特技ID、特技名)")
+    print(f"- {name('キャラ奥義.csv')} (連番、奥義ID、奥義名、指定特技)")
+    print(f"- {name('キャラ忍具.csv')} (連番、忍具ID、忍具名、個数)")
+    print(f"- {name(BASE_OUTPUT_FILE)} (元のデータ + 最終功績点)")
+    
+    if first_row is not None:
+        print("\n--- サンプルNPCの決定データ (抜粋) ---")
+        df_sample = pd.DataFrame([first_row])
+        print(df_sample[[col for col in ['連番', '氏名', '階級', '功績点', '最終功績点'] if col in df_sample.columns]].to_markdown(index=False))
+
+# キャラクター名簿: Excel (ファイル名, シート名) と、Excel が読めない場合の CSV
+ROSTER_XLSX = ('キャラクター.xlsx', 'character')
+ROSTER_CSV = 'キャラクター.csv'
+# 欠損値・非数値を 0 にして整数にするカラム
+ROSTER_INT_COLUMNS = ('功績点', '連番')
+
+def clean_roster_int(value: Any) -> int:
+    """pd.to_numeric(errors='coerce').fillna(0).astype(int) と同じ変換を1つの値に行う"""
+    number = pd.to_numeric(value, errors='coerce')
+    return 0 if pd.isna(number) else int(number)
+
+class RosterReader:
+    """
+    キャラクター名簿を少しずつ読み込み、1行ずつ辞書で返す (名簿全体をメモリに載せない)。
+    xlsx は openpyxl の read_only モードで1行ずつ、CSV は chunksize 行ずつ読む。
+    功績点と連番は欠損値・非数値を 0 にして整数に変換する。CSV のその他の値は文字列のまま返す。
+    """
+
+    def __init__(self, chunksize: int = 10000):
+        self.chunksize = chunksize
+        self.count = 0
+        try:
+            self.source, self.columns, self._rows = self._open_xlsx()
+        except Exception:
+            # Excelファイルの読み込みに失敗した場合、CSVファイルを試す
+            self.source, self.columns, self._rows = self._open_csv()
+
+    def _open_xlsx(self) -> tuple:
+        import openpyxl
+        file_name, sheet_name = ROSTER_XLSX
+        workbook = openpyxl.load_workbook(file_name, read_only=True, data_only=True)
+        try:
+            rows = workbook[sheet_name].iter_rows(values_only=True)
+            header = next(rows)
+        except Exception:
+            workbook.close()
+            raise
+        # 見出しが空欄のカラムは pandas と同じ名前にする
+        columns = [f'Unnamed: {i}' if name is None else str(name) for i, name in enumerate(header)]
+
+        def iter_rows() -> Iterator[Dict[str, Any]]:
+            try:
+                for values in rows:
+                    # read_only モードでは末尾の空行も返るため読み飛ばす
+                    if all(value is None for value in values):
+                        continue
+                    yield dict(zip(columns, values))
+            finally:
+                workbook.close()
+        return file_name, columns, iter_rows()
+
+    def _open_csv(self) -> tuple:
+        columns = list(pd.read_csv(ROSTER_CSV, encoding='utf_8_sig', nrows=0).columns)
+
+        def iter_rows() -> Iterator[Dict[str, Any]]:
+            # 型はチャンクごとに推定されて揺れるため、すべて文字列のまま読む
+            with pd.read_csv(ROSTER_CSV, encoding='utf_8_sig', dtype=object, chunksize=self.chunksize) as reader:
+                for chunk in reader:
+                    yield from chunk.to_dict('records')
+        return ROSTER_CSV, columns, iter_rows()
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for row in self._rows:
+            # ★★★ 修正箇所: NaN値の処理と確実な整数型への変換 ★★★
+            for col in ROSTER_INT_COLUMNS:
+                if col in row:
+                    row[col] = clean_roster_int(row[col])
+            self.count += 1
+            yield row
+
+def open_roster(chunksize: int = 10000) -> Optional[RosterReader]:
+    """キャラクター名簿を開く (読み込めない場合はエラーを表示して None)"""
+    try:
+        return RosterReader(chunksize)
+    except Exception as e:
+        print(f"既存キャラクターファイルの読み込みエラー: {e}")
+        print("ファイル名が「キャラクター.xlsx」（シート名「character」）または「キャラクター.xlsx - character.csv」であることを確認してください。")
+        return None
 
+def create_generator(cache_dir: Optional[str] = MASTER_CACHE_DIR) -> Optional[NPCGenerator]:
+    """生成器を初期化し、マスタの整合性をチェックする (マスタを読み込めない場合は None)"""
     # データ補完ロジッククラスを初期化
     try:
-        generator = NPCGenerator()
+        generator = NPCGenerator(cache_dir=cache_dir)
     except Exception as e:
         print(f"マスターデータ読み込みエラーにより処理を中断しました: {e}")
-        return
+        return None
     
+    print(f"マスタ読み込み: {generator.master_load_seconds * 1000:.1f}ms"
+          f" ({'キャッシュ使用' if generator.loaded_from_cache else 'マスタファイルから作成'})")
+
     # ★★★ 修正箇所: 整合性チェックの実行 ★★★
     generator._check_master_data_consistency() 
     # ★★★ ここまで ★★★
-        
-    # --- 出力用リスト ---
-    all_combined_data: List[Dict[str, Any]] = []
-    all_bg_data: List[Dict[str, Any]] = []
-    all_ninpo_data: List[Dict[str, Any]] = []
-    all_skill_data: List[Dict[str, Any]] = []
-    all_ougi_data: List[Dict[str, Any]] = []
-    all_ningu_data: List[Dict[str, Any]] = []
-    
-    # 既存のデータを使ってNPCオブジェクトを初期化し、残りの情報を付与
-    for index, row in df_characters.iterrows():
-        try:
-            # 必要なカラムの値を読み込み、クリーンアップ
-            npc_id = row['連番']
-            npc_name = str(row.get('名前', f'名無し_{npc_id}')).strip()
-            rank_str = str(row.get('階級', '中忍')).strip()
-            school_str = str(row.get('下位流派', '汎用')).strip()
-            # 功績点と連番は事前にクリーンアップされているため、安全に取得可能
-            kouseki_int = int(row.get('功績点', 0)) 
-            
-            if rank_str not in generator.RANK_SLOTS:
-                rank_str = '中忍'
+    return generator
+
+def resolve_seed(seed: Optional[int]) -> int:
+    """実行シードを決めて表示する (省略時はランダム)"""
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    print(f"乱数シード: {seed} (--seed {seed} を指定すると同じ結果を再現できます)")
+    return seed
+
+def iter_generation(generator: NPCGenerator, rows: Iterable[Dict[str, Any]], run_seed: int,
+                    workers: int = 1, chunksize: int = 256) -> Iterator[tuple]:
+    """
+    名簿の行を chunksize 行ずつ生成し、(名簿の行, 完成した NPC または None, エラーメッセージ または None) を
+    名簿順に1件ずつ返す。rows は必要な分だけ読み進める。
+    workers > 1 の場合はプロセスプールで生成する (マスタは WorkerMasterState で渡す)。
+    ワーカーに渡す未完了のチャンクは workers * 2 個までに抑え、名簿を先読みしすぎないようにする。
+    """
+    def chunks() -> Iterator[List[Dict[str, Any]]]:
+        iterator = iter(rows)
+        while True:
+            chunk = list(itertools.islice(iterator, chunksize))
+            if not chunk:
+                return
+            yield chunk
+
+    def inputs(chunk: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [{col: row[col] for col in NPC_INPUT_COLUMNS if col in row} for row in chunk]
+
+    if workers <= 1:
+        for chunk in chunks():
+            for row, outcome in zip(chunk, generate_rows(generator, inputs(chunk), run_seed)):
+                yield (row,) + outcome
+        return
 
-            # NPCオブジェクトを初期化
-            npc = NPC(npc_id, npc_name, rank_str, school_str, kouseki_int)
-            
-            # 決定ロジックを実行
-            completed_npc = generator.complete_npc_data(npc)
-            
-            # 各出力リストにデータを格納
-            all_combined_data.append(completed_npc.to_dict())
-            all_bg_data.extend(completed_npc.背景_list)
-            all_ninpo_data.extend(completed_npc.忍法_list)
-            all_skill_data.extend(completed_npc.特技_list)
-            all_ougi_data.extend(completed_npc.奥義_list)
-            all_ningu_data.extend(completed_npc.忍具_list)
-            
-        except Exception as e:
-            # エラー発生時の連番はすでにintになっているため、.0はつかなくなる
-            print(f"致命的なエラー: 連番 {row.get('連番', '不明')} のNPC処理中にエラーが発生しました: {e}")
-            
-    print(f"情報付与が完了しました。")
-    
-    # --- 結果のCSV出力 (5つの正規化ファイル + 1つの結合ファイル) ---
+    # 構築済みの生成器をワーカーに引き継ぎ、ワーカーごとの Excel 読み込みと前処理を省く
+    with WorkerMasterState(generator, PROFILER.enabled) as master_state, \
+            master_state.context.Pool(workers, initializer=_init_generation_worker,
+                                      initargs=master_state.initargs) as pool:
+        worker_func = _generate_rows_profiled_in_worker if PROFILER.enabled else _generate_rows_in_worker
+        pending = collections.deque()
+        for chunk in itertools.chain(chunks(), [None]):
+            if chunk is not None:
+                pending.append((chunk, pool.apply_async(worker_func, ((inputs(chunk), run_seed),))))
+            # 未完了のチャンクが上限に達したら (最後はすべて) 古い順に結果を受け取る
+            while pending and (chunk is None or len(pending) >= workers * 2):
+                done_chunk, result = pending.popleft()
+                outcomes = result.get()
+                if PROFILER.enabled:
+                    outcomes, samples = outcomes
+                    PROFILER.merge(samples)
+                for row, outcome in zip(done_chunk, outcomes):
+                    yield (row,) + outcome
+
+def run_generation(workers: int = 1, seed: Optional[int] = None, chunksize: int = 256,
+                   cache_dir: Optional[str] = MASTER_CACHE_DIR, output_format: str = 'csv',
+                   reorder_buffer: int = REORDER_BUFFER_ROWS):
+    """
+    名簿の全キャラクターに情報を付与して CSV に出力する
+    (output_format='parquet' の場合は Parquet、'sqlite' の場合は SQLite データベース)。
+    workers > 1 の場合は名簿を chunksize 行ずつに分けてプロセスプールで生成する。
+    各 NPC は (seed, 連番) から作った専用の乱数を使うため、ワーカー数に関係なく同じ結果になる。
+    cache_dir は前処理済みマスタのキャッシュ置き場 (None でキャッシュを使わない)。
+    出力は連番順で、名簿の並びの乱れは reorder_buffer 体の範囲まで並べ替える。
+    """
+    roster = open_roster()
+    if roster is None:
+        return
 
-    # 1. キャラクタ背景.csv
-    df_bg = pd.DataFrame(all_bg_data)
-    df_bg = df_bg.rename(columns={'キャラID': '連番'})
-    df_bg.to_csv('キャラ背景.csv', index=False, encoding='utf_8_sig')
-    
-    # 2. キャラクタ忍法.csv
-    df_ninpo = pd.DataFrame(all_ninpo_data)
-    df_ninpo = df_ninpo.rename(columns={'キャラID': '連番'})
-    df_ninpo.to_csv('キャラ忍法.csv', index=False, encoding='utf_8_sig')
-
-    # 3. キャラクタ特技.csv
-    df_skill = pd.DataFrame(all_skill_data)
-    df_skill = df_skill.rename(columns={'キャラID': '連番'})
-    df_skill = df_skill.drop_duplicates(subset=['連番', '特技ID'])
-    df_skill.to_csv('キャラ特技.csv', index=False, encoding='utf_8_sig')
-    
-    # 4. キャラ奥義.csv
-    df_ougi = pd.DataFrame(all_ougi_data)
-    df_ougi = df_ougi.rename(columns={'キャラID': '連番'})
-    df_ougi.to_csv('キャラ奥義.csv', index=False, encoding='utf_8_sig')
-    
-    # 5. キャラ忍具.csv
-    df_ningu = pd.DataFrame(all_ningu_data)
-    df_ningu = df_ningu.rename(columns={'キャラID': '連番'})
-    df_ningu = df_ningu.drop_duplicates(subset=['連番', '忍具ID'])
-    df_ningu.to_csv('キャラ忍具.csv', index=False, encoding='utf_8_sig')
-
-    # 6. 結合ファイル (基本情報と最終功績点)
-    df_calculated = pd.DataFrame(all_combined_data)
-    
-    # 元のデータから古い「功績点」を削除してからマージする
-    # これにより、計算後の値（最終功績点）が上書きされるのを防ぎます
-    if '功績点' in df_characters.columns:
-        df_characters_for_merge = df_characters.drop(columns=['功績点'])
-    else:
-        df_characters_for_merge = df_characters
+    print(f"--- 既存キャラクター ({roster.source}) への情報付与開始 ---")
 
-    df_output = pd.merge(df_characters_for_merge, df_calculated, on='連番', how='left')
-    
-    # 名前の重複などを掃除
-    df_output = df_output.drop(columns=['氏名_y'], errors='ignore')
-    df_output.rename(columns={'氏名_x': '氏名'}, inplace=True)
-    
-    # ★ ここが重要：HTMLやCSVが「功績点」という名前を期待している場合、
-    # 計算後の「最終功績点」を「功績点」という名前に戻して保存します
-    df_output['功績点'] = df_output['最終功績点']
-    
-    df_output.to_csv('generated_npcs_with_base_data.csv', index=False, encoding='utf_8_sig')
-    
-    print(f"\n--- 完了 ---")
-    print(f"以下の**5つの正規化されたファイル**と1つの結合ファイルを出力しました：")
-    print(f"- キャラ背景.csv (連番、背景ID、背景名)")
-    print(f"- キャラ忍法.csv (連番、忍法ID、忍法名、指定特技)")
-    print(f"- キャラ特技.csv (連番、特技ID、特技名)")
-    print(f"- キャラ奥義.csv (連番、奥義ID、奥義名、指定特技)")
-    print(f"- キャラ忍具.csv (連番、忍具ID、忍具名、個数)")
-    print(f"- generated_npcs_with_base_data.csv (元のデータ + 最終功績点)")
+    generator = create_generator(cache_dir)
+    if generator is None:
+        return
+    seed = resolve_seed(seed)
+
+    try:
+        writer = open_generation_writer(roster.columns, output_format, reorder_buffer=reorder_buffer)
+    except (ImportError, OSError, sqlite3.Error) as e:
+        print(f"出力ファイルを作成できません: {e}")
+        return
+
+    # 名簿を読み進めながら生成し、完成した NPC から連番順に出力ファイルへ追記する
+    with writer:
+        for roster_row, completed_npc, error in iter_generation(generator, roster, seed, workers, chunksize):
+            if error is not None:
+                # エラー発生時の連番はすでにintになっているため、.0はつかなくなる
+                print(error)
+            else:
+                writer.write(completed_npc, roster_row)
+            
+    print(f"情報付与が完了しました。({roster.count}体)")
     
-    if not df_output.empty:
-        print("\n--- サンプルNPCの決定データ (抜粋) ---")
-        print(df_output[['連番', '氏名', '階級', '功績点', '最終功績点']].head(1).to_markdown(index=False))
+    print_generation_summary(writer.first_row, output_format)
 
 if __name__ == '__main__':
-    run_generation()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='キャラクター名簿に背景・忍法・特技・奥義・忍具を付与してCSVに出力する')
+    parser.add_argument('--workers', type=int, default=1, help='生成に使うプロセス数 (既定: 1)')
+    parser.add_argument('--seed', type=int, default=None, help='乱数シード (省略時はランダムに決めて表示する)')
+    parser.add_argument('--chunksize', type=int, default=256, help='ワーカーに渡す1回あたりの行数 (既定: 256)')
+    parser.add_argument('--no-cache', action='store_true', help='前処理済みマスタのキャッシュを使わない')
+    parser.add_argument('--format', choices=list(OUTPUT_FORMATS), default='csv', help='出力形式 (既定: csv)')
+    parser.add_argument('--reorder-buffer', type=int, default=REORDER_BUFFER_ROWS,
+                        help=f'連番順に並べ替えるために待たせておく最大の人数 (既定: {REORDER_BUFFER_ROWS})')
+    parser.add_argument('--profile', action='store_true', help='処理段階ごとの所要時間を計測して表示する')
+    parser.add_argument('--profile-json', default=None, help='計測結果を JSON Lines で追記するファイル (--profile を含む)')
+    args = parser.parse_args()
+    PROFILER.enable(args.profile or bool(args.profile_json))
+    run_generation(workers=args.workers, seed=args.seed, chunksize=args.chunksize,
+                   cache_dir=None if args.no_cache else MASTER_CACHE_DIR, output_format=args.format,
+                   reorder_buffer=args.reorder_buffer)
+    report_profile(args.profile_json)
\ No newline at end of file
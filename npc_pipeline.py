@@ -0,0 +1,96 @@
+import argparse
+import contextlib
+import time
+from typing import Optional
+
+import npc_logic
+import html_exporter
+from npc_logic import MASTER_CACHE_DIR, npc_base_row, npc_output_records
+from html_exporter import TEMPLATE_CACHE_DIR
+from npc_profile import PROFILER, report_profile
+
+# =======================================================
+# 生成から HTML 出力までを CSV を経由せずに行う
+# =======================================================
+# 完成した NPC をそのまま描画に渡すため、名簿全体の生成を待たずにシートの書き出しが始まる。
+# CSV は write_csv を指定した場合だけ、run_generation と同じ形式で NPC ごとに追記する。
+
+def run_pipeline(workers: int = 1, seed: Optional[int] = None, chunksize: int = 64,
+                 cache_dir: Optional[str] = MASTER_CACHE_DIR, write_csv: bool = False,
+                 render_workers: int = 1, template_cache_dir: Optional[str] = TEMPLATE_CACHE_DIR,
+                 archive: Optional[str] = None, compress: bool = True,
+                 shared_css: bool = False, minify: bool = False):
+    """
+    名簿の全キャラクターを生成し、そのままキャラクターシートを出力する。
+    workers は生成、render_workers は描画に使うプロセス数。シートは名簿順に出力する。
+    その他の引数は run_generation / html_exporter.export_html を参照。
+    """
+    start = time.perf_counter()
+    roster = npc_logic.open_roster()
+    if roster is None:
+        return
+
+    print(f"--- 既存キャラクター ({roster.source}) の生成とシート出力を開始 ---")
+
+    generator = npc_logic.create_generator(cache_dir)
+    if generator is None:
+        return
+    masters_start = time.perf_counter()
+    try:
+        masters = html_exporter.load_export_masters()
+    except FileNotFoundError as e:
+        print(f"\n--- 致命的なエラーにより処理を中断しました ---")
+        print(e)
+        return
+    if PROFILER.enabled:
+        PROFILER.add('シート: 読み込み', int((time.perf_counter() - masters_start) * 1e9))
+    seed = npc_logic.resolve_seed(seed)
+    load_seconds = time.perf_counter() - start
+
+    with contextlib.ExitStack() as stack:
+        csv_writer = stack.enter_context(npc_logic.GenerationCsvWriter(roster.columns)) if write_csv else None
+
+        def sheet_tasks():
+            generated = npc_logic.iter_generation(generator, roster, seed, workers, chunksize)
+            for roster_row, completed_npc, error in generated:
+                if error is not None:
+                    print(error)
+                    continue
+                if csv_writer is not None:
+                    csv_writer.write(completed_npc, roster_row)
+                yield npc_base_row(completed_npc, roster_row), npc_output_records(completed_npc)
+
+        html_exporter.export_sheets(
+            sheet_tasks(), masters, workers=render_workers, chunksize=chunksize,
+            template_cache_dir=template_cache_dir, archive=archive, compress=compress,
+            shared_css=shared_css, minify=minify, load_seconds=load_seconds,
+        )
+
+    if csv_writer is not None:
+        npc_logic.print_generation_summary(csv_writer.first_row)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='キャラクター名簿から NPC を生成し、CSV を経由せずにキャラクターシートを出力する')
+    parser.add_argument('--workers', type=int, default=1, help='生成に使うプロセス数 (既定: 1)')
+    parser.add_argument('--render-workers', type=int, default=1, help='描画に使うプロセス数 (既定: 1)')
+    parser.add_argument('--seed', type=int, default=None, help='乱数シード (省略時はランダムに決めて表示する)')
+    parser.add_argument('--chunksize', type=int, default=64, help='ワーカーに渡す1回あたりの人数 (既定: 64)')
+    parser.add_argument('--csv', action='store_true', help='run_generation と同じ CSV も出力する')
+    parser.add_argument('--no-cache', action='store_true', help='前処理済みマスタのキャッシュを使わない')
+    parser.add_argument('--no-template-cache', action='store_true', help='コンパイル済みテンプレートのキャッシュを使わない')
+    parser.add_argument('--archive', default=None, help='シートをまとめるアーカイブ (.zip / .tar / .tar.gz / .tgz / .tar.xz)')
+    parser.add_argument('--no-compress', action='store_true', help='アーカイブを圧縮しない')
+    parser.add_argument('--shared-css', action='store_true', help=f'共通の <style> を {html_exporter.SHARED_CSS_NAME} に外出しする')
+    parser.add_argument('--minify', action='store_true', help='シートの HTML の字下げ・改行を詰める')
+    parser.add_argument('--profile', action='store_true', help='処理段階ごとの所要時間を計測して表示する')
+    parser.add_argument('--profile-json', default=None, help='計測結果を JSON Lines で追記するファイル (--profile を含む)')
+    args = parser.parse_args()
+    PROFILER.enable(args.profile or bool(args.profile_json))
+    run_pipeline(workers=args.workers, seed=args.seed, chunksize=args.chunksize,
+                 cache_dir=None if args.no_cache else MASTER_CACHE_DIR, write_csv=args.csv,
+                 render_workers=args.render_workers,
+                 template_cache_dir=None if args.no_template_cache else TEMPLATE_CACHE_DIR,
+                 archive=args.archive, compress=not args.no_compress,
+                 shared_css=args.shared_css, minify=args.minify)
+    report_profile(args.profile_json)
@@ -0,0 +1,117 @@
+import array
+import datetime
+import json
+import math
+import sys
+from typing import List, Dict, Any, Optional
+
+# =======================================================
+# 処理段階ごとの所要時間の計測 (--profile)
+# =======================================================
+# 計測する箇所では
+#     if PROFILER.enabled:
+#         start = time.perf_counter_ns()
+#     ...
+#     if PROFILER.enabled:
+#         PROFILER.add('段階名', time.perf_counter_ns() - start)
+# のように分岐し、無効時は時刻の取得も記録も行わない。
+# 1回ごとの所要時間 (ナノ秒) を段階ごとの array に溜め、最後に 合計 / 平均 / p95 / 最大 を集計する。
+# ワーカープロセスでの計測値は drain で取り出して親プロセスに返し、merge で合算する。
+
+
+class StageProfiler:
+    """段階名 -> 所要時間 (ナノ秒) の列。段階は最初に記録した順に表示する"""
+
+    def __init__(self):
+        self.enabled = False
+        self.samples: Dict[str, array.array] = {}
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def reset(self):
+        """記録を空にする (fork したワーカーが親プロセスの記録を引き継がないようにする)"""
+        self.samples = {}
+
+    def add(self, stage: str, elapsed_ns: int):
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = self.samples[stage] = array.array('q')
+        samples.append(elapsed_ns)
+
+    def drain(self) -> Dict[str, bytes]:
+        """記録した値を (プロセス間で受け渡しやすい) バイト列で取り出し、記録を空にする"""
+        drained = {stage: samples.tobytes() for stage, samples in self.samples.items()}
+        self.samples = {}
+        return drained
+
+    def merge(self, drained: Optional[Dict[str, bytes]]):
+        """drain で取り出した値を合算する"""
+        for stage, data in (drained or {}).items():
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = self.samples[stage] = array.array('q')
+            samples.frombytes(data)
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """段階ごとの 回数 / 合計 / 平均 / p95 / 最大 (ミリ秒)"""
+        rows = []
+        for stage, samples in self.samples.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            count = len(ordered)
+            total = sum(ordered)
+            rows.append({
+                'stage': stage, 'count': count, 'total_ms': total / 1e6, 'mean_ms': total / count / 1e6,
+                # 最近傍順位法
+                'p95_ms': ordered[max(1, math.ceil(0.95 * count)) - 1] / 1e6, 'max_ms': ordered[-1] / 1e6,
+            })
+        return rows
+
+    def print_report(self, title: str = '処理段階ごとの所要時間'):
+        rows = self.summary()
+        print(f"\n--- {title} ---")
+        if not rows:
+            print("(計測値なし)")
+            return
+        width = max(_display_width(row['stage']) for row in rows)
+        print(f"{_pad('段階', width)}  {'回数':>8}  {'合計(ms)':>11}  {'平均(ms)':>10}  {'p95(ms)':>10}  {'最大(ms)':>10}")
+        for row in rows:
+            print(f"{_pad(row['stage'], width)}  {row['count']:>10}  {row['total_ms']:>13.1f}  {row['mean_ms']:>12.4f}"
+                  f"  {row['p95_ms']:>10.4f}  {row['max_ms']:>12.4f}")
+        print("※ 並列実行時はワーカーの合計 (経過時間ではなく CPU 時間に近い値)")
+
+    def dump_json(self, path: str, command: Optional[str] = None):
+        """集計結果を JSON Lines として path に1行追記する (実行ごとの推移を追えるようにする)"""
+        record = {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'command': command if command is not None else ' '.join(sys.argv),
+            'stages': {row.pop('stage'): row for row in self.summary()},
+        }
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def _display_width(text: str) -> int:
+    """等幅端末での表示幅 (全角文字は2)"""
+    return sum(2 if ord(ch) > 0xff else 1 for ch in text)
+
+def _pad(text: str, width: int) -> str:
+    return text + ' ' * (width - _display_width(text))
+
+
+# プロセス全体で共有する計測器 (--profile で有効にする)
+PROFILER = StageProfiler()
+
+def report_profile(profile_json: Optional[str] = None):
+    """計測が有効なら表を表示し、profile_json を指定した場合は JSON Lines に追記する"""
+    if not PROFILER.enabled:
+        return
+    PROFILER.print_report()
+    if profile_json:
+        try:
+            PROFILER.dump_json(profile_json)
+            print(f"計測結果を {profile_json} に追記しました。")
+        except OSError as e:
+            print(f"⚠️ 警告: 計測結果を保存できませんでした: {e}")
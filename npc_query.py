@@ -0,0 +1,354 @@
+import argparse
+import contextlib
+import os
+import pickle
+import re
+import sqlite3
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from npc_logic import OUTPUT_TABLES, BASE_OUTPUT_FILE, OUTPUT_FORMATS, SQLITE_OUTPUT_FILE, output_file_name
+
+# =======================================================
+# 生成済み NPC の転置索引と検索
+# =======================================================
+# 「特技:隠蔽術 AND NOT 背景:宿敵 AND 最終功績点>=5」のような条件に合う NPC を、
+# 正規化テーブルを pandas で絞り込まずに索引だけで求める。
+# 索引は「種別:名前」の語 -> その語を持つ NPC の文書番号 (名簿順、昇順) の配列で、
+# 検索時は語ごとに NPC 数ぶんのビット列にして AND / OR / NOT を numpy の論理演算で計算する。
+
+QUERY_INDEX_FILE = 'npc_query.idx'
+QUERY_INDEX_VERSION = 1
+# 索引にする修得データ: 種別 -> 名前のカラム
+INDEXED_NAME_COLUMNS = {'背景': '背景名', '忍法': '忍法名', '特技': '特技名', '奥義': '奥義名', '忍具': '忍具名'}
+# 結合テーブルから語として索引にするカラム
+ATTRIBUTE_COLUMNS = ('階級', '下位流派')
+# 結合テーブルのうち、数値型のカラムは範囲条件 (最終功績点>=5 など) に使える
+COMPARISON_OPERATORS = {
+    '>=': np.greater_equal, '≥': np.greater_equal, '<=': np.less_equal, '≤': np.less_equal,
+    '>': np.greater, '<': np.less, '=': np.equal, '==': np.equal, '!=': np.not_equal,
+}
+COMPARISON_PATTERN = re.compile(r'^([^\s()"<>=!≥≤:]+)\s*(>=|<=|==|!=|≥|≤|=|>|<)\s*(-?\d+(?:\.\d+)?)$')
+# 比較 (空白を挟んでもよい) / 括弧 / 語 (ダブルクォートで囲めば空白や括弧も使える)
+TOKEN_PATTERN = re.compile(
+    r'\s*([^\s()"<>=!≥≤:]+\s*(?:>=|<=|==|!=|≥|≤|=|>|<)\s*-?\d+(?:\.\d+)?|\(|\)|(?:"[^"]*"|[^\s()"])+)'
+)
+QUERY_OPERATORS = ('AND', 'OR', 'NOT')
+
+
+def normalize_term_name(name: Any) -> str:
+    """語の名前を比較用にそろえる (前後の空白と 《》 を除く)"""
+    return str(name).strip().strip('《》').strip()
+
+def make_term(kind: str, name: Any) -> str:
+    return f'{kind}:{normalize_term_name(name)}'
+
+
+class QueryIndex:
+    """
+    生成済み NPC の転置索引。postings は語 -> 文書番号の昇順配列 (int32)、
+    char_ids / names は文書番号 -> 連番 / 氏名、numeric は数値カラム -> 文書番号順の値 (欠損は NaN)。
+    """
+
+    def __init__(self, char_ids: np.ndarray, names: np.ndarray, postings: Dict[str, np.ndarray],
+                 numeric: Dict[str, np.ndarray], source: Optional[tuple] = None):
+        self.char_ids = char_ids
+        self.names = names
+        self.postings = postings
+        self.numeric = numeric
+        self.source = source
+        self.kinds = {term.split(':', 1)[0] for term in postings} | set(INDEXED_NAME_COLUMNS) | set(ATTRIBUTE_COLUMNS)
+
+    def __len__(self) -> int:
+        return len(self.char_ids)
+
+    # --- 構築 ---
+    @classmethod
+    def build(cls, df_base: pd.DataFrame, acquired: Dict[str, pd.DataFrame], source: Optional[tuple] = None) -> 'QueryIndex':
+        """結合テーブルと正規化テーブル (種別 -> 連番と名前のカラムを持つ DataFrame) から索引を作る"""
+        # 連番が重複している場合は最初の行を使う
+        df_base = df_base.drop_duplicates(subset='連番', keep='first').reset_index(drop=True)
+        char_ids = df_base['連番'].to_numpy()
+        doc_index = pd.Index(char_ids)
+        names = (df_base['氏名'] if '氏名' in df_base.columns else pd.Series([''] * len(df_base))).astype(str).to_numpy()
+
+        postings = {}
+        for kind, name_col in INDEXED_NAME_COLUMNS.items():
+            df = acquired.get(kind)
+            if df is None or df.empty:
+                continue
+            docs = doc_index.get_indexer(df['連番'])
+            postings.update(cls._group_postings(kind, df[name_col], docs))
+        for col in ATTRIBUTE_COLUMNS:
+            if col in df_base.columns:
+                postings.update(cls._group_postings(col, df_base[col], np.arange(len(df_base))))
+
+        numeric = {}
+        for col in df_base.columns:
+            if col != '連番' and pd.api.types.is_numeric_dtype(df_base[col]):
+                numeric[col] = df_base[col].to_numpy(dtype=np.float64)
+        return cls(char_ids, names, postings, numeric, source)
+
+    @staticmethod
+    def _group_postings(kind: str, names: pd.Series, docs: np.ndarray) -> Dict[str, np.ndarray]:
+        """(名前, 文書番号) の組から 語 -> 文書番号の昇順配列 を作る (重複は除く)"""
+        # 名前の正規化は異なる名前ごとに1回だけ行い、並べ替えと重複除去は (語の番号, 文書番号) の整数で行う
+        codes, uniques = pd.factorize(names)
+        term_codes, terms = pd.factorize(pd.Index(uniques).map(normalize_term_name))
+        keep = (codes >= 0) & (docs >= 0)
+        codes, docs = term_codes[codes[keep]].astype(np.int64), docs[keep].astype(np.int64)
+        named = np.asarray(terms != '')[codes]
+        codes, docs = codes[named], docs[named]
+        width = int(docs.max(initial=0)) + 1
+        keys = np.sort(codes * width + docs)
+        keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))] if len(keys) else keys
+        codes, docs = np.divmod(keys, width)
+        bounds = np.flatnonzero(np.diff(codes)) + 1
+        return {
+            f'{kind}:{terms[group_codes[0]]}': group_docs.astype(np.int32)
+            for group_codes, group_docs in zip(np.split(codes, bounds), np.split(docs, bounds))
+            if len(group_codes)
+        }
+
+    # --- 保存と読み込み ---
+    def save(self, path: str = QUERY_INDEX_FILE):
+        state = {
+            'version': QUERY_INDEX_VERSION, 'source': self.source, 'char_ids': self.char_ids,
+            'names': self.names, 'postings': self.postings, 'numeric': self.numeric,
+        }
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = QUERY_INDEX_FILE) -> 'QueryIndex':
+        """save で保存した索引を読み込む (形式が古い場合は ValueError)"""
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != QUERY_INDEX_VERSION:
+            raise ValueError(f"索引ファイル '{path}' の形式が古いため使えません。")
+        return cls(state['char_ids'], state['names'], state['postings'], state['numeric'], state['source'])
+
+    # --- 検索 ---
+    def postings_for(self, term: str) -> np.ndarray:
+        """語の文書番号の配列 (索引にない名前は空)。種別が不明な場合は ValueError"""
+        kind, sep, name = term.partition(':')
+        if not sep or kind not in self.kinds:
+            raise ValueError(f"不明な語です: '{term}' (種別:名前 の形で指定してください。種別: {'/'.join(sorted(self.kinds))})")
+        return self.postings.get(make_term(kind, name), np.empty(0, dtype=np.int32))
+
+    def term_mask(self, term: str) -> np.ndarray:
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.postings_for(term)] = True
+        return mask
+
+    def comparison_mask(self, column: str, operator: str, value: float) -> np.ndarray:
+        values = self.numeric.get(column)
+        if values is None:
+            raise ValueError(f"数値で比較できないカラムです: '{column}' (候補: {'/'.join(self.numeric) or 'なし'})")
+        with np.errstate(invalid='ignore'):
+            return COMPARISON_OPERATORS[operator](values, value)
+
+    def search(self, query: str) -> np.ndarray:
+        """検索式に合う NPC の文書番号を名簿順で返す (検索式の誤りは ValueError)"""
+        return np.flatnonzero(QueryParser(self, query).parse())
+
+    def search_ids(self, query: str) -> List[Any]:
+        """検索式に合う NPC の連番を名簿順で返す"""
+        return self.char_ids[self.search(query)].tolist()
+
+
+class QueryParser:
+    """
+    検索式をビット列に評価する再帰下降パーサ。
+    式 := 積 (OR 積)* / 積 := 否定 (AND? 否定)* / 否定 := NOT 否定 | 要素 / 要素 := ( 式 ) | 比較 | 語
+    語を並べただけの場合は AND とみなす。演算子は大文字小文字を区別しない。
+    """
+
+    def __init__(self, index: QueryIndex, query: str):
+        self.index = index
+        self.tokens = self.tokenize(query)
+        self.pos = 0
+
+    @staticmethod
+    def tokenize(query: str) -> List[str]:
+        tokens = []
+        pos = 0
+        query = query.strip()
+        while pos < len(query):
+            match = TOKEN_PATTERN.match(query, pos)
+            if match is None:
+                raise ValueError(f"検索式を解釈できません: '{query[pos:]}'")
+            tokens.append(match.group(1))
+            pos = match.end()
+            while pos < len(query) and query[pos].isspace():
+                pos += 1
+        if not tokens:
+            raise ValueError("検索式が空です。")
+        return tokens
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def peek_operator(self) -> Optional[str]:
+        token = self.peek()
+        return token.upper() if token is not None and token.upper() in QUERY_OPERATORS else None
+
+    def parse(self) -> np.ndarray:
+        mask = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError(f"検索式の '{self.peek()}' 以降を解釈できません。")
+        return mask
+
+    def parse_or(self) -> np.ndarray:
+        mask = self.parse_and()
+        while self.peek_operator() == 'OR':
+            self.pos += 1
+            mask = mask | self.parse_and()
+        return mask
+
+    def parse_and(self) -> np.ndarray:
+        mask = self.parse_not()
+        while self.peek() is not None and self.peek() != ')' and self.peek_operator() != 'OR':
+            if self.peek_operator() == 'AND':
+                self.pos += 1
+            mask = mask & self.parse_not()
+        return mask
+
+    def parse_not(self) -> np.ndarray:
+        if self.peek_operator() == 'NOT':
+            self.pos += 1
+            return ~self.parse_not()
+        return self.parse_atom()
+
+    def parse_atom(self) -> np.ndarray:
+        token = self.peek()
+        if token is None:
+            raise ValueError("検索式が途中で終わっています。")
+        if token == ')' or self.peek_operator() is not None:
+            raise ValueError(f"検索式の '{token}' の位置に語がありません。")
+        self.pos += 1
+        if token == '(':
+            mask = self.parse_or()
+            if self.peek() != ')':
+                raise ValueError("括弧が閉じられていません。")
+            self.pos += 1
+            return mask
+        comparison = COMPARISON_PATTERN.match(token)
+        if comparison:
+            column, operator, value = comparison.groups()
+            return self.index.comparison_mask(column, operator, float(value))
+        return self.index.term_mask(token.replace('"', ''))
+
+
+# =======================================================
+# 生成済みテーブルの読み込み
+# =======================================================
+
+def source_files(input_format: str) -> List[str]:
+    if input_format == 'sqlite':
+        return [SQLITE_OUTPUT_FILE]
+    return [output_file_name(BASE_OUTPUT_FILE, input_format)] + [
+        output_file_name(OUTPUT_TABLES[kind][1], input_format) for kind in INDEXED_NAME_COLUMNS
+    ]
+
+def source_signature(input_format: str) -> Optional[tuple]:
+    """入力ファイルの名前・大きさ・更新時刻 (どれかがない場合は None)"""
+    try:
+        return (input_format,) + tuple((name, os.stat(name).st_size, os.stat(name).st_mtime_ns) for name in source_files(input_format))
+    except FileNotFoundError:
+        return None
+
+def load_index_tables(input_format: str = 'csv') -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]:
+    """npc_logic の出力から、索引に使うカラムだけを読み込む (ファイルがない場合は FileNotFoundError)"""
+    missing = [name for name in source_files(input_format) if not os.path.exists(name)]
+    if missing:
+        raise FileNotFoundError(f"必要なファイルが見つかりません: {', '.join(missing)}")
+
+    if input_format == 'sqlite':
+        with contextlib.closing(sqlite3.connect(SQLITE_OUTPUT_FILE)) as conn:
+            df_base = pd.read_sql_query(f'SELECT * FROM "{os.path.splitext(BASE_OUTPUT_FILE)[0]}" ORDER BY rowid', conn)
+            acquired = {
+                kind: pd.read_sql_query(f'SELECT "連番", "{col}" FROM "{os.path.splitext(OUTPUT_TABLES[kind][1])[0]}"', conn)
+                for kind, col in INDEXED_NAME_COLUMNS.items()
+            }
+        return df_base, acquired
+
+    def load(file_name: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        path = output_file_name(file_name, input_format)
+        if input_format == 'parquet':
+            return pd.read_parquet(path, columns=columns)
+        return pd.read_csv(path, encoding='utf_8_sig', usecols=columns)
+
+    df_base = load(BASE_OUTPUT_FILE)
+    acquired = {kind: load(OUTPUT_TABLES[kind][1], ['連番', col]) for kind, col in INDEXED_NAME_COLUMNS.items()}
+    return df_base, acquired
+
+def build_query_index(input_format: str = 'csv') -> QueryIndex:
+    signature = source_signature(input_format)
+    df_base, acquired = load_index_tables(input_format)
+    return QueryIndex.build(df_base, acquired, source=signature)
+
+def open_query_index(input_format: str = 'csv', index_path: str = QUERY_INDEX_FILE, rebuild: bool = False) -> QueryIndex:
+    """
+    保存済みの索引を読み込む。索引がない・入力ファイルが索引を作った後に変わった・rebuild を指定した
+    場合は作り直して保存する。
+    """
+    if not rebuild and os.path.exists(index_path):
+        try:
+            index = QueryIndex.load(index_path)
+            if index.source is not None and index.source[0] == input_format and index.source == source_signature(input_format):
+                return index
+        except (OSError, ValueError, pickle.UnpicklingError, EOFError) as e:
+            print(f"⚠️ 警告: 索引ファイル '{index_path}' を読み込めないため作り直します: {e}")
+
+    start = time.perf_counter()
+    index = build_query_index(input_format)
+    try:
+        index.save(index_path)
+    except OSError as e:
+        print(f"⚠️ 警告: 索引を保存できませんでした: {e}")
+    print(f"索引を作成しました: {len(index)}人 / {len(index.postings)}語 ({time.perf_counter() - start:.2f}秒)")
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='生成済み NPC を転置索引で検索する',
+        epilog="例: python npc_query.py '特技:隠蔽術 AND (忍法:接近戦攻撃 OR NOT 階級:下忍) AND 最終功績点>=5'",
+    )
+    parser.add_argument('query', nargs='?', default=None, help='検索式 (種別:名前、AND / OR / NOT、括弧、カラム>=数値)')
+    parser.add_argument('--input-format', choices=list(OUTPUT_FORMATS), default='csv', help='生成結果の形式 (既定: csv)')
+    parser.add_argument('--index', default=QUERY_INDEX_FILE, help=f'索引ファイル (既定: {QUERY_INDEX_FILE})')
+    parser.add_argument('--rebuild', action='store_true', help='索引を作り直す')
+    parser.add_argument('--limit', type=int, default=20, help='表示する件数 (既定: 20、0 で件数のみ)')
+    parser.add_argument('--terms', action='store_true', help='索引にある語と該当人数を一覧表示する')
+    args = parser.parse_args()
+
+    try:
+        query_index = open_query_index(args.input_format, args.index, args.rebuild)
+    except (FileNotFoundError, ImportError, sqlite3.Error) as e:
+        print(f"\n--- 致命的なエラーにより処理を中断しました ---")
+        print(e)
+        raise SystemExit(1)
+
+    if args.terms:
+        for term in sorted(query_index.postings):
+            print(f"{term}\t{len(query_index.postings[term])}")
+    if args.query:
+        try:
+            start = time.perf_counter()
+            docs = query_index.search(args.query)
+            elapsed = time.perf_counter() - start
+        except ValueError as e:
+            print(f"--- 検索式のエラー: {e} ---")
+            raise SystemExit(2)
+        print(f"--- {len(docs)}人 / {len(query_index)}人が該当 ({elapsed * 1000:.2f}ミリ秒) ---")
+        for doc in docs[:max(args.limit, 0)]:
+            print(f"{query_index.char_ids[doc]}\t{query_index.names[doc]}")
+        if len(docs) > args.limit > 0:
+            print(f"... ほか {len(docs) - args.limit}人")
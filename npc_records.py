@@ -0,0 +1,356 @@
+import array
+import bisect
+import math
+import random
+import re
+from typing import List, Dict, Any, Set, Optional, NamedTuple
+
+import pandas as pd
+
+# =======================================================
+# マスタのレコード定義とルール文字列のコンパイル
+# =======================================================
+# 前処理済みマスタのキャッシュ (pickle) に入るクラスは npc_logic.py ではなくこのモジュールに置く。
+# npc_logic.py をスクリプトとして実行してもクラスは __main__ ではなく npc_records のものとして保存されるため、
+# npc_logic を import する他のスクリプト (npc_pipeline.py など) と同じキャッシュを読み書きできる。
+
+# 修得制限/コスト条件で「条件なし」とみなす値
+NO_RULE_VALUES = ['汎用', 'なし', '－', 'nan']
+# コスト条件の半額指定として扱う表記
+HALF_COST_MARKERS = ['半額', '1/2', 'ハナガク/2']
+COST_DELTA_PATTERN = re.compile(r'^(.+?)([+-])(\d+)$')
+NINPO_RULE_PATTERN = re.compile(r'(種別|流派):([^:]+):(\d+)')
+SKILL_FIELD_PATTERN = re.compile(r'(?:分野:|好きな)?(.+術)')
+SKILL_NAME_PATTERN = re.compile(r'《(.*?)》')
+
+
+class BackgroundRestriction:
+    """背景マスタの修得制限をコンパイルした判定オブジェクト (条件は OR 結合)"""
+    __slots__ = ('always', 'have_names', 'match_names', 'not_names')
+
+    def __init__(self, always: bool, have_names: frozenset, match_names: frozenset, not_names: tuple):
+        self.always = always
+        self.have_names = have_names
+        self.match_names = match_names
+        self.not_names = not_names
+
+    @classmethod
+    def parse(cls, rule_str: Any, errors: Optional[List[str]] = None, label: str = '') -> 'BackgroundRestriction':
+        rule = str(rule_str).strip()
+        if not rule or rule in NO_RULE_VALUES:
+            return cls(True, frozenset(), frozenset(), ())
+
+        have_names, match_names, not_names = set(), set(), []
+        for condition in rule.split('+'):
+            condition = condition.strip('《》').strip('/').strip('(').strip(')').strip()
+            if not condition: continue
+
+            # A. HAVE: 取得済み背景の条件
+            if condition.startswith('HAVE:'):
+                required_name = condition[len('HAVE:'):].strip()
+                if required_name:
+                    have_names.add(required_name)
+                continue
+
+            # B. NOT 条件 ('NOT'の後のコロンと空白を除去)
+            if condition.startswith('NOT'):
+                check_rule = condition[3:].lstrip(':').strip()
+                if check_rule and check_rule not in not_names:
+                    not_names.append(check_rule)
+            else:
+                match_names.add(condition)
+
+        restriction = cls(False, frozenset(have_names), frozenset(match_names), tuple(not_names))
+        if errors is not None and not restriction.has_conditions():
+            errors.append(f"{label}修得制限「{rule}」: 有効な条件がないため、常に修得不可になります")
+        return restriction
+
+    def has_conditions(self) -> bool:
+        return self.always or bool(self.have_names or self.match_names or self.not_names)
+
+    def allows_by_school(self, school: str, series: str) -> bool:
+        """HAVE: 以外の条件 (流派/系列とNOT) で満たされるか"""
+        if self.always or school in self.match_names or series in self.match_names:
+            return True
+        return any(name != school and name != series for name in self.not_names)
+
+    def __call__(self, school: str, series: str, acquired_names: Set[str]) -> bool:
+        if self.allows_by_school(school, series):
+            return True
+        return not self.have_names.isdisjoint(acquired_names)
+
+
+class CostRule:
+    """背景マスタのコスト条件をコンパイルしたもの。(条件名, 種類, 値) を先頭から評価する"""
+    __slots__ = ('clauses',)
+
+    def __init__(self, clauses: tuple):
+        self.clauses = clauses
+
+    @classmethod
+    def parse(cls, rule_str: Any, errors: Optional[List[str]] = None, label: str = '') -> 'CostRule':
+        rule = str(rule_str).strip()
+        if not rule or rule in NO_RULE_VALUES:
+            return cls(())
+
+        def report(message: str):
+            if errors is not None:
+                errors.append(f"{label}コスト条件「{rule}」: {message}")
+
+        def names_of(condition_str: str) -> frozenset:
+            return frozenset(s.strip('《》') for s in condition_str.split('+'))
+
+        clauses = []
+        # 1. '|' 区切りの条件/固定値形式 (例: 麝香会総合病院|4)
+        if '|' in rule:
+            condition_str, value_str = rule.split('|', 1)
+            try:
+                clauses.append((names_of(condition_str), 'fixed', int(value_str.strip())))
+            except ValueError:
+                report(f"固定値「{value_str.strip()}」を整数として解釈できません")
+
+        # 2. '/' 区切りの条件/半額形式 (例: 麝香会総合病院/)
+        if '/' in rule:
+            parts = rule.split('/')
+            is_half_rule = len(parts) == 2 and parts[1].strip() == '' or \
+                            len(parts) > 1 and parts[1].strip().upper() in HALF_COST_MARKERS
+            if is_half_rule:
+                clauses.append((names_of(parts[0]), 'half', 0))
+
+        # 3. 加算/減算形式 (例: 御斎系列+1)
+        match = COST_DELTA_PATTERN.match(rule)
+        if match:
+            condition_str, operator, amount_str = match.groups()
+            amount = int(amount_str)
+            clauses.append((names_of(condition_str), 'delta', amount if operator == '+' else -amount))
+
+        if not clauses and '|' not in rule:
+            report("どの書式にも一致しないため、基本コストのまま扱います")
+        return cls(tuple(clauses))
+
+    def __call__(self, base_cost: int, school: Any, series: Any) -> int:
+        for names, kind, value in self.clauses:
+            if school in names or series in names:
+                if kind == 'fixed':
+                    return value
+                if kind == 'half':
+                    # ★ 端数切り上げ (ceil) を適用
+                    return math.ceil(base_cost / 2)
+                return base_cost + value
+        return base_cost
+
+
+class NinpoSpecialRule:
+    """背景マスタの忍法特例 ('種別:X:n' / '流派:X:n' / 忍法名) をコンパイルしたもの"""
+    __slots__ = ('rule_type', 'value', 'count')
+
+    def __init__(self, rule_type: str, value: str, count: int):
+        self.rule_type = rule_type
+        self.value = value
+        self.count = count
+
+    @classmethod
+    def parse(cls, rule_str: Any) -> Optional['NinpoSpecialRule']:
+        if rule_str is None or pd.isna(rule_str):
+            return None
+        rule = str(rule_str).strip()
+        if not rule or rule in ['なし', '－']:
+            return None
+        rule_info = NINPO_RULE_PATTERN.match(rule)
+        if rule_info:
+            rule_type, value, count_str = rule_info.groups()
+            return cls(rule_type, value.strip(), int(count_str))
+        return cls('名前', rule.strip('《》'), 1)
+
+
+class SkillRule:
+    """
+    指定特技/加入必須特技の文字列をコンパイルしたもの。
+    kind は なし/自由/分野/候補/全て/可変 のいずれかで、候補となる特技名は読み込み時に解決しておく。
+    """
+    __slots__ = ('kind', 'text', 'field', 'candidates', 'mask')
+
+    NONE, FREE, FIELD, ONE_OF, ALL_OF, VARIABLE = 'なし', '自由', '分野', '候補', '全て', '可変'
+
+    def __init__(self, kind: str, text: str, field: Optional[str] = None, candidates: tuple = (), mask: int = 0):
+        self.kind = kind
+        self.text = text
+        self.field = field
+        self.candidates = candidates
+        self.mask = mask # 候補特技のビットマスク
+
+    @classmethod
+    def parse_designated(cls, rule_str: Any, field_skills: Dict[str, List[str]], skill_bits: Dict[str, int]) -> 'SkillRule':
+        """忍法マスタの指定特技 (例: '自由', '分野:器術', '好きな妖術', '《針術》《隠蔽術》', '可変')"""
+        if not isinstance(rule_str, str) or rule_str.strip() in ['なし', '', 'nan', '－']:
+            return cls(cls.NONE, 'なし')
+        rule = rule_str.strip()
+        if rule == '自由':
+            return cls.of(cls.FREE, rule, None, skill_bits, skill_bits)
+        if rule == '可変':
+            return cls(cls.VARIABLE, rule)
+
+        # 分野指定 (例: '分野:器術' -> '器術', '好きな妖術' -> '妖術')
+        # 末尾に「術」を含むルールは分野指定として扱い、該当分野がなければ 'なし' とする
+        match_field = SKILL_FIELD_PATTERN.search(rule)
+        if match_field:
+            field = match_field.group(1).strip()
+            if field in field_skills:
+                return cls.of(cls.FIELD, rule, field, field_skills[field], skill_bits)
+            return cls(cls.NONE, rule)
+
+        # 特定特技リスト (例: '《異形化》《変化の術》'): '》' で区切り、《》を削除して特技名を抽出
+        names = [s.strip().replace('《', '').replace('》', '') for s in rule.split('》') if s.strip()]
+        return cls.one_of(rule, names, skill_bits)
+
+    @classmethod
+    def parse_required(cls, rule_str: Any, field_skills: Dict[str, List[str]], skill_bits: Dict[str, int]) -> 'SkillRule':
+        """流派マスタの加入必須特技 (例: '自由', '分野:器術', '《A》+《B》', '《A》')"""
+        if not isinstance(rule_str, str) or rule_str.strip() in ['－', 'なし', '可変', 'nan', '']:
+            return cls(cls.NONE, 'なし')
+        rule = rule_str.strip()
+        if rule == '自由':
+            return cls.of(cls.FREE, rule, None, skill_bits, skill_bits)
+        if '分野:' in rule:
+            field = rule.split(':')[1].strip()
+            return cls.of(cls.FIELD, rule, field, field_skills.get(field, []), skill_bits)
+        if '+' in rule:
+            # '《A》+《B》' はいずれか1つを修得していればよい
+            names = [s.strip().strip('《》') for s in rule.split('+')]
+            return cls.one_of(rule, names, skill_bits)
+        # '《A》《B》' は列挙した特技をすべて修得している必要がある
+        names = SKILL_NAME_PATTERN.findall(rule)
+        if not names:
+            # 《》のない特技名 (例: '絡繰術') は修得の対象にしない (従来どおり何も修得しない)
+            return cls(cls.NONE, rule)
+        return cls.one_of(rule, names, skill_bits, cls.ALL_OF)
+
+    @classmethod
+    def of(cls, kind: str, rule: str, field: Optional[str], names, skill_bits: Dict[str, int]) -> 'SkillRule':
+        candidates = tuple(names)
+        mask = 0
+        for name in candidates:
+            if name in skill_bits:
+                mask |= 1 << skill_bits[name]
+        return cls(kind, rule, field, candidates, mask)
+
+    @classmethod
+    def one_of(cls, rule: str, names: List[str], skill_bits: Dict[str, int], kind: str = ONE_OF) -> 'SkillRule':
+        # 特技マスタに存在する特技のみを候補にする (重複は除去)
+        candidates = tuple(dict.fromkeys(name for name in names if name in skill_bits))
+        if not candidates:
+            return cls(cls.NONE, rule)
+        return cls.of(kind, rule, None, candidates, skill_bits)
+
+    def choose(self, rng: Any = random) -> str:
+        """候補からランダムに1つ選ぶ。可変はルール文字列をそのまま返す (特技修得フェーズで処理)"""
+        if self.kind == self.VARIABLE:
+            return self.text
+        if not self.candidates:
+            return 'なし'
+        return rng.choice(self.candidates)
+
+    def is_satisfied(self, acquired_mask: int) -> bool:
+        """加入必須特技の条件を既に満たしているか ('自由'は常に1つ追加で修得する)"""
+        if self.kind == self.NONE:
+            return True
+        if self.kind == self.FREE or self.kind == self.VARIABLE:
+            return False
+        if self.kind == self.ALL_OF:
+            return acquired_mask & self.mask == self.mask
+        return acquired_mask & self.mask != 0
+
+
+class BackgroundTable:
+    """
+    (所属流派, 流派系列) ごとの背景候補表。
+    流派/系列だけで修得可能な行を実効コスト昇順に保持し、HAVE: でのみ解禁される行は別に持つ。
+    コストと行インデックスは array に持つ。fork したワーカーが表を読んでも Python オブジェクトの参照カウントを
+    書き換えないため、親プロセスと共有しているページがコピーされない。
+    HAVE: の行は対象の背景名から引けるようにし、抽選のたびにすべての行を走査しない。
+    """
+    __slots__ = ('costs', 'indices', 'positions', 'overlay_costs', 'overlay_indices', 'overlay_by_name', 'names')
+
+    def __init__(self, entries: List[tuple], overlay: List[tuple], names: Dict[Any, str]):
+        entries = sorted(entries, key=lambda e: e[0])
+        self.costs = array.array('q', (cost for cost, _ in entries))
+        self.indices = array.array('q', (idx for _, idx in entries))
+        self.positions: Dict[str, List[int]] = {}
+        for pos, idx in enumerate(self.indices):
+            self.positions.setdefault(names[idx], []).append(pos)
+        # overlay: [(実効コスト, 行インデックス, HAVE:の対象名)]。HAVE:の対象名 -> overlay 内の位置
+        self.overlay_costs = array.array('q', (cost for cost, _, _ in overlay))
+        self.overlay_indices = array.array('q', (idx for _, idx, _ in overlay))
+        self.overlay_by_name: Dict[str, List[int]] = {}
+        for pos, (_, _, have_names) in enumerate(overlay):
+            for name in have_names:
+                self.overlay_by_name.setdefault(name, []).append(pos)
+        self.names = names
+
+    def choose(self, max_cost: Optional[int], excluded_names: Set[str], acquired_names: Set[str],
+               rng: Any = random) -> Optional[tuple]:
+        """実効コストが max_cost 以下かつ excluded_names 以外の候補から1つ選び、(行インデックス, 実効コスト) を返す"""
+        limit = len(self.costs) if max_cost is None else bisect.bisect_right(self.costs, max_cost)
+        excluded = sorted({
+            pos for name in excluded_names for pos in self.positions.get(name, ()) if pos < limit
+        })
+        # HAVE: 条件は取得済み背景によって変わるため、都度オーバーレイとして追加する (overlay の順序を保つ)
+        unlocked_positions = sorted({pos for name in acquired_names for pos in self.overlay_by_name.get(name, ())})
+        unlocked = [
+            (self.overlay_indices[pos], self.overlay_costs[pos]) for pos in unlocked_positions
+            if (max_cost is None or self.overlay_costs[pos] <= max_cost)
+            and self.names[self.overlay_indices[pos]] not in excluded_names
+        ]
+        static_count = limit - len(excluded)
+        total = static_count + len(unlocked)
+        if total <= 0:
+            return None
+
+        r = rng.randrange(total)
+        if r >= static_count:
+            return unlocked[r - static_count]
+        # r 番目の「除外されていない」位置へ読み替える
+        for pos in excluded:
+            if pos > r: break
+            r += 1
+        return self.indices[r], self.costs[r]
+
+
+# --- 生成処理用のマスタレコード (rid はレコード列内の位置で、整数IDとして使う) ---
+
+class SkillRecord(NamedTuple):
+    rid: int
+    id: Any
+    name: str
+    field: str
+
+
+class NinpoRecord(NamedTuple):
+    rid: int
+    id: Any
+    name: str
+    kind: str          # 種別 (秘伝 など)
+    school: str        # 流派
+    rank_limit: str    # 階級制限
+    skill_rule: str    # 指定特技 (ルール文字列)
+    ninpo_type: str    # タイプ
+    designated: SkillRule  # 指定特技 (コンパイル済み)
+
+
+class BackgroundRecord(NamedTuple):
+    rid: int
+    id: Any
+    name: str
+    kind: str          # 長所 / 弱点
+    cost: int
+    restriction: BackgroundRestriction
+    cost_rule: CostRule
+    ninpo_rule: Optional[NinpoSpecialRule]
+
+
+class SchoolRecord(NamedTuple):
+    rid: int
+    name: str
+    series: Any
+    required_skill: str  # 加入必須特技
+    required: SkillRule  # 加入必須特技 (コンパイル済み)
@@ -0,0 +1,305 @@
+import argparse
+import collections
+import itertools
+import os
+import pickle
+import random
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple, Iterable
+
+import npc_logic
+from npc_logic import MASTER_CACHE_DIR, RANK_SLOTS, NPC, NPCGenerator, npc_from_row, npc_rng
+
+# =======================================================
+# 生成済み NPC の貯蔵庫 (リザーバ)
+# =======================================================
+# (階級, 流派) ごとに生成済みの NPC を capacity 人まで蓄えておき、要求にはその場で (O(1) で) 返す。
+# 残りが low_water 人を下回ると、バックグラウンドのスレッドが capacity 人まで補充する。
+# 蓄えた NPC は save で保存でき、次回の起動時に load すれば空の状態から始めずに済む。
+
+RESERVOIR_FILE = 'npc_reservoir.pkl'
+RESERVOIR_VERSION = 1
+
+ReservoirKey = Tuple[str, str]
+
+
+def master_signature() -> Optional[str]:
+    """マスタとモジュールの内容から決まる識別子 (マスタが変わったら保存済みの NPC は使わない)"""
+    path = NPCGenerator._master_cache_path('')
+    return os.path.basename(path) if path else None
+
+
+class PoolStats:
+    """1つの (階級, 流派) の計測値"""
+
+    def __init__(self):
+        self.hits = 0            # 蓄えから返した回数
+        self.misses = 0          # 蓄えが空でその場で生成した回数
+        self.refilled = 0        # バックグラウンドで補充した人数
+        self.refill_seconds = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'hits': self.hits, 'misses': self.misses, 'refilled': self.refilled,
+                'refill_ms': round(self.refill_seconds * 1000, 1)}
+
+
+class NPCReservoir:
+    """
+    NPCGenerator.complete_npc_data の前段に置く NPC の貯蔵庫。
+    生成器は渡されたものの状態を複製して使う (NPCGenerator は生成中に乱数生成器を差し替えるため、
+    呼び出し元の生成器と同時に使わない)。蓄えの操作と生成はそれぞれ別のロックで保護する。
+    NPC は (run_seed, 連番) の乱数で生成するため、名簿に 連番 / 名前 'NPC{連番}' / 功績点 kouseki の行を置いて
+    run_generation を --seed run_seed で実行すると同じ結果になる。
+    """
+
+    def __init__(self, generator: NPCGenerator, capacity: int = 20, low_water: int = 5,
+                 kouseki: int = 0, run_seed: Optional[int] = None, start: bool = True):
+        if capacity < 1 or not 0 <= low_water <= capacity:
+            raise ValueError(f"capacity は1以上、low_water は0〜capacity で指定してください: {capacity}, {low_water}")
+        self.generator = NPCGenerator.from_state(generator.export_state())
+        self.capacity = capacity
+        self.low_water = low_water
+        self.kouseki = kouseki
+        self.run_seed = random.randrange(2 ** 32) if run_seed is None else run_seed
+        self.next_id = itertools.count(1)
+        self.pools: Dict[ReservoirKey, collections.deque] = {}
+        self.stats: Dict[ReservoirKey, PoolStats] = {}
+        # 補充待ちのキー (重複なし、古い順)
+        self.pending: Dict[ReservoirKey, None] = {}
+        self.refilling = False
+        self.condition = threading.Condition()
+        self.generate_lock = threading.Lock()
+        self.closed = False
+        self.worker = None
+        if start:
+            self.start()
+
+    # --- 生成 ---
+    @staticmethod
+    def make_key(rank: str, school: str) -> ReservoirKey:
+        rank = str(rank).strip()
+        if rank not in RANK_SLOTS:
+            raise ValueError(f"不明な階級です: {rank} (候補: {'/'.join(RANK_SLOTS)})")
+        return rank, str(school).strip() or '汎用'
+
+    def roster_row(self, key: ReservoirKey, char_id: int) -> Dict[str, Any]:
+        return {'連番': char_id, '名前': f'NPC{char_id}', '階級': key[0], '下位流派': key[1], '功績点': self.kouseki}
+
+    def generate(self, key: ReservoirKey) -> Tuple[NPC, Dict[str, Any]]:
+        """(完成した NPC, 名簿の行) を1人分生成する"""
+        with self.generate_lock:
+            char_id = next(self.next_id)
+            row = self.roster_row(key, char_id)
+            npc = self.generator.complete_npc_data(npc_from_row(row), npc_rng(self.run_seed, char_id))
+        return npc, row
+
+    # --- 取り出し ---
+    def take(self, rank: str, school: str, generate_on_miss: bool = True) -> Optional[Tuple[NPC, Dict[str, Any]]]:
+        """
+        (階級, 流派) の NPC を1人取り出し、(NPC, 名簿の行) を返す。
+        蓄えが空の場合は generate_on_miss ならその場で生成し、そうでなければ None を返す (どちらも補充を予約する)。
+        """
+        key = self.make_key(rank, school)
+        with self.condition:
+            pool = self.pools.setdefault(key, collections.deque())
+            stats = self.stats.setdefault(key, PoolStats())
+            item = pool.popleft() if pool else None
+            if item is None:
+                stats.misses += 1
+            else:
+                stats.hits += 1
+            if len(pool) < self.low_water or not pool:
+                self._schedule(key)
+        if item is None and generate_on_miss:
+            item = self.generate(key)
+        return item
+
+    def warm(self, keys: Iterable[Tuple[str, str]]):
+        """指定した (階級, 流派) の蓄えを作り、補充を予約する"""
+        with self.condition:
+            for rank, school in keys:
+                key = self.make_key(rank, school)
+                self.pools.setdefault(key, collections.deque())
+                self.stats.setdefault(key, PoolStats())
+                if len(self.pools[key]) < self.capacity:
+                    self._schedule(key)
+
+    def _schedule(self, key: ReservoirKey):
+        # condition を保持した状態で呼ぶ
+        if key not in self.pending:
+            self.pending[key] = None
+            # wait_until_full で待っているスレッドもあるため、全員を起こす
+            self.condition.notify_all()
+
+    # --- バックグラウンドの補充 ---
+    def start(self):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._refill_loop, name='npc-reservoir', daemon=True)
+            self.worker.start()
+
+    def _refill_loop(self):
+        """補充待ちのキーに1人ずつ追加する。capacity に満たないキーは列の最後に戻し、キー間で交互に補充する"""
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                key = next(iter(self.pending))
+                del self.pending[key]
+                if len(self.pools[key]) >= self.capacity:
+                    self.condition.notify_all()
+                    continue
+                self.refilling = True
+            start = time.perf_counter()
+            try:
+                item = self.generate(key)
+            except Exception as e:
+                print(f"⚠️ 警告: {key[0]} / {key[1]} の NPC を補充できませんでした: {e}")
+                item = None
+            with self.condition:
+                self.refilling = False
+                if item is None:
+                    self.condition.notify_all()
+                    continue
+                pool = self.pools[key]
+                stats = self.stats[key]
+                stats.refilled += 1
+                stats.refill_seconds += time.perf_counter() - start
+                pool.append(item)
+                if len(pool) < self.capacity:
+                    self._schedule(key)
+                self.condition.notify_all()
+
+    def wait_until_full(self, timeout: Optional[float] = None) -> bool:
+        """補充待ちがなくなるまで待つ (timeout 秒以内に終わらなければ False)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while (self.pending or self.refilling) and not self.closed:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def close(self):
+        """補充スレッドを止める (生成中の1人は最後まで生成する)"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+    # --- 計測値 ---
+    def metrics(self) -> Dict[str, Any]:
+        """全体と (階級, 流派) ごとの 在庫 / ヒット / ミス / 補充人数 / 補充時間"""
+        with self.condition:
+            pools = {
+                f'{key[0]}/{key[1]}': dict(self.stats[key].to_dict(), size=len(pool))
+                for key, pool in self.pools.items()
+            }
+            pending = len(self.pending)
+        totals = {name: sum(p[name] for p in pools.values()) for name in ('size', 'hits', 'misses', 'refilled')}
+        requests = totals['hits'] + totals['misses']
+        totals['hit_rate'] = round(totals['hits'] / requests, 3) if requests else None
+        return {'capacity': self.capacity, 'low_water': self.low_water, 'pending': pending, **totals, 'pools': pools}
+
+    # --- 保存と読み込み ---
+    def save(self, path: str = RESERVOIR_FILE):
+        """蓄えた NPC を保存する (計測値は保存しない)"""
+        with self.condition:
+            state = {
+                'version': RESERVOIR_VERSION, 'master': master_signature(), 'run_seed': self.run_seed,
+                'kouseki': self.kouseki, 'next_id': next(self.next_id),
+                'pools': {key: list(pool) for key, pool in self.pools.items()},
+            }
+            self.next_id = itertools.count(state['next_id'])
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str = RESERVOIR_FILE) -> int:
+        """
+        保存した NPC を蓄えに戻し、戻した人数を返す。ファイルがない・形式やマスタや功績点が違う場合は何もしない。
+        戻した後、capacity に満たないキーの補充を予約する。
+        """
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            print(f"⚠️ 警告: 保存済みの NPC '{path}' を読み込めません: {e}")
+            return 0
+        if (state.get('version') != RESERVOIR_VERSION or state.get('master') != master_signature()
+                or state.get('kouseki') != self.kouseki):
+            print(f"⚠️ 警告: 保存済みの NPC '{path}' はマスタまたは設定が異なるため使いません。")
+            return 0
+
+        restored = 0
+        with self.condition:
+            self.run_seed = state['run_seed']
+            self.next_id = itertools.count(state['next_id'])
+            for key, items in state['pools'].items():
+                pool = self.pools.setdefault(key, collections.deque())
+                self.stats.setdefault(key, PoolStats())
+                for item in items[:self.capacity - len(pool)]:
+                    pool.append(item)
+                    restored += 1
+                if len(pool) < self.capacity:
+                    self._schedule(key)
+        return restored
+
+    def __enter__(self) -> 'NPCReservoir':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def reservoir_keys(generator: NPCGenerator, ranks: Optional[List[str]] = None,
+                   schools: Optional[List[str]] = None) -> List[ReservoirKey]:
+    """蓄える (階級, 流派) の組 (省略時は全階級 × 流派マスタの全流派)"""
+    ranks = ranks or list(RANK_SLOTS)
+    schools = schools or [school.name for school in generator.school_records]
+    return [(rank, school) for rank in ranks for school in schools]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='(階級, 流派) ごとに NPC を生成して蓄え、保存する')
+    parser.add_argument('--capacity', type=int, default=20, help='キーごとに蓄える人数 (既定: 20)')
+    parser.add_argument('--low-water', type=int, default=5, help='この人数を下回ったら補充する (既定: 5)')
+    parser.add_argument('--ranks', nargs='*', default=None, help='蓄える階級 (既定: すべて)')
+    parser.add_argument('--schools', nargs='*', default=None, help='蓄える流派 (既定: 流派マスタのすべて)')
+    parser.add_argument('--file', default=RESERVOIR_FILE, help=f'保存先 (既定: {RESERVOIR_FILE})')
+    parser.add_argument('--take', type=int, default=0, help='満たした後に各キーから取り出す人数 (動作確認用)')
+    parser.add_argument('--no-cache', action='store_true', help='前処理済みマスタのキャッシュを使わない')
+    args = parser.parse_args()
+
+    master_generator = npc_logic.create_generator(None if args.no_cache else MASTER_CACHE_DIR)
+    if master_generator is None:
+        raise SystemExit(1)
+    with NPCReservoir(master_generator, args.capacity, args.low_water) as reservoir:
+        restored_count = reservoir.load(args.file)
+        keys = reservoir_keys(master_generator, args.ranks, args.schools)
+        start_time = time.perf_counter()
+        reservoir.warm(keys)
+        reservoir.wait_until_full()
+        print(f"--- {len(keys)}組の蓄えを満たしました (保存済み {restored_count}人、"
+              f"{time.perf_counter() - start_time:.2f}秒) ---")
+        if args.take > 0:
+            start_time = time.perf_counter()
+            for _ in range(args.take):
+                for rank_name, school_name in keys:
+                    reservoir.take(rank_name, school_name)
+            elapsed = time.perf_counter() - start_time
+            print(f"取り出し: {args.take * len(keys)}人 ({elapsed / (args.take * len(keys)) * 1e6:.1f}マイクロ秒/人)")
+            reservoir.wait_until_full()
+        result = reservoir.metrics()
+        print(f"在庫 {result['size']}人 / ヒット {result['hits']} / ミス {result['misses']}"
+              f" / 補充 {result['refilled']}人 / ヒット率 {result['hit_rate']}")
+        reservoir.save(args.file)
+        print(f"{args.file} に保存しました。")
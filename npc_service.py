@@ -0,0 +1,367 @@
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import random
+import time
+from typing import List, Dict, Any, Optional, Tuple
+from urllib.parse import urlsplit, parse_qsl
+
+import numpy as np
+
+import npc_logic
+from npc_logic import MASTER_CACHE_DIR, RANK_SLOTS, WorkerMasterState, npc_base_row, npc_output_records
+from npc_reservoir import RESERVOIR_FILE, NPCReservoir, reservoir_keys
+
+# =======================================================
+# 生成サービス (常駐して HTTP / JSON で NPC を返す)
+# =======================================================
+# マスタを読み込んだ NPCGenerator を1つ保持し続けるため、リクエストごとの import やマスタ読み込みがない。
+# 生成と描画はイベントループの外 (スレッドまたはプロセス) で行い、待っている間も他の接続を受け付ける。
+#
+#   GET  /health                      状態とマスタ読み込み時間
+#   GET  /npc?階級=上忍&下位流派=...    NPC を1人生成 (POST で JSON 本文を渡してもよい)
+#   POST /npcs {"count": 10, ...}      同じ条件で複数人を生成
+#   GET  /sheet?階級=...               生成した NPC のキャラクターシート (HTML)
+#   GET  /reservoir                    NPC の蓄え (npc_reservoir) の在庫とヒット率
+#
+# 条件: 階級 / 下位流派 / 功績点 / 名前 / 連番 / seed / render (true で JSON に HTML を含める)。
+# seed を指定すると (seed, 連番) から run_generation と同じ結果になる。省略時は応答に使ったシードを返す。
+# 蓄えを有効にした場合、/npc で 階級 / 下位流派 (と render) だけを指定したリクエストには蓄えから返す。
+
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+# 1リクエストで生成できる人数と本文の上限
+MAX_BATCH = 1000
+MAX_BODY_BYTES = 1024 * 1024
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class ServiceError(Exception):
+    """HTTP のエラー応答にするための例外"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+def encode_json(data: Any) -> bytes:
+    return json.dumps(data, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+def parse_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+def parse_int(params: Dict[str, Any], key: str, default: Optional[int]) -> Optional[int]:
+    value = params.get(key)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ServiceError(400, f"'{key}' は整数で指定してください: {value!r}")
+
+
+class NPCService:
+    """
+    常駐する生成器と (読み込めた場合は) シートの描画器を持ち、リクエストを処理する。
+    workers <= 1 の場合は生成を1本のスレッドで行う (NPCGenerator は生成中に乱数生成器を差し替えるため、
+    同じ生成器を複数スレッドから同時に使わない)。workers > 1 の場合はプロセスプールで並列に生成し、
+    マスタは run_generation と同じく WorkerMasterState で渡す (fork できる環境では構築済みの生成器を引き継ぐ)。
+    """
+
+    def __init__(self, generator: npc_logic.NPCGenerator, renderer: Optional[Any] = None, workers: int = 1,
+                 reservoir: Optional[NPCReservoir] = None):
+        self.generator = generator
+        self.renderer = renderer
+        self.reservoir = reservoir
+        self.workers = max(1, workers)
+        self.next_id = itertools.count(1)
+        self.started = time.time()
+        self.served = 0
+        self.master_state = None
+        if self.workers > 1:
+            self.master_state = WorkerMasterState(generator)
+            self.generate_executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=self.master_state.context, initializer=npc_logic._init_generation_worker,
+                initargs=self.master_state.initargs,
+            )
+            # ワーカーはここで起動しておく (fork はスレッドを起動する前に行う)
+            self.generate_executor.submit(int).result()
+        else:
+            self.generate_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='npc-generate')
+        # Jinja2 のテンプレートはスレッド間で共有できる
+        self.render_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='npc-render')
+
+    def close(self):
+        self.generate_executor.shutdown(wait=True, cancel_futures=True)
+        self.render_executor.shutdown(wait=True, cancel_futures=True)
+        if self.master_state is not None:
+            self.master_state.close()
+
+    # --- 生成 ---
+    def roster_rows(self, params: Dict[str, Any], count: int) -> List[Dict[str, Any]]:
+        """リクエストの条件から、名簿と同じ形の行を count 行作る"""
+        rank = str(params.get('階級', '中忍')).strip()
+        if rank not in RANK_SLOTS:
+            raise ServiceError(400, f"不明な階級です: {rank} (候補: {'/'.join(RANK_SLOTS)})")
+        first_id = parse_int(params, '連番', None)
+        if first_id is None:
+            first_id = next(self.next_id)
+            # 自動採番はバッチの人数ぶん進める
+            for _ in range(count - 1):
+                next(self.next_id)
+        base_row = {
+            '階級': rank,
+            '下位流派': str(params.get('下位流派', '汎用')).strip() or '汎用',
+            '功績点': parse_int(params, '功績点', 0),
+        }
+        rows = []
+        for char_id in range(first_id, first_id + count):
+            row = dict(base_row, 連番=char_id)
+            row['名前'] = str(params['名前']) if params.get('名前') else f'NPC{char_id}'
+            rows.append(row)
+        return rows
+
+    async def generate(self, rows: List[Dict[str, Any]], run_seed: int) -> List[tuple]:
+        """行を生成し、(完成した NPC または None, エラーメッセージ または None) を行の順に返す"""
+        loop = asyncio.get_running_loop()
+        if self.workers <= 1:
+            return await loop.run_in_executor(self.generate_executor, npc_logic.generate_rows, self.generator, rows, run_seed)
+        size = -(-len(rows) // self.workers)
+        parts = await asyncio.gather(*(
+            loop.run_in_executor(self.generate_executor, npc_logic._generate_rows_in_worker, (rows[i:i + size], run_seed))
+            for i in range(0, len(rows), size)
+        ))
+        return [outcome for part in parts for outcome in part]
+
+    async def render(self, npc: npc_logic.NPC, row: Dict[str, Any]) -> str:
+        if self.renderer is None:
+            raise ServiceError(503, "シートの描画は無効です (テンプレートまたは描画用マスタを読み込めませんでした)。")
+        loop = asyncio.get_running_loop()
+        sheet = await loop.run_in_executor(self.render_executor, self.renderer.render,
+                                           npc_base_row(npc, row), npc_output_records(npc))
+        return sheet.html
+
+    @staticmethod
+    def request_seed(params: Dict[str, Any]) -> int:
+        run_seed = parse_int(params, 'seed', None)
+        return random.randrange(2 ** 32) if run_seed is None else run_seed
+
+    async def npc_data(self, npc: npc_logic.NPC, row: Dict[str, Any], render: bool) -> Dict[str, Any]:
+        data = npc_base_row(npc, row)
+        data['修得'] = npc_output_records(npc)
+        if render:
+            data['html'] = await self.render(npc, row)
+        return data
+
+    async def take_reserved(self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """階級 / 下位流派 だけのリクエストを蓄えから返す (蓄えがない・空・他の条件がある場合は None)"""
+        if self.reservoir is None or any(key in params for key in ('seed', '連番', '功績点', '名前')):
+            return None
+        item = self.reservoir.take(params.get('階級', '中忍'), params.get('下位流派', '汎用'), generate_on_miss=False)
+        if item is None:
+            return None
+        npc, row = item
+        self.served += 1
+        return {'seed': self.reservoir.run_seed, 'reserved': True,
+                'npc': await self.npc_data(npc, row, parse_bool(params.get('render', False)))}
+
+    async def build_npcs(self, params: Dict[str, Any], count: int) -> Tuple[int, List[Dict[str, Any]], List[str]]:
+        """条件に合う NPC を count 人生成し、(シード, NPC のデータ, エラーメッセージ) を返す"""
+        run_seed = self.request_seed(params)
+        rows = self.roster_rows(params, count)
+        outcomes = await self.generate(rows, run_seed)
+        render = parse_bool(params.get('render', False))
+        npcs, errors = [], []
+        for row, (npc, error) in zip(rows, outcomes):
+            if error is not None:
+                errors.append(error)
+                continue
+            npcs.append(await self.npc_data(npc, row, render))
+        self.served += len(npcs)
+        return run_seed, npcs, errors
+
+    # --- ルーティング ---
+    async def dispatch(self, method: str, target: str, body: bytes) -> Tuple[int, str, bytes]:
+        """(ステータス, Content-Type, 本文) を返す"""
+        url = urlsplit(target)
+        params: Dict[str, Any] = dict(parse_qsl(url.query))
+        if body:
+            try:
+                payload = json.loads(body)
+            except ValueError as e:
+                raise ServiceError(400, f"JSON を解釈できません: {e}")
+            if not isinstance(payload, dict):
+                raise ServiceError(400, "本文は JSON オブジェクトで指定してください。")
+            params.update(payload)
+
+        if url.path == '/health':
+            return 200, 'application/json', encode_json({
+                'status': 'ok', 'workers': self.workers, 'render': self.renderer is not None,
+                'master_load_ms': round(self.generator.master_load_seconds * 1000, 1),
+                'master_from_cache': self.generator.loaded_from_cache,
+                'uptime_seconds': round(time.time() - self.started, 1), 'served': self.served,
+                'reservoir': None if self.reservoir is None else {
+                    key: value for key, value in self.reservoir.metrics().items() if key != 'pools'
+                },
+            })
+        if url.path == '/reservoir':
+            if self.reservoir is None:
+                raise ServiceError(404, "NPC の蓄えは無効です (--reservoir で有効にできます)。")
+            return 200, 'application/json', encode_json(self.reservoir.metrics())
+        if url.path not in ('/npc', '/npcs', '/sheet'):
+            raise ServiceError(404, f"不明なパスです: {url.path}")
+        if method not in ('GET', 'POST'):
+            raise ServiceError(405, f"{method} は使えません (GET / POST)")
+
+        if url.path == '/sheet':
+            rows = self.roster_rows(params, 1)
+            npc, error = (await self.generate(rows, self.request_seed(params)))[0]
+            if error is not None:
+                raise ServiceError(500, error)
+            self.served += 1
+            return 200, 'text/html; charset=utf-8', (await self.render(npc, rows[0])).encode('utf-8')
+
+        if url.path == '/npc':
+            reserved = await self.take_reserved(params)
+            if reserved is not None:
+                return 200, 'application/json', encode_json(reserved)
+        count = parse_int(params, 'count', 1) if url.path == '/npcs' else 1
+        if not 1 <= count <= MAX_BATCH:
+            raise ServiceError(400, f"count は 1〜{MAX_BATCH} で指定してください: {count}")
+        run_seed, npcs, errors = await self.build_npcs(params, count)
+        if url.path == '/npc':
+            if errors:
+                raise ServiceError(500, errors[0])
+            return 200, 'application/json', encode_json({'seed': run_seed, 'npc': npcs[0]})
+        return 200, 'application/json', encode_json({'seed': run_seed, 'npcs': npcs, 'errors': errors})
+
+    # --- HTTP ---
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """HTTP/1.1 のリクエストを処理する (keep-alive に対応し、1接続で複数のリクエストを受ける)"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length > MAX_BODY_BYTES:
+                        keep_alive = False
+                        raise ServiceError(413, f"本文が大きすぎます ({length}バイト)")
+                    body = await reader.readexactly(length) if length > 0 else b''
+                    status, content_type, payload = await self.dispatch(method.upper(), target, body)
+                except ServiceError as e:
+                    status, content_type, payload = e.status, 'application/json', encode_json({'error': str(e)})
+                except ValueError as e:
+                    status, content_type, payload = 400, 'application/json', encode_json({'error': str(e)})
+                except Exception as e:
+                    status, content_type, payload = 500, 'application/json', encode_json({'error': f"{type(e).__name__}: {e}"})
+
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                    f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def create_renderer() -> Optional[Any]:
+    """html_exporter のテンプレートと描画用マスタを読み込む (読み込めない場合は None で、描画は無効)"""
+    try:
+        import html_exporter
+        masters = html_exporter.load_export_masters()
+        return html_exporter.SheetRenderer(*masters)
+    except Exception as e:
+        print(f"⚠️ 警告: シートの描画を無効にします: {e}")
+        return None
+
+async def serve(service: NPCService, host: str = SERVICE_HOST, port: int = SERVICE_PORT, unix_path: Optional[str] = None):
+    if unix_path:
+        server = await asyncio.start_unix_server(service.handle_connection, path=unix_path)
+        print(f"--- NPC 生成サービスを開始しました: unix:{unix_path} ---")
+    else:
+        server = await asyncio.start_server(service.handle_connection, host, port)
+        print(f"--- NPC 生成サービスを開始しました: http://{host}:{port}/ ---")
+    async with server:
+        await server.serve_forever()
+
+def run_service(host: str = SERVICE_HOST, port: int = SERVICE_PORT, unix_path: Optional[str] = None,
+                workers: int = 1, cache_dir: Optional[str] = MASTER_CACHE_DIR, render: bool = True,
+                reservoir_capacity: int = 0, reservoir_low_water: int = 5, reservoir_file: Optional[str] = RESERVOIR_FILE):
+    """
+    reservoir_capacity > 0 の場合は (階級, 流派) ごとに NPC を蓄え、reservoir_file から前回の蓄えを読み込む。
+    終了時 (Ctrl+C) に蓄えを reservoir_file に保存する。
+    """
+    generator = npc_logic.create_generator(cache_dir)
+    if generator is None:
+        return
+    reservoir = None
+    if reservoir_capacity > 0:
+        # 補充スレッドは生成ワーカーの起動 (fork) の後で始める
+        reservoir = NPCReservoir(generator, reservoir_capacity, min(reservoir_low_water, reservoir_capacity), start=False)
+        restored = reservoir.load(reservoir_file) if reservoir_file else 0
+        reservoir.warm(reservoir_keys(generator))
+        print(f"NPC の蓄え: {len(reservoir.pools)}組 × {reservoir_capacity}人 (保存済み {restored}人を読み込み、残りを補充中)")
+    service = NPCService(generator, create_renderer() if render else None, workers, reservoir)
+    if reservoir is not None:
+        reservoir.start()
+    try:
+        asyncio.run(serve(service, host, port, unix_path))
+    except KeyboardInterrupt:
+        print("\n--- NPC 生成サービスを終了しました ---")
+    finally:
+        service.close()
+        if reservoir is not None:
+            reservoir.close()
+            if reservoir_file:
+                try:
+                    reservoir.save(reservoir_file)
+                except OSError as e:
+                    print(f"⚠️ 警告: NPC の蓄えを保存できませんでした: {e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='マスタを読み込んだまま常駐し、HTTP / JSON で NPC を生成する')
+    parser.add_argument('--host', default=SERVICE_HOST, help=f'待ち受けるアドレス (既定: {SERVICE_HOST})')
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help=f'待ち受けるポート (既定: {SERVICE_PORT})')
+    parser.add_argument('--unix', default=None, help='TCP の代わりに Unix ソケットで待ち受ける')
+    parser.add_argument('--workers', type=int, default=1, help='生成に使うプロセス数 (既定: 1 はスレッドで生成)')
+    parser.add_argument('--no-cache', action='store_true', help='前処理済みマスタのキャッシュを使わない')
+    parser.add_argument('--no-render', action='store_true', help='シートの描画 (テンプレートの読み込み) を行わない')
+    parser.add_argument('--reservoir', type=int, default=0, help='(階級, 流派) ごとに蓄える NPC の人数 (既定: 0 は蓄えない)')
+    parser.add_argument('--reservoir-low-water', type=int, default=5, help='蓄えがこの人数を下回ったら補充する (既定: 5)')
+    parser.add_argument('--reservoir-file', default=RESERVOIR_FILE, help=f'蓄えの保存先 (既定: {RESERVOIR_FILE})')
+    args = parser.parse_args()
+    run_service(host=args.host, port=args.port, unix_path=args.unix, workers=args.workers,
+                cache_dir=None if args.no_cache else MASTER_CACHE_DIR, render=not args.no_render,
+                reservoir_capacity=args.reservoir, reservoir_low_water=args.reservoir_low_water,
+                reservoir_file=args.reservoir_file)